@@ -1,9 +1,19 @@
 __author__ = 'chris'
-import pkg_resources  # part of setuptools
 import argparse
 from pythomics.proteomics import config
 
-version = pkg_resources.require('pyquant-ms')[0].version
+
+def get_version():
+    try:
+        from importlib import metadata
+    except ImportError:
+        # pkg_resources is slow to import, so it is only used where importlib cannot tell us the version
+        import pkg_resources  # part of setuptools
+        return pkg_resources.require('pyquant-ms')[0].version
+    return metadata.version('pyquant-ms')
+
+
+version = get_version()
 
 description = """
 This will quantify labeled peaks (such as SILAC) in ms1 spectra. It relies solely on the distance between peaks,
@@ -38,6 +48,7 @@ search_group.add_argument('--skip', help="If true, skip scans with missing files
 search_group.add_argument('--peptide', help="The peptide(s) to limit quantification to.", type=str, nargs='*')
 search_group.add_argument('--peptide-file', help="A file of peptide(s) to limit quantification to.", type=argparse.FileType('r'))
 search_group.add_argument('--scan', help="The scan(s) to limit quantification to.", type=str, nargs='*')
+search_group.add_argument('--psm-merge-window', help="Quantify PSMs of the same peptide, charge and modifications once if their retention times are within this window of each other. The result is reported for each PSM. 0 disables merging.", type=float, default=0)
 
 replicate_group = pyquant_parser.add_argument_group("Missing Value Analysis")
 replicate_group.add_argument('--mva', help="Analyze files in 'missing value' mode.", action='store_true')
@@ -80,6 +91,7 @@ quant_parameters.add_argument('--merge-labels', help='Merge labels together to a
 quant_parameters.add_argument('--min-scans', help='How many quantification scans are needed to quantify a scan.', default=1, type=int)
 quant_parameters.add_argument('--min-resolution', help='The minimal resolving power of a scan to consider for quantification. Useful for skipping low-res scans', default=0, type=float)
 quant_parameters.add_argument('--no-mass-accuracy-correction', help='Disables the mass accuracy correction.', action='store_true')
+quant_parameters.add_argument('--calibration-cache', help='A directory to save the mass accuracy correction of each raw file in. Later runs on the same raw file and search results load it instead of fitting it again.', type=str)
 quant_parameters.add_argument('--no-contaminant-detection', help='Disables routine to check if an ion is a contaminant of a nearby peptide (checks if its a likely isotopologue).', action='store_true')
 
 peak_parameters = pyquant_parser.add_argument_group('Peak Fitting Parameters')
@@ -124,11 +136,18 @@ mrm_parameters.add_argument('--mrm-map', help=argparse.SUPPRESS, type=argparse.F
 output_group = pyquant_parser.add_argument_group("Output Options")
 output_group.add_argument('--debug', help="This will output debug information.", action='store_true')
 output_group.add_argument('--html', help="Output a HTML table summary.", action='store_true')
+output_group.add_argument('--html-chunk-size', help="The number of rows whose figures are stored together in each data file of the HTML summary.", type=int, default=500)
 output_group.add_argument('--resume', help="Will resume from the last run. Only works if not directing output to stdout.", action='store_true')
 output_group.add_argument('--sample', help="How much of the data to sample. Enter as a decimal (ie 1.0 for everything, 0.1 for 10%%)", type=float, default=1.0)
 output_group.add_argument('--disable-stats', help="Disable confidence statistics on data.", action='store_true')
 output_group.add_argument('--no-ratios', help="Disable reporting of ratios in output.", action='store_true')
 output_group.add_argument('-o', '--out', nargs='?', help='The prefix for the file output', type=str)
+output_group.add_argument('--output-buffer-size', help="How many results to buffer before they are written to disk.", type=int, default=100)
+output_group.add_argument('--output-flush-interval', help="The maximal time (in seconds) results are buffered before they are written to disk.", type=float, default=1.0)
+output_group.add_argument('--columnar-output', help="Additionally write results as typed columns to <out>.parquet or <out>.arrow (Arrow IPC). Requires pyarrow.", type=str, choices=('parquet', 'arrow'))
+output_group.add_argument('--ordered-output', help="Write the results of each raw file in retention time order of their targets rather than in the order they finish, so the same input always gives the same output. Results that finish early are held until the ones before them are written.", action='store_true')
+output_group.add_argument('--reorder-window', help="With --ordered-output, how many targets ahead of the earliest unfinished one may be quantified. This bounds the results that are held.", type=int, default=1000)
+output_group.add_argument('--durable-output', help="Write and sync every result to disk as soon as it is received. This is slower, but no completed results are lost if the run is interrupted.", action='store_true')
 
 PER_PEAK = 'per-peak'
 PER_FILE = 'per-file'
@@ -138,6 +157,26 @@ spectra_output = pyquant_parser.add_argument_group("Spectra Output Options")
 spectra_output.add_argument('--export-mzml', help='Create an mzml file of spectra contained within each peak.', action='store_true')
 spectra_output.add_argument('--export-mode', help='How to export the scans. per-peak: A mzML per peak identified. per-id: A mzML per ion identified (each row of the output gets an mzML). per-file: All scans matched per raw file.', type=str, default='per-peak', choices={PER_PEAK, PER_ID, PER_FILE})
 
+scheduling_group = pyquant_parser.add_argument_group('Scheduling Options')
+scheduling_group.add_argument('--tasks-per-worker', help="The number of task chunks queued for each worker at a time.", type=int, default=2)
+scheduling_group.add_argument('--disable-cost-scheduling', help="Send tasks one at a time in retention time order, instead of starting the most expensive tasks first and sending cheap tasks in chunks.", action='store_true')
+scheduling_group.add_argument('--chunk-seconds', help="How long a chunk of cheap tasks should take to quantify.", type=float, default=0.5)
+scheduling_group.add_argument('--rt-bands', help="Give each worker a contiguous band of retention times to quantify, so workers reuse the scans of their neighboring targets. Workers that finish their band take over part of another.", action='store_true')
+scheduling_group.add_argument('--worker-scan-cache', help="The number of scans each worker keeps so neighboring targets do not fetch them from the reader again. Defaults to 200 with --rt-bands, and 0 otherwise.", type=int, default=None)
+scheduling_group.add_argument('--envelope-cache', help="The number of isotopic envelope searches each worker keeps, so targets that overlap in m/z and retention time do not search the same scan for the same ions again. 0 disables it.", type=int, default=1000)
+scheduling_group.add_argument('--task-timeout', help="The number of seconds a single target may take before its worker is restarted. The target is retried once with the fast peak finding mode, and then listed in a .quarantine file next to the output.", type=float, default=None)
+scheduling_group.add_argument('--max-workers', help="Add and remove workers as the run goes, between --min-workers and this many. Workers are added while they spend their time fitting, and removed when they mostly wait on the reader or results are waiting to be written. -p is the number of workers to start with.", type=int, default=None)
+scheduling_group.add_argument('--min-workers', help="The fewest workers to scale down to with --max-workers.", type=int, default=1)
+scheduling_group.add_argument('--autoscale-interval', help="The number of seconds between changes to the number of workers with --max-workers.", type=float, default=10)
+scheduling_group.add_argument('--native-threads', help="The number of threads BLAS and OpenMP libraries may use in the reader and each worker. 0 leaves them at their defaults, which is usually a thread per core in every process.", type=int, default=1)
+scheduling_group.add_argument('--pin-cores', help="Pin the reader and each worker to their own core.", action='store_true')
+scheduling_group.add_argument('--worker-memory-limit', help="The resident memory in MB a worker may grow to. A worker over the limit is replaced once it finishes its current target.", type=float, default=None)
+scheduling_group.add_argument('--start-method', help="How the reader and worker processes are started. forkserver imports the modules they need once in a server process, which makes starting each of them quick.", type=str, choices=('fork', 'spawn', 'forkserver'), default=None)
+scheduling_group.add_argument('--sweep', help="Read the quant scans of each raw file once, in retention time order, and extract the XICs of every target overlapping a scan from it together, instead of each target fetching its own scans. The scans read ahead for a target span its expected length, which is --xic-window-size scans to each side of it, or 25 if it is not set. Scans an XIC extends to past those are fetched as usual.", action='store_true')
+scheduling_group.add_argument('--plan', help="Only build the targets of each raw file, and report the work and memory quantifying them takes along with a suggested number of workers for this machine.", action='store_true')
+scheduling_group.add_argument('--auto', help="Choose the number of workers for each raw file from its plan, rather than -p.", action='store_true')
+scheduling_group.add_argument('--scheduler-history', help="A file to keep task timings in between runs, used to size chunks before the first results of a run arrive.", type=str)
+
 convenience_group = pyquant_parser.add_argument_group('Convenience Parameters')
 convenience_group.add_argument('--neucode', help='This will select parameters specific for neucode. Note: You still must define a labeling scheme.', action='store_true')
 convenience_group.add_argument('--isobaric-tags', help='This will select parameters specific for isobaric tag based labeling (TMT/iTRAQ).', action='store_true')
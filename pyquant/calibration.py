@@ -0,0 +1,76 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.interpolate import UnivariateSpline
+
+# the m/z range and spacing the fitted correction is sampled over
+GRID_LOW = 50.
+GRID_HIGH = 4000.
+GRID_STEP = 0.1
+
+
+class MassCalibration(object):
+    """
+    A mass accuracy correction, sampled onto a dense m/z grid.
+
+    The correction is fit as a spline of the mass error (in ppm) against the observed mass, and is then stored as the
+    factor each m/z is multiplied by at every grid point. Calibrating masses is a linear interpolation of the factor,
+    which works on whole arrays at once and is much cheaper than evaluating the spline. Masses outside of the grid use
+    the factor of the nearest end of it.
+
+    :param mz: The m/z of each grid point, in ascending order.
+    :param factors: The correction factor at each grid point.
+    """
+    def __init__(self, mz, factors):
+        self.mz = np.asarray(mz, dtype=float)
+        self.factors = np.asarray(factors, dtype=float)
+
+    @classmethod
+    def fit(cls, observed, errors, min_points=10):
+        """
+        Fits the correction from the observed masses of PSMs and their error in ppm. Returns None if there are not
+        enough PSMs within 25 ppm to fit it.
+        """
+        spline_df = pd.DataFrame({'Observed': observed, 'Error': errors}, columns=['Observed', 'Error'])
+        spline_df = spline_df[(spline_df['Error'] < 25) & (spline_df['Error'] > -25)].dropna()
+        spline_df = spline_df.sort_values('Observed').drop_duplicates('Observed')
+        if len(spline_df) <= min_points:
+            return None
+        observed = spline_df['Observed'].astype(float).values
+        spline = UnivariateSpline(observed, spline_df['Error'].astype(float).values, s=1e6)
+        grid = np.arange(min(GRID_LOW, observed[0]), max(GRID_HIGH, observed[-1])+GRID_STEP, GRID_STEP)
+        return cls(grid, 1/(1-spline(grid)/1e6))
+
+    def __call__(self, mz):
+        return mz*np.interp(mz, self.mz, self.factors)
+
+    def save(self, path, source=None):
+        # written to a temporary file first so an interrupted run does not leave a partial file behind
+        with open('{}.tmp'.format(path), 'wb') as handle:
+            np.savez(handle, mz=self.mz, factors=self.factors, source=np.array(json.dumps(source)))
+        os.rename('{}.tmp'.format(path), path)
+
+    @classmethod
+    def load(cls, path, source=None):
+        """
+        Loads a saved correction. Returns None if there is none at path, or if it was fit from a different source.
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as saved:
+            if json.loads(str(saved['source'])) != json.loads(json.dumps(source)):
+                return None
+            return cls(saved['mz'], saved['factors'])
+
+
+def calibration_source(raw_file, search_file):
+    """
+    What a mass correction depends on: the raw file and search results it was fit from, and when they last changed.
+    """
+    source = []
+    for path in (raw_file, search_file):
+        stat = os.stat(path) if path and os.path.exists(path) else None
+        source.append([os.path.abspath(path) if path else None, stat.st_size if stat else None, stat.st_mtime if stat else None])
+    return source
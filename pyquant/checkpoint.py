@@ -0,0 +1,89 @@
+import json
+import os
+import sqlite3
+import threading
+
+from six.moves import cPickle as pickle
+
+PICKLE_PROTOCOL = 2
+
+
+class Checkpoint(object):
+    """
+    Tracks the progress of a run so it can be resumed.
+
+    The checkpoint is a SQLite database holding the key of every result that has been written, and for each raw file,
+    the tasks and scan maps built for it and whether all of its results have been written. This lets a resumed run
+    skip files that were finished entirely, and go straight to quantification for files that were partially finished.
+
+    Keys can be added from the result writer thread while the main thread records file progress, so all access goes
+    through a lock.
+
+    :param path: The database file.
+    :param mode: 'w' to start a new checkpoint, 'a' to continue an existing one (it is created if it does not exist)
+        and 'r' to read an existing one without changing it.
+    """
+    def __init__(self, path, mode='a'):
+        self.path = path
+        if mode == 'w' and os.path.exists(path):
+            os.remove(path)
+        if mode == 'r' and not os.path.exists(path):
+            raise IOError('{} does not exist.'.format(path))
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        if mode != 'r':
+            self.connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS files (filename TEXT PRIMARY KEY, state BLOB, complete INTEGER DEFAULT 0)')
+            self.connection.commit()
+
+    def encode_key(self, key):
+        return json.dumps(list(key))
+
+    def __contains__(self, key):
+        with self.lock:
+            cursor = self.connection.execute('SELECT 1 FROM results WHERE key = ?', (self.encode_key(key),))
+            return cursor.fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def append(self, key):
+        with self.lock:
+            self.connection.execute('INSERT OR IGNORE INTO results (key) VALUES (?)', (self.encode_key(key),))
+
+    def flush(self, durable=False):
+        # sqlite syncs on every commit, so there is nothing extra to do for durable writes
+        with self.lock:
+            self.connection.commit()
+
+    def get_file_state(self, filename):
+        """
+        Returns a tuple of (state, complete) for the file, or None if nothing has been saved for it.
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT state, complete FROM files WHERE filename = ?', (filename,)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(bytes(row[0])), bool(row[1])
+
+    def save_file_state(self, filename, state):
+        payload = sqlite3.Binary(pickle.dumps(state, PICKLE_PROTOCOL))
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO files (filename, state, complete) VALUES (?, ?, 0)', (filename, payload))
+            self.connection.commit()
+
+    def mark_complete(self, filename):
+        with self.lock:
+            self.connection.execute('UPDATE files SET complete = 1 WHERE filename = ?', (filename,))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
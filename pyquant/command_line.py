@@ -1,25 +1,27 @@
 from __future__ import division, unicode_literals, print_function
-import base64
+import argparse
 import copy
-import gzip
+import json
 import os
 import operator
 import traceback
 import random
 import signal
 import sys
+import time
 from collections import defaultdict, OrderedDict
 from functools import partial
-from multiprocessing import Queue, Manager
-from string import Template
+import multiprocessing
+from multiprocessing import Queue, cpu_count
 
-import pandas as pd
 import six
-from pythomics.proteomics.parsers import GuessIterator
-from pythomics.proteomics import config
-from scipy.interpolate import UnivariateSpline
-from six.moves.queue import Empty
 from six.moves import xrange
+from six.moves import cPickle as pickle
+try:
+    from multiprocessing.connection import wait
+except ImportError:
+    # python 2 cannot wait on several connections at once, so we fall back to polling
+    wait = None
 try:
     from profilestats import profile
     from memory_profiler import profile as memory_profiler
@@ -27,11 +29,10 @@ except ImportError:
     pass
 
 
-from .reader import Reader
-from .worker import Worker
-from .utils import find_prior_scan, get_scans_under_peaks, naninfmean, naninfsum, perform_ml, get_formatted_mass
-from . import peaks
-from pyquant.cpeaks import find_nearest_indices
+from .writer import ReorderBuffer, ResultWriter, TextSink, ColumnarSink, RecordSink, FLOAT, STRING, truncate_lines
+from .store import RecordStore
+from .checkpoint import Checkpoint
+from .governor import Governor, RECYCLE_EXIT_CODE, set_thread_environment
 
 
 description = """
@@ -41,13 +42,86 @@ an assortment of datatypes and allows a high degree of customization for how dat
 
 ION_CUTOFF = 2
 
-CRASH_SIGNALS = {signal.SIGSEGV, }
+# the modules the reader and workers use, which a forkserver imports before starting any of them
+PRELOAD_MODULES = ['numpy', 'pandas', 'scipy.optimize', 'pyquant.peaks', 'pyquant.reader', 'pyquant.worker']
+
+# the number of targets whose scans and tasks are measured to plan a file
+PLAN_SAMPLE_SIZE = 20
+
+QUARANTINE_HEADERS = ['Raw File', 'Peptide', 'Charge', 'Scan', 'Modifications', 'Reason']
+
+
+def wait_for_events(result_queue, workers, timeout=None, sweep=None):
+    """
+    Blocks until a result is available, a worker exits or a sweep has extracted more XICs, or timeout seconds have
+    passed. Returns the next result, or None if there is none yet, and the workers that exited.
+
+    Workers send no end marker, as a worker's results are in the result pipe by the time it exits. Once every worker
+    has exited, a result of None with a timeout of 0 means the pipe is drained.
+    """
+    if wait is None:
+        result_ready = result_queue._reader.poll(0.1 if timeout is None else min(timeout, 0.1))
+        exited = [i for i in workers if not i.is_alive()]
+    else:
+        sweep_events = [sweep.outgoing._reader, sweep.sentinel] if sweep is not None and not sweep.done else []
+        ready = wait([result_queue._reader]+[i.sentinel for i in workers]+sweep_events, timeout=timeout)
+        result_ready = result_queue._reader in ready
+        exited = [i for i in workers if i.sentinel in ready]
+    return result_queue.get() if result_ready else None, exited
+
+
+def worker_parser_args(args):
+    """
+    A copy of the parsed arguments without the open files in it, which workers do not use and cannot be pickled.
+    """
+    def is_file(value):
+        if isinstance(value, (list, tuple)):
+            return any(is_file(i) for i in value)
+        return hasattr(value, 'read') or hasattr(value, 'write')
+    return argparse.Namespace(**{key: value for key, value in six.iteritems(vars(args)) if not is_file(value)})
+
+
+# result keys that are not numeric, used to type columnar output
+STRING_RESULTS = {'peptide', 'modifications', 'accession', 'ms1', 'scan', 'ions_found', 'label'}
+
+def set_start_method(method):
+    """
+    Sets how the reader and worker processes are started. With forkserver, a server process imports the modules they
+    use once, and every process after that is forked from it rather than from this one.
+    """
+    if method is None:
+        return
+    if not hasattr(multiprocessing, 'set_start_method'):
+        sys.stderr.write('The {} start method is not available in this version of python, processes will be forked.\n'.format(method))
+        return
+    multiprocessing.set_start_method(method, force=True)
+    if method == 'forkserver':
+        multiprocessing.set_forkserver_preload(PRELOAD_MODULES)
+
 
 def run_pyquant():
     from . import pyquant_parser
-    # for some reason this is being undefined in windows
-    import numpy as np
     args = pyquant_parser.parse_args()
+    # processes and their queues must be created after the start method is set
+    set_start_method(args.start_method)
+    # the scientific stack, and the modules of ours that use it, are imported once the arguments are parsed, so --help
+    # and argument errors return right away.
+    # numpy is imported here because for some reason this is being undefined in windows
+    import numpy as np
+    import pandas as pd
+    from pythomics.proteomics.parsers import GuessIterator
+    from pythomics.proteomics import config
+    from pyquant.cpeaks import find_nearest_indices
+    from . import peaks
+    from .calibration import MassCalibration, calibration_source
+    from .reader import Reader
+    from .utils import find_prior_scan, get_scans_under_peaks, naninfmean, naninfsum, perform_ml, get_formatted_mass
+    from .worker import Worker
+    from .report import HtmlReport
+    from .sweep import ScanSweep, make_sweep_targets
+    from .scheduler import TaskScheduler, Autoscaler, estimate_task_cost
+    from .runmap import RunMap, RTWindows, ScanMask
+    from .planner import PSM_FIELDS, merge_redundant_psms, task_size, plan_file, format_plan, available_memory
     isotopologue_limit = args.isotopologue_limit
     isotopologue_limit = isotopologue_limit if isotopologue_limit else None
     labels_needed = args.labels_needed
@@ -68,7 +142,7 @@ def run_pyquant():
     reporter_mode = args.reporter_ion
     msn_ppm = args.msn_ppm
     if args.msn_rt_window:
-        msn_rt_window = [tuple(map(float, i.split('-'))) for i in args.msn_rt_window]
+        msn_rt_window = RTWindows([tuple(map(float, i.split('-'))) for i in args.msn_rt_window])
     else:
         msn_rt_window = None
     ref_label = str(args.reference_label) if args.reference_label else None
@@ -99,6 +173,21 @@ def run_pyquant():
 
     mrm_pair_info = pd.read_table(args.mrm_map) if args.mrm and args.mrm_map else None
 
+    if args.columnar_output:
+        try:
+            import pyarrow
+        except ImportError:
+            sys.stderr.write('pyarrow is required for --columnar-output. It may be installed with pip install pyarrow.\n')
+            return 1
+
+    if args.ordered_output and args.rt_bands:
+        sys.stderr.write('--ordered-output cannot be used with --rt-bands, which quantifies targets of every retention time from the start.\n')
+        return 1
+
+    if args.sweep and (args.mrm or args.rt_bands or args.ordered_output):
+        sys.stderr.write('--sweep cannot be used with --mrm, --rt-bands or --ordered-output, as it hands targets out in the order their XICs end.\n')
+        return 1
+
     scan_filemap = {}
     found_scans = {}
     raw_files = {}
@@ -331,10 +420,6 @@ def run_pyquant():
         return 1
     sys.stderr.write('\nScans loaded.\n')
 
-    pq_dir = os.path.split(__file__)[0]
-
-    pyquant_html_file = os.path.join(pq_dir, 'static', 'pyquant_output.html')
-
     workers = []
     completed = 0
     sys.stderr.write('Beginning quantification.\n')
@@ -429,66 +514,85 @@ def run_pyquant():
                                              ])
 
     headers = ['Raw File']+[i[1] for i in RESULT_ORDER]
-    if resume and os.path.exists(out):
-        if not out:
-            sys.stderr.write('You may only resume runs with a file output.\n')
-            return -1
-        out = open(out, 'a+')
-        out_path = out.name
+    if args.plan:
+        # plans only report on the targets, so the output, record store and checkpoint of a run are left as they are.
+        # The checkpoint of a run being resumed is only read, to leave out the targets it finished.
+        checkpoint_path = '{}.checkpoint'.format(out) if out else None
+        resume = resume and checkpoint_path is not None and os.path.exists(checkpoint_path)
+        checkpoint = Checkpoint(checkpoint_path, mode='r') if resume else None
     else:
-        if out:
-            out = open(out, 'w+')
+        if resume and os.path.exists(out):
+            if not out:
+                sys.stderr.write('You may only resume runs with a file output.\n')
+                return -1
+            out = open(out, 'a+')
             out_path = out.name
         else:
-            out = sys.stdout
-            out_path = source_file
-        out.write('{0}\n'.format('\t'.join(headers)))
-
-    if html:
-        def table_rows(html_list, res=None):
-            # each item is a string like a\tb\tc
-            if html_list:
-                d = html_list.pop(0)
+            if out:
+                out = open(out, 'w+')
+                out_path = out.name
             else:
-                return res
-            l = d['table']
-            html_extra = d.get('html', {})
-            keys = d['keys']
-            if res is None:
-                res = '<tr>'
-            out = ['<td></td>']# for graph controls
-            for col_index, (i,v) in enumerate(zip(l.split('\t'), keys)):
-                out.append('<td>{0}</td>'.format(i))
-            res += '\n'.join(out)+'</tr>'
-            return table_rows(html_list, res=res), html_extra
+                out = sys.stdout
+                out_path = source_file
+            out.write('{0}\n'.format('\t'.join(headers)))
 
+        # every result is kept in a binary record store for post-processing, and the checkpoint tracks what is finished
+        try:
+            result_store = RecordStore('{}.tmp'.format(out.name), mode='a' if resume else 'w')
+        except ValueError as e:
+            sys.stderr.write('{} It was written by an older version of pyquant, so this run cannot be resumed. Run it again without --resume.\n'.format(e))
+            return 1
+        checkpoint = Checkpoint('{}.checkpoint'.format(out.name), mode='a' if resume else 'w')
         if resume:
-            html_out = open('{0}.html'.format(out_path), 'a')
-        else:
-            html_out = open('{0}.html'.format(out_path), 'w')
-            template = []
-            for i in open(pyquant_html_file, 'r'):
-                if 'HTML BREAK' in i:
-                    break
-                template.append(i)
-            html_template = Template(''.join(template))
-            html_out.write(html_template.substitute({'title': source_file, 'table_header': '\n'.join(['<th>{0}</th>'.format(i) for i in ['Controls', 'Raw File']+[i[1] for i in RESULT_ORDER]])}))
-
-    skip_map = set([])
-    if resume:
-        resume_name = '{}.tmp'.format(out.name)
-        if os.path.exists(resume_name):
-            with open(resume_name, 'r') as temp_file:
-                for index, entry in enumerate(temp_file):
-                    info = pd.io.json.loads(entry)['res_list']
-                    # key is filename, peptide, charge, target scan id, modifications
-                    key = tuple(map(str, (info[0], info[1], info[3], info[5], info[2])))
-                    skip_map.add(key)
-            temp_file = open(resume_name, 'a')
-        else:
-            temp_file = open(resume_name, 'w')
-    else:
-        temp_file = open('{}.tmp'.format(out.name), 'w')
+            # The checkpoint is written last, so the results written after its last commit are at the end of the
+            # store and the output. Their targets are quantified again, so they are dropped to not write them twice.
+            committed = len(result_store)
+            while committed and result_store[committed-1]['key'] not in checkpoint:
+                committed -= 1
+            if committed < len(result_store):
+                result_store.truncate(committed)
+                if out != sys.stdout:
+                    truncate_lines(out.name, committed+1)
+        # targets that crashed or timed out their worker twice are listed here instead of being quantified
+        quarantine_path = '{}.quarantine'.format(out.name)
+        if not resume and os.path.exists(quarantine_path):
+            os.remove(quarantine_path)
+
+        result_sinks = [TextSink(out, formatter=operator.itemgetter('row'))]
+        if args.columnar_output:
+            def get_column_type(key):
+                if key in STRING_RESULTS:
+                    return STRING
+                # merged labels report their precursors joined together
+                if key.endswith('_precursor') and (args.merge_labels or ion_search):
+                    return STRING
+                return FLOAT
+
+            columnar_path = '{}.{}'.format(out_path, args.columnar_output)
+            part = 1
+            while resume and os.path.exists(columnar_path):
+                # columnar files cannot be appended to, so resumed runs write their results to a new part
+                columnar_path = '{}.part{}.{}'.format(out_path, part, args.columnar_output)
+                part += 1
+            result_sinks.append(ColumnarSink(
+                columnar_path,
+                [('Raw File', STRING)]+[(i[1], get_column_type(i[0])) for i in RESULT_ORDER],
+                formatter=lambda x: ([x['res_dict']['filename']]+[x['res_dict'].get(i[0], 'NA') for i in RESULT_ORDER], x['res_dict']['peak_report']),
+                peak_columns=[(i[1], get_column_type(i[0])) for i in PEAK_REPORTING] if PEAK_REPORTING else None,
+                file_format=args.columnar_output,
+            ))
+        result_sinks.append(
+            RecordSink(result_store, formatter=lambda x: {'key': x['key'], 'res_dict': x['res_dict'], 'html': x['html']})
+        )
+        # The checkpoint is the last sink, so every key in it has already been written to the output
+        result_sinks.append(RecordSink(checkpoint, formatter=operator.itemgetter('key')))
+        result_writer = ResultWriter(
+            result_sinks,
+            batch_size=args.output_buffer_size,
+            flush_interval=args.output_flush_interval,
+            durable=args.durable_output,
+        )
+        result_writer.start()
 
     silac_shifts = {}
     for silac_label, silac_masses in mass_labels.items():
@@ -498,456 +602,637 @@ def run_pyquant():
             except Exception as e:
                 silac_shifts[get_formatted_mass(mass)] = aas
 
+    # how long tasks took in previous runs, which is used to judge how many tasks to send to workers at once
+    scheduler_history = {}
+    if args.scheduler_history and os.path.exists(args.scheduler_history):
+        with open(args.scheduler_history, 'r') as history_file:
+            scheduler_history = json.load(history_file)
+    worker_scan_cache = args.worker_scan_cache if args.worker_scan_cache is not None else (200 if args.rt_bands else 0)
+    worker_args = worker_parser_args(args)
+    # the reader and every worker get their own share of the machine, rather than a BLAS thread pool per core each
+    governor = Governor(
+        native_threads=args.native_threads or None,
+        pin=args.pin_cores,
+        memory_limit=args.worker_memory_limit*1024**2 if args.worker_memory_limit else None,
+    )
+    if args.native_threads:
+        set_thread_environment(args.native_threads)
+    task_cost = partial(estimate_task_cost, label_count=len(mass_labels), isotopologue_limit=isotopologue_limit, xic_window_size=args.xic_window_size)
+
+    # this is to fix the header at the end to include peak information if we have multiple peaks
+    most_peaks_found = 0
+    pending_exports = []
     for filename in raw_files.keys():
         raw_scans = raw_files[filename]
         filepath = scan_filemap[filename]
         if not len(raw_scans):
             continue
-        in_queue = Queue()
+        file_state = checkpoint.get_file_state(filename) if resume else None
+        if file_state is not None and file_state[1]:
+            sys.stderr.write('{} was completed in a previous run, skipping.\n'.format(filepath))
+            completed += sum(task_size(i[1]) for i in file_state[0]['tasks'])
+            continue
         result_queue = Queue()
         reader_in = Queue()
         reader_outs = {'main': Queue()}
-        for i in xrange(threads):
+        # with --auto or --max-workers, the number of workers is only known once the targets are built or as they run
+        for i in xrange(max(threads, cpu_count() if args.auto else 0, args.max_workers or 0)):
             reader_outs[i] = Queue()
 
-        msn_map = []
-        scan_rt_map = {}
-        msn_rt_map = {}
-        scan_charge_map = {}
-
-        raw = GuessIterator(filepath, full=False, store=False)
-        sys.stderr.write('Processing {}.\n'.format(filepath))
-
-        # params in case we are doing ion search or replicate analysis
-        ion_tolerance = args.precursor_ppm/1e6 if args.mva else args.msn_ppm/1e6
-        ion_search_list = []
-        replicate_search_list = defaultdict(list)
-        scans_to_fetch = []
-
-        # figure out the splines for mass accuracy correction
-        calc_spline = not mass_accuracy_correction and not raw_data_only and not args.neucode
-        spline_x = []
-        spline_y = []
-        spline = None
-
-        scan_info_map = defaultdict(dict)
-
-        for index, scan in enumerate(raw):
-            if index % 100 == 0:
-                sys.stderr.write('.')
-            if scan is None:
-                continue
-            scan_id = scan.id
-            msn_map.append((scan.ms_level if not args.mrm else scan.mass, scan_id))
-            rt = scan.rt
-            if scan.ms_level == msn_for_quant:
-                msn_rt_map[scan_id] = int(scan.title) if args.mrm else rt
-            scan_rt_map[scan_id] = rt
-            scan_info_map[scan_id]['parent'] = scan.parent
-            scan_info_map[scan_id]['msn'] = scan.ms_level
-            scan_info_map[scan_id]['precursor'] = scan.mass
-            scan_charge_map[scan_id] = scan.charge
-            if msn_rt_window and not any([(i[0] < float(rt) < i[1]) for i in msn_rt_window]):
-                continue
-            if scan.parent:
-                try:
-                    scan_info_map[scan.parent]['children'].add(scan_id)
-                except KeyError:
-                    scan_info_map[scan.parent]['children'] = set([scan_id])
-            if not scans_to_select or str(scan_id) in scans_to_select:
-                if ion_search:
-                    if scan.ms_level == msn_for_id:
-                        scans_to_fetch.append(scan_id)
-                elif all_msn:
-                    # we are quantifying all msn spectra of a given type
-                    if msn_for_id == scan.ms_level:
-                        # find the closest scan to this, which will be the parent scan
-                        spectra_to_quant = find_prior_scan(msn_map, scan_id, ms_level=msn_for_quant) if msn_for_quant != msn_for_id else scan_id
-                        d = {
-                            'quant_scan': {'id': spectra_to_quant},
-                            'id_scan': {'id': scan_id, 'rt': scan.rt, 'charge': scan.charge, 'mass': float(scan.mass), 'product_ion': float(scan.product_ion) if args.mrm else None},
-                        }
-                        ion_search_list.append((spectra_to_quant, d))
-                elif args.mva:
-                    if scan.ms_level == msn_for_quant:
-                        scans_to_fetch.append(scan_id)
-            if not raw_data_only and calc_spline:
-                if hasattr(scan, 'theor_mass'):
-                    theor_mass = scan.getTheorMass()
-                    observed_mass = scan.mass
-                    mass_error = (theor_mass-observed_mass)/theor_mass*1e6
-                    spline_x.append(observed_mass)
-                    spline_y.append(mass_error)
-            del scan
-
-        if calc_spline and len(spline_x):
-            spline_df = pd.DataFrame(zip(spline_x, spline_y), columns=['Observed', 'Error'])
-            spline_df = spline_df[(spline_df['Error']<25) & (spline_df['Error']>-25)].dropna()
-            spline_df.sort('Observed', inplace=True)
-            spline_df.drop_duplicates('Observed', inplace=True)
-            if len(spline_df) > 10:
-                spline = UnivariateSpline(spline_df['Observed'].astype(float).values, spline_df['Error'].astype(float).values, s=1e6)
-            else:
-                spline = None
-
-        reader = Reader(reader_in, reader_outs, raw_file=filepath, spline=spline, rt_window=msn_rt_window)
-        reader.start()
-        rep_map = defaultdict(set)
-        if ion_search or args.mva:
-            ions = [i['id_scan'].get('theor_mass', i['id_scan']['mass']) for i in raw_scans] if args.mva else raw_scans['ions']
-            rt_info = raw_scans.get('rt_info') if not args.mva else None
-            last_scan_ions = defaultdict(set)
-            for scan_id in scans_to_fetch:
-                this_scan_ions = defaultdict(set)
-                reader_in.put((0, scan_id, None, None))
-                scan = reader_outs[0].get()
+        if file_state is None:
+            msn_map = []
+            scan_rt_map = {}
+            msn_rt_map = {}
+            scan_charge_map = {}
+            # scans outside of the retention time windows, which the reader does not need to parse
+            rt_excluded = set([])
+
+            raw = GuessIterator(filepath, full=False, store=False)
+            sys.stderr.write('Processing {}.\n'.format(filepath))
+
+            # params in case we are doing ion search or replicate analysis
+            ion_tolerance = args.precursor_ppm/1e6 if args.mva else args.msn_ppm/1e6
+            ion_search_list = []
+            replicate_search_list = defaultdict(list)
+            scans_to_fetch = []
+
+            # figure out the splines for mass accuracy correction
+            calc_spline = not mass_accuracy_correction and not raw_data_only and not args.neucode
+            spline_x = []
+            spline_y = []
+            calibration = None
+            if calc_spline and args.calibration_cache:
+                calibration_path = os.path.join(args.calibration_cache, '{}.calibration.npz'.format(filename))
+                source = calibration_source(filepath, source_file)
+                calibration = MassCalibration.load(calibration_path, source=source)
+                if calibration is not None:
+                    # the correction was fit by a previous run, so we do not need the PSMs to fit it again
+                    calc_spline = False
+
+            scan_info_map = defaultdict(dict)
+
+            for index, scan in enumerate(raw):
+                if index % 100 == 0:
+                    sys.stderr.write('.')
                 if scan is None:
                     continue
-                if args.msn_all_scans:
-                    # if not args.require_all_ions:
-                    #     ions = set([j for i in ions for j in i])
-                    for ion_index, ion_set in enumerate(ions):
-                        d = {
-                            'quant_scan': {'id': scan_id, 'scans': scans_to_fetch},
-                            'id_scan': {
-                                'id': scan_id, 'theor_mass': ion_set[0], 'rt': rt_info[ion_index] if rt_info else scan['rt'],
-                                'charge': 1, 'mass': ion_set[0], 'ions_found': None, 'ion_set': ion_set,
-                            },
-                            'combine_xics': args.require_all_ions,
-                        }
-                        ion_search_list.append((scan_id, d))
-                    break
-                scan_mzs = scan['vals']
-                mz_vals = scan_mzs[scan_mzs[:, 1] > 0][:, 1]
-                scan_mzs = scan_mzs[scan_mzs[:, 1] > 0][:, 0]
-                if not np.any(scan_mzs):
+                scan_id = scan.id
+                msn_map.append((scan.ms_level if not args.mrm else scan.mass, scan_id))
+                rt = scan.rt
+                if scan.ms_level == msn_for_quant:
+                    msn_rt_map[scan_id] = int(scan.title) if args.mrm else rt
+                scan_rt_map[scan_id] = rt
+                scan_info_map[scan_id]['parent'] = scan.parent
+                scan_info_map[scan_id]['msn'] = scan.ms_level
+                scan_info_map[scan_id]['precursor'] = scan.mass
+                scan_charge_map[scan_id] = scan.charge
+                if msn_rt_window is not None and float(rt) not in msn_rt_window:
+                    rt_excluded.add(scan_id)
                     continue
-                mass, charge, rt = scan['mass'], scan['charge'], scan['rt']
-                ions_found = []
-                added = set([])
-                for ion_set in ions:
-                    for ion_index, (ion, nearest_mz_index) in enumerate(zip(ion_set, find_nearest_indices(scan_mzs, np.array(ion_set, dtype=np.float)))):
-                        nearest_mz = scan_mzs[nearest_mz_index]
-                        found_ions = []
-                        if peaks.get_ppm(ion, nearest_mz) < ion_tolerance:
-                            if args.mva:
-                                d = raw_scans[ion_index]
-                                scan_rt = d['id_scan']['rt']
-                                if scan_rt-args.rt_window < rt < scan_rt+args.rt_window:
-                                    found_ions.append({
-                                        'ion': ion,
-                                        'nearest_mz': nearest_mz,
-                                        'charge': d['id_scan']['charge'],
-                                        'scan_info': d,
-                                        'ion_set': ion_set,
-                                    })
-                            else:
-                                ion_rt = rt_info[ion_index] if rt_info else None
-                                if ion_rt is None or (rt-args.rt_window < ion_rt < rt+args.rt_window):
-                                    found_ions.append({
-                                        'ion': ion,
-                                        'nearest_mz': nearest_mz,
-                                        'rt': ion_rt,
-                                        'ion_set': ion_set,
-                                    })
-                        elif args.require_all_ions:
-                            # this means an ion in the set was not found, if we require all ions, continue to the next set
-                            continue
-                        # if we require all ions, only put in a single copy since we'll be finding the same ions in every
-                        # scan anyways, otherwise put the entire set in since we may be missing ions
-                        ions_found += found_ions[0] if args.require_all_ions else found_ions
-                if ions_found:
-                    # we have two options here. If we are quantifying a preceeding scan or the ion itself per scan
-                    isotope_ppm = args.isotope_ppm/1e6
-                    if msn_for_quant == msn_for_id or args.mva:
-                        for ion_dict in ions_found:
-                            ion, nearest_mz = ion_dict['ion'], ion_dict['nearest_mz']
-                            ion_found = ','.join(map(str, ion_dict['ion_set']))
-                            spectra_to_quant = scan_id
-                            # we are quantifying the ion itself
-                            if charge == 0 or args.mva:
-                                # see if we can figure out the charge state
-                                charge_states = []
-                                for i in xrange(1, 5):
-                                    charge_peaks_found = 0
-                                    peak_height = 0
-                                    for j in xrange(1, 3):
-                                        next_peak = ion+peaks.NEUTRON/float(i)*float(j)
-                                        closest_mz = peaks.find_nearest_index(scan_mzs, next_peak)
-                                        if peaks.get_ppm(next_peak, scan_mzs[closest_mz]) < isotope_ppm*1.5:
-                                            charge_peaks_found += 1
-                                            peak_height += mz_vals[closest_mz]
-                                    charge_states.append((charge_peaks_found, i, peak_height))
-                                charge_states = sorted(charge_states, key=operator.itemgetter(0, 2), reverse=True)
-                                if args.mva and int(ion_dict['charge']) not in [i[0] for i in charge_states]:
-                                    continue
-                                elif args.mva:
-                                    charge_to_use = ion_dict['charge']
-                                elif charge_states:
-                                    if charge_states[0][1] == 1:
-                                        charge_to_use = charge_states[1][1] if charge_states[1][2] != 0 else 1
+                if scan.parent:
+                    try:
+                        scan_info_map[scan.parent]['children'].add(scan_id)
+                    except KeyError:
+                        scan_info_map[scan.parent]['children'] = set([scan_id])
+                if not scans_to_select or str(scan_id) in scans_to_select:
+                    if ion_search:
+                        if scan.ms_level == msn_for_id:
+                            scans_to_fetch.append(scan_id)
+                    elif all_msn:
+                        # we are quantifying all msn spectra of a given type
+                        if msn_for_id == scan.ms_level:
+                            # find the closest scan to this, which will be the parent scan
+                            spectra_to_quant = find_prior_scan(msn_map, scan_id, ms_level=msn_for_quant) if msn_for_quant != msn_for_id else scan_id
+                            d = {
+                                'quant_scan': {'id': spectra_to_quant},
+                                'id_scan': {'id': scan_id, 'rt': scan.rt, 'charge': scan.charge, 'mass': float(scan.mass), 'product_ion': float(scan.product_ion) if args.mrm else None},
+                            }
+                            ion_search_list.append((spectra_to_quant, d))
+                    elif args.mva:
+                        if scan.ms_level == msn_for_quant:
+                            scans_to_fetch.append(scan_id)
+                if not raw_data_only and calc_spline:
+                    if hasattr(scan, 'theor_mass'):
+                        theor_mass = scan.getTheorMass()
+                        observed_mass = scan.mass
+                        mass_error = (theor_mass-observed_mass)/theor_mass*1e6
+                        spline_x.append(observed_mass)
+                        spline_y.append(mass_error)
+                del scan
+
+            if calc_spline and len(spline_x):
+                calibration = MassCalibration.fit(spline_x, spline_y)
+                if calibration is not None and args.calibration_cache:
+                    if not os.path.exists(args.calibration_cache):
+                        os.makedirs(args.calibration_cache)
+                    calibration.save(calibration_path, source=source)
+            del raw
+        else:
+            # the scan maps and tasks were saved by the run we are resuming
+            file_state = file_state[0]
+            msn_map, msn_rt_map, calibration = file_state['msn_map'], file_state['msn_rt_map'], file_state['calibration']
+            rt_excluded = file_state['rt_excluded']
+            sys.stderr.write('Resuming {}.\n'.format(filepath))
+
+        # the scan maps are written once and memory mapped by the reader and workers, rather than copied into each of them
+        run_map = RunMap(msn_map, msn_rt_map, quant_level=msn_for_quant if not args.mrm else None, excluded=rt_excluded)
+        reader = Reader(reader_in, reader_outs, raw_file=filepath, calibration=calibration, rt_window=msn_rt_window,
+                        run_map=run_map, governor=governor.for_process(0))
+        reader.start()
+        if file_state is None:
+            rep_map = defaultdict(set)
+            if ion_search or args.mva:
+                ions = [i['id_scan'].get('theor_mass', i['id_scan']['mass']) for i in raw_scans] if args.mva else raw_scans['ions']
+                rt_info = raw_scans.get('rt_info') if not args.mva else None
+                last_scan_ions = defaultdict(set)
+                for scan_id in scans_to_fetch:
+                    this_scan_ions = defaultdict(set)
+                    reader_in.put((0, scan_id, None, None, None))
+                    _, scan = reader_outs[0].get()
+                    if scan is None:
+                        continue
+                    if args.msn_all_scans:
+                        # if not args.require_all_ions:
+                        #     ions = set([j for i in ions for j in i])
+                        for ion_index, ion_set in enumerate(ions):
+                            d = {
+                                'quant_scan': {'id': scan_id, 'scans': scans_to_fetch},
+                                'id_scan': {
+                                    'id': scan_id, 'theor_mass': ion_set[0], 'rt': rt_info[ion_index] if rt_info else scan['rt'],
+                                    'charge': 1, 'mass': ion_set[0], 'ions_found': None, 'ion_set': ion_set,
+                                },
+                                'combine_xics': args.require_all_ions,
+                            }
+                            ion_search_list.append((scan_id, d))
+                        break
+                    scan_mzs = scan['vals']
+                    mz_vals = scan_mzs[scan_mzs[:, 1] > 0][:, 1]
+                    scan_mzs = scan_mzs[scan_mzs[:, 1] > 0][:, 0]
+                    if not np.any(scan_mzs):
+                        continue
+                    mass, charge, rt = scan['mass'], scan['charge'], scan['rt']
+                    ions_found = []
+                    added = set([])
+                    for ion_set in ions:
+                        for ion_index, (ion, nearest_mz_index) in enumerate(zip(ion_set, find_nearest_indices(scan_mzs, np.array(ion_set, dtype=np.float)))):
+                            nearest_mz = scan_mzs[nearest_mz_index]
+                            found_ions = []
+                            if peaks.get_ppm(ion, nearest_mz) < ion_tolerance:
+                                if args.mva:
+                                    d = raw_scans[ion_index]
+                                    scan_rt = d['id_scan']['rt']
+                                    if scan_rt-args.rt_window < rt < scan_rt+args.rt_window:
+                                        found_ions.append({
+                                            'ion': ion,
+                                            'nearest_mz': nearest_mz,
+                                            'charge': d['id_scan']['charge'],
+                                            'scan_info': d,
+                                            'ion_set': ion_set,
+                                        })
+                                else:
+                                    ion_rt = rt_info[ion_index] if rt_info else None
+                                    if ion_rt is None or (rt-args.rt_window < ion_rt < rt+args.rt_window):
+                                        found_ions.append({
+                                            'ion': ion,
+                                            'nearest_mz': nearest_mz,
+                                            'rt': ion_rt,
+                                            'ion_set': ion_set,
+                                        })
+                            elif args.require_all_ions:
+                                # this means an ion in the set was not found, if we require all ions, continue to the next set
+                                continue
+                            # if we require all ions, only put in a single copy since we'll be finding the same ions in every
+                            # scan anyways, otherwise put the entire set in since we may be missing ions
+                            ions_found += found_ions[0] if args.require_all_ions else found_ions
+                    if ions_found:
+                        # we have two options here. If we are quantifying a preceeding scan or the ion itself per scan
+                        isotope_ppm = args.isotope_ppm/1e6
+                        if msn_for_quant == msn_for_id or args.mva:
+                            for ion_dict in ions_found:
+                                ion, nearest_mz = ion_dict['ion'], ion_dict['nearest_mz']
+                                ion_found = ','.join(map(str, ion_dict['ion_set']))
+                                spectra_to_quant = scan_id
+                                # we are quantifying the ion itself
+                                if charge == 0 or args.mva:
+                                    # see if we can figure out the charge state
+                                    charge_states = []
+                                    for i in xrange(1, 5):
+                                        charge_peaks_found = 0
+                                        peak_height = 0
+                                        for j in xrange(1, 3):
+                                            next_peak = ion+peaks.NEUTRON/float(i)*float(j)
+                                            closest_mz = peaks.find_nearest_index(scan_mzs, next_peak)
+                                            if peaks.get_ppm(next_peak, scan_mzs[closest_mz]) < isotope_ppm*1.5:
+                                                charge_peaks_found += 1
+                                                peak_height += mz_vals[closest_mz]
+                                        charge_states.append((charge_peaks_found, i, peak_height))
+                                    charge_states = sorted(charge_states, key=operator.itemgetter(0, 2), reverse=True)
+                                    if args.mva and int(ion_dict['charge']) not in [i[0] for i in charge_states]:
+                                        continue
+                                    elif args.mva:
+                                        charge_to_use = ion_dict['charge']
+                                    elif charge_states:
+                                        if charge_states[0][1] == 1:
+                                            charge_to_use = charge_states[1][1] if charge_states[1][2] != 0 else 1
+                                        else:
+                                            charge_to_use = charge_states[0][1]
                                     else:
-                                        charge_to_use = charge_states[0][1]
+                                        charge_to_use = 1
+                                    if args.mva:
+                                        rep_key = (ion_dict['scan_info']['id_scan']['rt'], ion_dict['scan_info']['id_scan']['mass'], charge_to_use)
+                                        rep_map[rep_key].add(rt)
                                 else:
-                                    charge_to_use = 1
+                                    charge_to_use = charge
+                                this_scan_ions[ion].add(charge_to_use)
+                                if charge_to_use in last_scan_ions[ion]:
+                                    continue
+                                last_scan_ions[ion].add(charge_to_use)
                                 if args.mva:
-                                    rep_key = (ion_dict['scan_info']['id_scan']['rt'], ion_dict['scan_info']['id_scan']['mass'], charge_to_use)
-                                    rep_map[rep_key].add(rt)
-                            else:
-                                charge_to_use = charge
-                            this_scan_ions[ion].add(charge_to_use)
-                            if charge_to_use in last_scan_ions[ion]:
-                                continue
-                            last_scan_ions[ion].add(charge_to_use)
-                            if args.mva:
-                                d = copy.deepcopy(ion_dict['scan_info'])
-                                d['id_scan']['id'] = scan_id
-                                theo_mass = d['id_scan'].get('theor_mass')
-                                if theo_mass:
-                                    d['id_scan']['mass'] = theo_mass
-                                spectra_to_quant = find_prior_scan(msn_map, scan_id, ms_level=msn_for_quant)
-                                d['quant_scan']['id'] = spectra_to_quant
-                                d['replicate_scan_rt'] = rt
-                            else:
-                                d = {
-                                    'quant_scan': {'id': scan_id},
-                                    'id_scan': {
-                                        'id': scan_id, 'theor_mass': ion, 'rt': rt if ion_rt is None else ion_rt,
-                                        'charge': charge_to_use, 'mass': float(nearest_mz), 'ions_found': ion_found,
-                                        'ion_set': ion_dict['ion_set']
-                                    },
-                                    'combine_xics': True,
-                                }
-                            key = (scan_id, d['id_scan']['theor_mass'], charge_to_use)
-                            if key in added:
-                                continue
-                            added.add(key)
-                            if args.mva:
-                                replicate_search_list[(d['id_scan']['rt'], ion_dict['ion'])].append((spectra_to_quant, d))
-                            else:
-                                ion_search_list.append((spectra_to_quant, d))
-                    else:
-                        # we are identifying the ion in a particular scan, and quantifying a preceeding scan
-                        # find the closest scan to this, which will be the parent scan
-                        spectra_to_quant = find_prior_scan(msn_map, scan_id, ms_level=msn_for_quant)
-                        d = {
-                            'quant_scan': {'id': spectra_to_quant},
-                            'id_scan': {
-                                'id': scan_id, 'rt': rt, 'charge': charge,
-                                'mass': float(mass), 'ions_found': ';'.join(map(lambda x: '{}({})'.format(ion, nearest_mz), ions_found))
-                            },
-                        }
-                        ion_search_list.append((spectra_to_quant, d))
-                to_remove = []
-                for ion, charges in last_scan_ions.items():
-                    for charge in charges:
-                        if charge not in this_scan_ions[ion]:
-                            to_remove.append((ion, charge))
-                for ion, charge in to_remove:
-                    last_scan_ions[ion].discard(charge)
-                del scan
+                                    d = copy.deepcopy(ion_dict['scan_info'])
+                                    d['id_scan']['id'] = scan_id
+                                    theo_mass = d['id_scan'].get('theor_mass')
+                                    if theo_mass:
+                                        d['id_scan']['mass'] = theo_mass
+                                    spectra_to_quant = find_prior_scan(msn_map, scan_id, ms_level=msn_for_quant)
+                                    d['quant_scan']['id'] = spectra_to_quant
+                                    d['replicate_scan_rt'] = rt
+                                else:
+                                    d = {
+                                        'quant_scan': {'id': scan_id},
+                                        'id_scan': {
+                                            'id': scan_id, 'theor_mass': ion, 'rt': rt if ion_rt is None else ion_rt,
+                                            'charge': charge_to_use, 'mass': float(nearest_mz), 'ions_found': ion_found,
+                                            'ion_set': ion_dict['ion_set']
+                                        },
+                                        'combine_xics': True,
+                                    }
+                                key = (scan_id, d['id_scan']['theor_mass'], charge_to_use)
+                                if key in added:
+                                    continue
+                                added.add(key)
+                                if args.mva:
+                                    replicate_search_list[(d['id_scan']['rt'], ion_dict['ion'])].append((spectra_to_quant, d))
+                                else:
+                                    ion_search_list.append((spectra_to_quant, d))
+                        else:
+                            # we are identifying the ion in a particular scan, and quantifying a preceeding scan
+                            # find the closest scan to this, which will be the parent scan
+                            spectra_to_quant = find_prior_scan(msn_map, scan_id, ms_level=msn_for_quant)
+                            d = {
+                                'quant_scan': {'id': spectra_to_quant},
+                                'id_scan': {
+                                    'id': scan_id, 'rt': rt, 'charge': charge,
+                                    'mass': float(mass), 'ions_found': ';'.join(map(lambda x: '{}({})'.format(ion, nearest_mz), ions_found))
+                                },
+                            }
+                            ion_search_list.append((spectra_to_quant, d))
+                    to_remove = []
+                    for ion, charges in last_scan_ions.items():
+                        for charge in charges:
+                            if charge not in this_scan_ions[ion]:
+                                to_remove.append((ion, charge))
+                    for ion, charge in to_remove:
+                        last_scan_ions[ion].discard(charge)
+                    del scan
 
-        if args.mva:
-            x = []
-            y = []
-            for i,v in six.iteritems(rep_map):
-                for j in v:
-                    x.append(i[0])
-                    y.append(j)
-            from sklearn.linear_model import LinearRegression
-            rep_mapper = LinearRegression()
-            try:
-                rep_mapper.fit(np.array(x).reshape(len(x), 1), y)
-            except ValueError:
-                rep_mapper = None
-
-        if ion_search or all_msn:
-            raw_scans = [i[1] for i in sorted(ion_search_list, key=operator.itemgetter(0))]
-        if args.mva:
-            raw_scans = []
-            for i in replicate_search_list:
-                ion_rt, ion = i
-                best_scan = sorted([(np.abs((rep_mapper.predict(j[1]['replicate_scan_rt']) if rep_mapper else j[1]['replicate_scan_rt'])-ion_rt), j[1]) for j in replicate_search_list[i]], key=operator.itemgetter(0))[0][1]
-                raw_scans.append(best_scan)
-
-        quant_msn_map = [i for i in msn_map if i[0] == msn_for_quant] if not args.mrm else msn_map
-        manager = Manager()
-        scan_mask = manager.dict()
+            if args.mva:
+                x = []
+                y = []
+                for i,v in six.iteritems(rep_map):
+                    for j in v:
+                        x.append(i[0])
+                        y.append(j)
+                from sklearn.linear_model import LinearRegression
+                rep_mapper = LinearRegression()
+                try:
+                    rep_mapper.fit(np.array(x).reshape(len(x), 1), y)
+                except ValueError:
+                    rep_mapper = None
 
-        for i in xrange(threads):
-            worker = Worker(queue=in_queue, results=result_queue, raw_name=filepath, mass_labels=mass_labels,
-                            debug=args.debug, html=html, mono=not args.spread, precursor_ppm=args.precursor_ppm,
-                            isotope_ppm=args.isotope_ppm, isotope_ppms=None, msn_rt_map=msn_rt_map, reporter_mode=reporter_mode,
-                            reader_in=reader_in, reader_out=reader_outs[i], thread=i, quant_method=quant_method,
-                            spline=spline, isotopologue_limit=isotopologue_limit, labels_needed=labels_needed,
-                            quant_msn_map=quant_msn_map,
-                            overlapping_mz=overlapping_mz, min_resolution=args.min_resolution, min_scans=args.min_scans,
-                            mrm_pair_info=mrm_pair_info, mrm=args.mrm, peak_cutoff=args.peak_cutoff, replicate=args.mva,
-                            ref_label=ref_label, max_peaks=args.max_peaks, parser_args=args, scans_to_skip=scan_mask)
-            workers.append(worker)
-            worker.start()
+            if ion_search or all_msn:
+                raw_scans = [i[1] for i in sorted(ion_search_list, key=operator.itemgetter(0))]
+            if args.mva:
+                raw_scans = []
+                for i in replicate_search_list:
+                    ion_rt, ion = i
+                    best_scan = sorted([(np.abs((rep_mapper.predict(j[1]['replicate_scan_rt']) if rep_mapper else j[1]['replicate_scan_rt'])-ion_rt), j[1]) for j in replicate_search_list[i]], key=operator.itemgetter(0))[0][1]
+                    raw_scans.append(best_scan)
+
+            # TODO:
+            # combine information from scans (where for instance, we have fragmented both the heavy/light
+            # peptides -- we want to use those masses before calculating where it should be). This may not
+            # be possible for all types of input though, figure this out.
+            scans_to_submit = []
+
+            mrm_added = set([])
+            exclusion_masses = mrm_pair_info.loc[:,[i for i in mrm_pair_info.columns if i.lower() not in ('light', 'retention time')]].values.flatten() if args.mrm else set([])
+            for scan_index, raw_scan_info in enumerate(raw_scans):
+                target_scan = raw_scan_info['id_scan']
+                quant_scan = raw_scan_info['quant_scan']
+                scanId = target_scan['id']
+                scan_mass = target_scan.get('mass')
+                if args.mrm:
+                    if scan_mass in mrm_added:
+                        continue
+                    mrm_added.add(scan_mass)
+                    if scan_mass in exclusion_masses:
+                        continue
 
-        # TODO:
-        # combine information from scans (where for instance, we have fragmented both the heavy/light
-        # peptides -- we want to use those masses before calculating where it should be). This may not
-        # be possible for all types of input though, figure this out.
-        quant_map = {}
-        scans_to_submit = []
-
-        # this is to fix the header at the end to include peak information if we have multiple peaks
-        most_peaks_found = 0
-        mrm_added = set([])
-        exclusion_masses = mrm_pair_info.loc[:,[i for i in mrm_pair_info.columns if i.lower() not in ('light', 'retention time')]].values.flatten() if args.mrm else set([])
-        for scan_index, raw_scan_info in enumerate(raw_scans):
-            target_scan = raw_scan_info['id_scan']
-            quant_scan = raw_scan_info['quant_scan']
-            scanId = target_scan['id']
-            scan_mass = target_scan.get('mass')
-            if args.mrm:
-                if scan_mass in mrm_added:
-                    continue
-                mrm_added.add(scan_mass)
-                if scan_mass in exclusion_masses:
+                if quant_scan.get('id') is None:
+                    scan_to_quant = None
+                    if msn_for_quant > msn_for_id:
+                        # Cases like MS3 hit this, go down until we hit the correct MS level and add
+                        # those scans to be quantified
+                        children = scan_info_map[scanId].get('children', [scanId])
+                        quant_scan['scans'] = []
+                        while children:
+                            child = children.pop()
+                            child_scan_info = scan_info_map[child]
+                            scan_to_quant_ms = child_scan_info['msn']
+                            if scan_to_quant_ms < msn_for_quant:
+                                children += child_scan_info.get('children', [])
+                            if scan_to_quant_ms == msn_for_quant:
+                                if scan_to_quant is None:
+                                    scan_to_quant = child
+                                quant_scan['scans'].append(child)
+                    else:
+                        # we will hit this in a normal proteomic run
+                        # figure out the ms-1 from the ms level we are at
+                        scan_info = scan_info_map[scanId]
+                        current_scan = scan_info['parent']
+                        try:
+                            while current_scan:
+                                scan_info = scan_info_map[scanId]
+                                current_scan = scan_info['parent']
+                                scan_to_quant_ms = scan_info[scan_to_quant]['msn']
+                                if scan_to_quant_ms == msn_for_quant:
+                                    scan_to_quant = current_scan
+                        except KeyError:
+                            scan_to_quant = None
+                    if scan_to_quant is not None:
+                        msn_to_quant = scan_to_quant
+                    else:
+                        msn_to_quant = find_prior_scan(msn_map, scanId, ms_level=msn_for_quant)
+                    quant_scan['id'] = msn_to_quant
+
+                rt = target_scan.get('rt', scan_rt_map.get(scanId))
+                if rt is None:
+                    rt = float(msn_rt_map[msn_to_quant])
+                    target_scan['rt'] = rt
+
+                if args.mva and rep_mapper is not None:
+                    target_scan['rt'] = rep_mapper.predict(float(target_scan['rt']))[0]
+
+                mods = target_scan.get('modifications')
+                charge = target_scan.get('charge')
+                if charge is None or charge == 0:
+                    charge = int(scan_charge_map.get(scanId, 0))
+                if charge == 0:
                     continue
+                charge = int(charge)
 
-            if quant_scan.get('id') is None:
-                scan_to_quant = None
-                if msn_for_quant > msn_for_id:
-                    # Cases like MS3 hit this, go down until we hit the correct MS level and add
-                    # those scans to be quantified
-                    children = scan_info_map[scanId].get('children', [scanId])
-                    quant_scan['scans'] = []
-                    while children:
-                        child = children.pop()
-                        child_scan_info = scan_info_map[child]
-                        scan_to_quant_ms = child_scan_info['msn']
-                        if scan_to_quant_ms < msn_for_quant:
-                            children += child_scan_info.get('children', [])
-                        if scan_to_quant_ms == msn_for_quant:
-                            if scan_to_quant is None:
-                                scan_to_quant = child
-                            quant_scan['scans'].append(child)
+                if msn_for_quant != 1:
+                    lowest_label = min([j for i,v in mass_labels.items() for j in v])
+                    target_scan['theor_mass'] = lowest_label
+                    target_scan['precursor'] = lowest_label
                 else:
-                    # we will hit this in a normal proteomic run
-                    # figure out the ms-1 from the ms level we are at
-                    scan_info = scan_info_map[scanId]
-                    current_scan = scan_info['parent']
-                    try:
-                        while current_scan:
-                            scan_info = scan_info_map[scanId]
-                            current_scan = scan_info['parent']
-                            scan_to_quant_ms = scan_info[scan_to_quant]['msn']
-                            if scan_to_quant_ms == msn_for_quant:
-                                scan_to_quant = current_scan
-                    except KeyError:
-                        scan_to_quant = None
-                if scan_to_quant is not None:
-                    msn_to_quant = scan_to_quant
-                else:
-                    msn_to_quant = find_prior_scan(msn_map, scanId, ms_level=msn_for_quant)
-                quant_scan['id'] = msn_to_quant
-
-            rt = target_scan.get('rt', scan_rt_map.get(scanId))
-            if rt is None:
-                rt = float(msn_rt_map[msn_to_quant])
-                target_scan['rt'] = rt
-
-            if args.mva and rep_mapper is not None:
-                target_scan['rt'] = rep_mapper.predict(float(target_scan['rt']))[0]
-
-            mods = target_scan.get('modifications')
-            charge = target_scan.get('charge')
-            if charge is None or charge == 0:
-                charge = int(scan_charge_map.get(scanId, 0))
-            if charge == 0:
+                    mass_shift = 0
+
+                    if mods is not None:
+                        shift = 0
+                        for mod in filter(lambda x: x, mods.split('|')):
+                            aa, pos, mass, _ = mod.split(',', 3)
+                            mass = get_formatted_mass(mass)
+                            if aa in silac_shifts.get(mass, {}):
+                                shift += mass
+                        mass_shift += (float(shift)/float(charge))
+                    else:
+                        # assume we are the light version, include all the labels we are looking for here
+                        pass
+
+                    target_scan['theor_mass'] = target_scan.get('theor_mass', target_scan.get('mass'))-mass_shift
+                    target_scan['precursor'] = target_scan['mass']-mass_shift if not args.neucode else target_scan['theor_mass']
+                # key is filename, peptide, charge, target scan id, modifications
+                key = (filename, target_scan.get('peptide', ''), target_scan.get('charge'), target_scan.get('id'), target_scan.get('modifications'),)
+                key = tuple(map(str, key))
+                params = {'scan_info': raw_scan_info, 'key': key}
+                scans_to_submit.append((target_scan['rt'], params))
+
+            # sort by RT so we can minimize our memory footprint by throwing away scans we no longer need
+            scans_to_submit.sort(key=operator.itemgetter(0))
+            if args.psm_merge_window and not args.mrm:
+                scans_to_submit = merge_redundant_psms(scans_to_submit, args.psm_merge_window)
+            if not args.plan:
+                checkpoint.save_file_state(filename, {
+                    'msn_map': msn_map,
+                    'msn_rt_map': msn_rt_map,
+                    'calibration': calibration,
+                    'rt_excluded': rt_excluded,
+                    'tasks': scans_to_submit,
+                })
+            del scan_rt_map
+        else:
+            scans_to_submit = file_state['tasks']
+        if ion_search or all_msn or args.mva:
+            scan_count = sum(task_size(i[1]) for i in scans_to_submit)
+        if resume:
+            remaining = [i for i in scans_to_submit if i[1]['key'] not in checkpoint]
+            completed += sum(task_size(i[1]) for i in scans_to_submit)-sum(task_size(i[1]) for i in remaining)
+            scans_to_submit = remaining
+
+        if args.plan or args.auto:
+            # a sample of the scans to quantify tells us how large scans are in this file
+            sample_step = max(1, len(scans_to_submit)//PLAN_SAMPLE_SIZE)
+            sample = scans_to_submit[::sample_step][:PLAN_SAMPLE_SIZE]
+            scan_sizes = []
+            for rt, params in sample:
+                reader_in.put((0, params['scan_info']['quant_scan'].get('id'), None, None, None))
+                _, scan = reader_outs[0].get()
+                if scan is not None:
+                    scan_sizes.append(scan['vals'].nbytes)
+            file_plan = plan_file(
+                filename,
+                scans_to_submit,
+                run_map,
+                scan_bytes=int(np.mean(scan_sizes)) if scan_sizes else 0,
+                task_bytes=int(np.mean([len(pickle.dumps(i[1], 2)) for i in sample])) if sample else 0,
+                xic_window_size=args.xic_window_size,
+                tasks_per_worker=args.tasks_per_worker,
+                scan_cache_size=worker_scan_cache,
+                memory=available_memory(),
+            )
+            if args.plan:
+                sys.stdout.write(format_plan(file_plan))
+                reader_in.put(None)
+                run_map.remove()
                 continue
-            charge = int(charge)
-
-            if msn_for_quant != 1:
-                lowest_label = min([j for i,v in mass_labels.items() for j in v])
-                target_scan['theor_mass'] = lowest_label
-                target_scan['precursor'] = lowest_label
-            else:
-                mass_shift = 0
-
-                if mods is not None:
-                    shift = 0
-                    for mod in filter(lambda x: x, mods.split('|')):
-                        aa, pos, mass, _ = mod.split(',', 3)
-                        mass = get_formatted_mass(mass)
-                        if aa in silac_shifts.get(mass, {}):
-                            shift += mass
-                    mass_shift += (float(shift)/float(charge))
-                else:
-                    # assume we are the light version, include all the labels we are looking for here
-                    pass
-
-                target_scan['theor_mass'] = target_scan.get('theor_mass', target_scan.get('mass'))-mass_shift
-                target_scan['precursor'] = target_scan['mass']-mass_shift if not args.neucode else target_scan['theor_mass']
-            # key is filename, peptide, charge, target scan id, modifications
-            key = (filename, target_scan.get('peptide', ''), target_scan.get('charge'), target_scan.get('id'), target_scan.get('modifications'),)
-            if resume:
-                if tuple(map(str, key)) in skip_map:
-                    completed += 1
-                    continue
-            params = {'scan_info': raw_scan_info}
-            scans_to_submit.append((target_scan['rt'], params))
+            threads = file_plan['workers']
+            sys.stderr.write('Using {} workers for {}.\n'.format(threads, filename))
+
+        worker_kwargs = dict(
+            results=result_queue, raw_name=filepath, mass_labels=mass_labels, debug=args.debug, html=html,
+            mono=not args.spread, precursor_ppm=args.precursor_ppm, isotope_ppm=args.isotope_ppm, isotope_ppms=None,
+            run_map=run_map, reporter_mode=reporter_mode, reader_in=reader_in, quant_method=quant_method,
+            calibration=calibration, isotopologue_limit=isotopologue_limit, labels_needed=labels_needed,
+            overlapping_mz=overlapping_mz, min_resolution=args.min_resolution, min_scans=args.min_scans,
+            mrm_pair_info=mrm_pair_info, mrm=args.mrm, peak_cutoff=args.peak_cutoff, replicate=args.mva,
+            ref_label=ref_label, max_peaks=args.max_peaks, parser_args=worker_args, scan_cache_size=worker_scan_cache,
+            envelope_cache_size=args.envelope_cache,
+        )
+        # low resolution scans found by any worker are skipped by the others
+        scan_mask = ScanMask(run_map)
+        sweep = None
+        if args.sweep:
+            # the scans of every target are read in a single pass over the file, and each target is given to the
+            # scheduler as soon as its XIC is extracted. Ordering tasks by cost would wait on the whole sweep, so they
+            # keep this order.
+            sweep = ScanSweep(
+                filepath,
+                make_sweep_targets(
+                    [i[1] for i in scans_to_submit], run_map, mass_labels, reporter_mode=reporter_mode,
+                    calibration=calibration, xic_window_size=args.xic_window_size,
+                ),
+                run_map,
+                calibration=calibration,
+                rt_window=msn_rt_window,
+                governor=governor.for_process(0),
+            )
+            sweep.start()
+            sweep_params = [i[1] for i in scans_to_submit]
+            task_params = None
+        else:
+            task_params = (i[1] for i in scans_to_submit)
+        # tasks are handed to each worker as it finishes its previous ones, so they are never all queued at once. Their
+        # params are all in scans_to_submit, as they are sorted, merged and saved for resuming before any is handed out.
+        scheduler = TaskScheduler(
+            task_params,
+            max_in_flight=args.tasks_per_worker,
+            cost=task_cost if not (args.disable_cost_scheduling or args.sweep) else None,
+            seconds_per_cost=scheduler_history.get('seconds_per_cost'),
+            chunk_seconds=args.chunk_seconds,
+            rt_bands=args.rt_bands,
+            window=args.reorder_window if args.ordered_output else None,
+        )
+        # with ordered output, results are written in the order of scans_to_submit as soon as the ones before them are
+        reorder_buffer = ReorderBuffer(result_writer) if args.ordered_output else None
 
-        # sort by RT so we can minimize our memory footprint by throwing away scans we no longer need
-        scans_to_submit.sort(key=operator.itemgetter(0))
-        if ion_search or all_msn or args.mva:
-            scan_count = len(scans_to_submit)
-        for i in scans_to_submit:
-            in_queue.put(i[1])
+        for i in xrange(threads):
+            worker = Worker(queue=scheduler.add_worker(i), reader_out=reader_outs[i], thread=i, scans_to_skip=scan_mask,
+                            governor=governor.for_process(i+1), **worker_kwargs)
+            workers.append(worker)
+            worker.start()
+        scheduler.start()
+        autoscaler = Autoscaler(
+            min_workers=args.min_workers, max_workers=args.max_workers, interval=args.autoscale_interval,
+        ) if args.max_workers else None
 
         sys.stderr.write('{0} processed and placed into queue.\n'.format(filename))
 
-        # kill the workers
-        [in_queue.put(None) for i in xrange(threads)]
         RESULT_DICT = {i[0]: 'NA' for i in RESULT_ORDER}
-        scans_to_export = set([])
         export_mapping = defaultdict(set)
-        key_map = msn_rt_map.keys()
-        rt_scan_map = pd.Series(key_map, index=[msn_rt_map[i] for i in key_map])
-        rt_scan_map.sort_index(inplace=True)
+        rt_scan_map = (run_map.rts, run_map.rt_ids)
 
+        result = None
+        # the threads whose worker we stopped for running past the task timeout, and when we stopped it
+        timed_out = {}
         while workers or result is not None:
-            try:
-                result = result_queue.get(timeout=0.1)
-            except Empty:
-                # kill expired workers
-                result = None
+            # once every worker has exited, anything left is already in the result pipe
+            if not workers:
+                event_timeout = 0
+            elif args.task_timeout or autoscaler is not None:
+                event_timeout = min(args.task_timeout or 1, 1)
+            else:
+                event_timeout = None
+            # swept XICs are only taken while the scheduler has fewer than a sweep queue's worth left to hand out, so
+            # they wait in the sweep, which stops reading once its queue is full, rather than in this process
+            sweep_room = sweep.queue_size-scheduler.queued if sweep is not None else 0
+            result, exited = wait_for_events(result_queue, workers, timeout=event_timeout,
+                                             sweep=sweep if sweep_room > 0 else None)
+            if sweep is not None and not sweep.done and sweep_room > 0:
+                scheduler.extend(sweep.ready_tasks(sweep_params, limit=sweep_room))
+                if sweep.done:
+                    scheduler.close()
+            if args.task_timeout:
+                for thread_index in scheduler.timed_out(args.task_timeout):
+                    for worker in workers:
+                        if worker.thread == thread_index and thread_index not in timed_out:
+                            # workers exit on SIGTERM once they are done with any queue they are using, see
+                            # Worker.stop
+                            worker.terminate()
+                            timed_out[thread_index] = time.time()
+                for worker in workers:
+                    stopped_at = timed_out.get(worker.thread)
+                    if stopped_at is not None and time.time()-stopped_at > args.task_timeout and hasattr(signal, 'SIGKILL'):
+                        # a worker that has not stopped by now is stuck in native code, where it never gets to handle
+                        # the SIGTERM, or waiting on a reader that stopped replying, so it is killed (only once)
+                        os.kill(worker.pid, signal.SIGKILL)
+                        timed_out[worker.thread] = float('inf')
+            if exited:
                 to_del = []
                 for i, v in enumerate(workers):
-                    if not v.is_alive():
-                        v.terminate()
-                        exit_code = v.exitcode
-                        if exit_code in CRASH_SIGNALS:
-                            print('thread has been killed using params {}'.format(v.params))
-                        to_del.append({'worker_index': i, 'thread_id': v.thread, 'exitcode': exit_code})
+                    if v in exited:
+                        v.join()
+                        to_del.append({'worker_index': i, 'thread_id': v.thread, 'exitcode': v.exitcode})
                 workers_to_add = []
                 for worker_dict in sorted(to_del, key=operator.itemgetter('worker_index'), reverse=True):
                     worker_index = worker_dict['worker_index']
-                    if worker_dict['exitcode'] in CRASH_SIGNALS:
+                    if worker_dict['exitcode'] != 0:
                         thread_index = worker_dict['thread_id']
-                        worker = Worker(queue=in_queue, results=result_queue, raw_name=filepath, mass_labels=mass_labels,
-                                debug=args.debug, html=html, mono=not args.spread, precursor_ppm=args.precursor_ppm,
-                                isotope_ppm=args.isotope_ppm, isotope_ppms=None, msn_rt_map=msn_rt_map, reporter_mode=reporter_mode,
-                                reader_in=reader_in, reader_out=reader_outs[thread_index], thread=thread_index, quant_method=quant_method,
-                                spline=spline, isotopologue_limit=isotopologue_limit, labels_needed=labels_needed,
-                                quant_msn_map=[i for i in msn_map if i[0] == msn_for_quant] if not args.mrm else msn_map,
-                                overlapping_mz=overlapping_mz, min_resolution=args.min_resolution, min_scans=args.min_scans,
-                                mrm_pair_info=mrm_pair_info, mrm=args.mrm, peak_cutoff=args.peak_cutoff, replicate=args.mva,
-                                ref_label=ref_label, max_peaks=args.max_peaks, parser_args=args)
+                        reason = 'timeout' if thread_index in timed_out else 'crash'
+                        timed_out.pop(thread_index, None)
+                        # the task it was on is retried with a faster fit, or quarantined if that already happened. A
+                        # worker that went over its memory limit exited between tasks, so none of them are at fault.
+                        recycled = worker_dict['exitcode'] == RECYCLE_EXIT_CODE and reason != 'timeout'
+                        task = None if recycled else scheduler.fail_worker(thread_index, reason)
+                        if task is not None:
+                            sys.stderr.write('Quarantining {} after a worker {}.\n'.format(task['key'], reason))
+                            new_file = not os.path.exists(quarantine_path)
+                            with open(quarantine_path, 'a') as quarantine_file:
+                                if new_file:
+                                    quarantine_file.write('{}\n'.format('\t'.join(QUARANTINE_HEADERS)))
+                                for key in [task['key']]+[i['key'] for i in task.get('psms', [])]:
+                                    quarantine_file.write('{}\n'.format('\t'.join(list(key)+[reason])))
+                            completed += task_size(task)
+                            if reorder_buffer is not None:
+                                reorder_buffer.skip(task['order'])
+                        worker = Worker(queue=scheduler.add_worker(thread_index), reader_out=reader_outs[thread_index],
+                                        thread=thread_index, scans_to_skip=scan_mask,
+                                        governor=governor.for_process(thread_index+1), **worker_kwargs)
                         workers_to_add.append(worker)
                         worker.start()
+                        scheduler.fill(thread_index)
                     del workers[worker_index]
                 workers += workers_to_add
+            if autoscaler is not None:
+                # workers that were retired finish what they have, so only the ones still being fed count
+                active = [i.thread for i in workers if i.thread not in scheduler.stopped]
+                change = autoscaler.decide(len(active), scheduler.pending)
+                # retired workers that have not exited yet still hold their thread
+                free_threads = set(xrange(args.max_workers))-set(i.thread for i in workers)
+                if change > 0 and free_threads:
+                    thread_index = min(free_threads)
+                    worker = Worker(queue=scheduler.add_worker(thread_index), reader_out=reader_outs[thread_index],
+                                    thread=thread_index, scans_to_skip=scan_mask,
+                                    governor=governor.for_process(thread_index+1), **worker_kwargs)
+                    workers.append(worker)
+                    worker.start()
+                    scheduler.fill(thread_index)
+                elif change < 0:
+                    scheduler.retire(max(active))
             if result is not None:
-                completed += 1
+                if not scheduler.complete(result.get('task_id'), elapsed=result.get('elapsed')):
+                    # we already have the result of this task
+                    continue
+                if autoscaler is not None:
+                    autoscaler.observe(result)
+                completed += 1+len(result.get('psms', []))
                 if completed % 10 == 0:
                     sys.stderr.write('\r{0:2.2f}% Completed'.format(completed/scan_count*100))
                     sys.stderr.flush()
+                if result.get('failed'):
+                    if reorder_buffer is not None:
+                        reorder_buffer.skip(result['order'])
+                    continue
                 res_dict = copy.deepcopy(RESULT_DICT)
                 for i in RESULT_ORDER:
                     res_dict[i[0]] = result.get(i[0], 'NA')
@@ -958,7 +1243,6 @@ def run_pyquant():
                         from . import PER_FILE, PER_ID, PER_PEAK
                         scans = get_scans_under_peaks(rt_scan_map, peaks_found)
                         flattened_scans = set([l for i,v in scans.items() for j,k in v.items() for l in k])
-                        scans_to_export |= flattened_scans
                         if args.export_mode == PER_FILE:
                             export_mapping['{}_{}.mzML'.format(out_path, filename)] |= flattened_scans
                     if len(peaks_found) > most_peaks_found:
@@ -993,7 +1277,7 @@ def run_pyquant():
                                             except KeyError:
                                                 xic_peak_summary[i] = [xic_peak_info[j]]
                             else:
-                                peak_report.append(list(map(str, (xic_peak_info.get(i[0], 'NA') for i in PEAK_REPORTING))))
+                                peak_report.append([xic_peak_info.get(i[0], 'NA') for i in PEAK_REPORTING])
 
 
                     if args.peaks_n == 1:
@@ -1007,28 +1291,60 @@ def run_pyquant():
                 # first entry of peak report is label, sort alphabetically
                 peak_report.sort(key=operator.itemgetter(0))
                 res_dict['peak_report'] = peak_report
-                # This is the tsv output we provide
-                res_list = [filename]+[res_dict.get(i[0], 'NA') for i in RESULT_ORDER]+['\t'.join(i) for i in peak_report]
-                res = '{0}\n'.format('\t'.join(map(str, res_list)))
-                out.write(res)
-                out.flush()
-
-                temp_file.write(pd.io.json.dumps({'res_dict': res_dict, 'html': result.get('html', {})}))
-                temp_file.write('\n')
-                temp_file.flush()
-
-        if scans_to_export:
-            raw_file = GuessIterator(filepath, full=True, store=False)
-            for export_filename, scans in six.iteritems(export_mapping):
-                with open(export_filename, 'w') as o:
-                    raw_file.parser.writeScans(handle=o, scans=sorted(scans))
+                psm_results = [(result.get('key'), res_dict)]
+                for psm in result.get('psms', []):
+                    # merged PSMs share the quantification, but keep their own scans and retention time
+                    psm_dict = copy.deepcopy(res_dict)
+                    psm_dict.update({i: psm.get(i, 'NA') for i in PSM_FIELDS if i in psm_dict})
+                    psm_results.append((psm['key'], psm_dict))
+                records = []
+                for key, psm_dict in psm_results:
+                    # This is the tsv output we provide
+                    res_list = [filename]+[psm_dict.get(i[0], 'NA') for i in RESULT_ORDER]+['\t'.join(map(str, i)) for i in peak_report]
+                    res = '{0}\n'.format('\t'.join(map(str, res_list)))
+                    records.append({'row': res, 'key': key, 'res_dict': psm_dict, 'html': result.get('html', {})})
+                if reorder_buffer is not None:
+                    reorder_buffer.put(result['order'], records)
+                else:
+                    # the rows of merged PSMs are written and checkpointed together, as resuming only checks the
+                    # first of them
+                    result_writer.put_all(records)
+
+        export_mapping = {i: v for i, v in six.iteritems(export_mapping) if v}
+        if export_mapping:
+            # the reader writes the exports from its already opened raw file while we move on to the next file
+            reader_in.put({'export': export_mapping, 'threads': threads})
+            pending_exports.append((filepath, reader_outs['main']))
 
         reader_in.put(None)
+        if sweep is not None:
+            sweep.join()
+        if scheduler.seconds_per_cost is not None:
+            scheduler_history['seconds_per_cost'] = scheduler.seconds_per_cost
 
+        # everything from this file is written at this point, so a resumed run can skip it
+        result_writer.flush()
+        checkpoint.mark_complete(filename)
+
+        run_map.remove()
         del msn_map
-        del scan_rt_map
-        del raw
 
+    if args.plan:
+        # nothing was quantified, so there is nothing to report
+        if checkpoint is not None:
+            checkpoint.close()
+        return 0
+
+    for filepath, reader_out in pending_exports:
+        export_result = reader_out.get()
+        if 'error' in export_result:
+            sys.stderr.write('Unable to export scans from {}: {}\n'.format(filepath, export_result['error']))
+
+    if args.scheduler_history:
+        with open(args.scheduler_history, 'w') as history_file:
+            json.dump(scheduler_history, history_file)
+
+    result_writer.close()
     out.flush()
     out.close()
     # fix the header if we need to. We reopen the file because Windows doesn't like it when we read on a file with 'w+'
@@ -1046,54 +1362,28 @@ def run_pyquant():
         shutil.move(tmp_file, out_path)
 
 
-    temp_file.close()
+    # only the table is loaded here, the figures and peak reports are streamed from the store when they are needed
     df_data = []
-    html_data = []
-    peak_data = []
-
-    for j in open(temp_file.name, 'r'):
-        result = pd.io.json.loads(j if isinstance(j, six.text_type) else j.decode('utf-8'))
-        res_dict = result['res_dict']
-        res_list = [res_dict['filename']]+[res_dict.get(i[0], 'NA') for i in RESULT_ORDER]
-        peak_data.append(res_dict['peak_report'])
-        df_data.append(res_list)
-        html_data.append(result['html'])
+    for entry in result_store:
+        res_dict = entry['res_dict']
+        df_data.append([res_dict['filename']]+[res_dict.get(i[0], 'NA') for i in RESULT_ORDER])
     data = pd.DataFrame.from_records(df_data, columns=[i for i in headers if i != 'Confidence'])
-    header_mapping = []
-    order_names = [i[1] for i in RESULT_ORDER]
-    for i in data.columns:
-        try:
-            header_mapping.append(RESULT_ORDER[order_names.index(i)][0])
-        except ValueError:
-            header_mapping.append(False)
+    del df_data
     if calc_stats:
         perform_ml(data, mass_labels)
         data.to_csv('{}_stats'.format(out_path), sep=str('\t'), index=None)
 
     if html:
-        html_map = []
-        peak_map = {'header': [i[1] for i in PEAK_REPORTING], 'data': []}
-        for index, (row_index, row) in enumerate(data.iterrows()):
-            res = '\t'.join(row.astype(str))
-            to_write, html_info = table_rows([{'table': res.strip(), 'html': html_data[index], 'keys': header_mapping}])
-            html_map.append(html_info)
-            peak_map['data'].append(peak_data[index])
-            html_out.write(to_write)
-            html_out.flush()
-
-        template = []
-        append = False
-        for i in open(pyquant_html_file, 'r'):
-            if 'HTML BREAK' in i:
-                append = True
-            elif append:
-                template.append(i)
-        html_template = Template(''.join(template))
-        peak_map = pd.io.json.dumps(peak_map)
-        html_map = pd.io.json.dumps(html_map)
-        html_out.write(html_template.safe_substitute({
-            'peak_output': base64.b64encode(gzip.zlib.compress(peak_map if six.PY2 else six.binary_type(peak_map, 'utf-8'), 9)).decode('utf-8'),
-            'html_output': base64.b64encode(gzip.zlib.compress(html_map if six.PY2 else six.binary_type(html_map, 'utf-8'), 9)).decode('utf-8'),
-        }))
-
-    os.remove(temp_file.name)
+        report = HtmlReport(
+            '{0}.html'.format(out_path),
+            title=source_file,
+            headers=['Raw File']+[i[1] for i in RESULT_ORDER],
+            peak_header=[i[1] for i in PEAK_REPORTING],
+            chunk_size=args.html_chunk_size,
+        )
+        for (row_index, row), entry in zip(data.iterrows(), result_store):
+            report.write_row(row.astype(str), html=entry['html'], peaks=entry['res_dict']['peak_report'])
+        report.close()
+
+    result_store.remove()
+    checkpoint.remove()
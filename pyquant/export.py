@@ -0,0 +1,174 @@
+import hashlib
+import re
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+import six
+from lxml import etree
+from pythomics.proteomics.parsers import indent_xml
+
+MZML_NAMESPACE = '{http://psi.hupo.org/ms/mzml}'
+
+# placeholders in the serialized document that are filled in for each export
+SPECTRA = b'PYQUANT_SPECTRA'
+COUNT = b'PYQUANT_COUNT'
+OFFSETS = b'PYQUANT_OFFSETS'
+INDEX_OFFSET = b'PYQUANT_INDEX_OFFSET'
+CHECKSUM = b'PYQUANT_CHECKSUM'
+# the index attribute of a spectrum, which is its position in each export
+INDEX = b'PYQUANT_INDEX'
+PLACEHOLDERS = re.compile(b'(PYQUANT_[A-Z_]+)')
+
+# the number of spectra an export reads from the spool at a time
+CHUNK_SIZE = 100
+
+
+class MzmlExporter(object):
+    """
+    Writes subsets of the spectra of an mzML file to new mzML files.
+
+    The document surrounding the spectra is parsed once, and every spectrum is read from the raw file once no matter
+    how many exports include it. Spectra are serialized to a temporary spool file as they are read, so only where each
+    one is in the spool is kept in memory. The exports are then written by a pool of threads, each copying its spectra
+    from the spool chunk_size at a time.
+
+    :param raw: The parser of an opened mzML file, such as GuessIterator(...).parser.
+    """
+    def __init__(self, raw, namespace=MZML_NAMESPACE, chunk_size=CHUNK_SIZE):
+        self.raw = raw
+        self.namespace = namespace
+        self.chunk_size = max(1, chunk_size)
+        # scan ids to the order key, id, spool offset and length of their spectra
+        self.spectra = {}
+        self.spool = tempfile.TemporaryFile()
+        self.spool_lock = threading.Lock()
+        self.template = self.build_template()
+
+    def build_template(self):
+        ns = self.namespace
+        handle = self.raw.handle
+        initial_pos = handle.tell()
+        handle.seek(0)
+        root = None
+        for event, element in etree.iterparse(handle, events=('start', 'end')):
+            if root is None:
+                root = element
+            elif event == 'end' and element.tag == '{}spectrum'.format(ns):
+                # the spectra are added back for each export, so we do not keep them around
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        handle.seek(initial_pos)
+
+        spectrum_list = next(root.iter('{}spectrumList'.format(ns)))
+        attribs = dict(spectrum_list.attrib)
+        spectrum_list.clear()
+        for key, value in six.iteritems(attribs):
+            spectrum_list.set(key, value)
+        spectrum_list.set('count', COUNT.decode('utf-8'))
+        spectrum_list.text = SPECTRA.decode('utf-8')
+
+        if root.tag == '{}indexedmzML'.format(ns):
+            index_list = root.find('{}indexList'.format(ns))
+            if index_list is None:
+                index_list = etree.SubElement(root, '{}indexList'.format(ns))
+            index_list.clear()
+            index_list.set('count', '1')
+            etree.SubElement(index_list, '{}index'.format(ns), {'name': 'spectrum'}).text = OFFSETS.decode('utf-8')
+            index_offset = root.find('{}indexListOffset'.format(ns))
+            if index_offset is not None:
+                index_offset.text = INDEX_OFFSET.decode('utf-8')
+            checksum = root.find('{}fileChecksum'.format(ns))
+            if checksum is not None:
+                checksum.text = CHECKSUM.decode('utf-8')
+        indent_xml(root)
+        contents = etree.tostring(root, pretty_print=True, xml_declaration=True, encoding='utf-8')
+        return PLACEHOLDERS.split(contents)
+
+    def file_order(self, scan_id):
+        """
+        A key that sorts scan ids in the order of their spectra in the raw file, or numerically if that is not known.
+        """
+        offsets = getattr(self.raw, 'ra', {})
+        return int(offsets[scan_id]) if scan_id in offsets else -1, int(scan_id) if scan_id.isdigit() else -1, scan_id
+
+    def load_spectra(self, scan_ids):
+        scan_ids = [i for i in set(map(str, scan_ids)) if i not in self.spectra]
+        # read in file order so we move through the raw file a single time
+        scan_ids.sort(key=self.file_order)
+        self.spool.seek(0, 2)
+        for scan_id in scan_ids:
+            spectrum = self.raw.getScan(scan_id, xml=True)
+            if spectrum is None:
+                continue
+            spectrum.set('index', INDEX.decode('utf-8'))
+            serialized = etree.tostring(spectrum, with_tail=False)+b'\n'
+            self.spectra[scan_id] = (self.file_order(scan_id), spectrum.get('id'), self.spool.tell(), len(serialized))
+            self.spool.write(serialized)
+        self.spool.flush()
+
+    def read_spectra(self, spectra):
+        """
+        Yields the id and serialized spectrum of each of a list of spectra, reading chunk_size of them from the spool
+        at a time.
+        """
+        for start in six.moves.range(0, len(spectra), self.chunk_size):
+            chunk = []
+            with self.spool_lock:
+                for _, spectrum_id, offset, length in spectra[start:start+self.chunk_size]:
+                    self.spool.seek(offset)
+                    chunk.append((spectrum_id, self.spool.read(length)))
+            for spectrum in chunk:
+                yield spectrum
+
+    def write(self, path, scan_ids):
+        spectra = sorted(self.spectra[i] for i in set(map(str, scan_ids)) if i in self.spectra)
+        offsets = []
+        index_offset = None
+        sha = hashlib.sha1()
+        position = 0
+        with open(path, 'wb') as handle:
+            for part in self.template:
+                if part == SPECTRA:
+                    for index, (spectrum_id, spectrum) in enumerate(self.read_spectra(spectra)):
+                        spectrum = spectrum.replace(INDEX, str(index).encode('utf-8'), 1)
+                        offsets.append((spectrum_id, position))
+                        handle.write(spectrum)
+                        sha.update(spectrum)
+                        position += len(spectrum)
+                    continue
+                elif part == COUNT:
+                    part = str(len(spectra)).encode('utf-8')
+                elif part == OFFSETS:
+                    part = b''.join(
+                        '\n<offset idRef="{}">{}</offset>'.format(spectrum_id, offset).encode('utf-8')
+                        for spectrum_id, offset in offsets
+                    )+b'\n'
+                elif part == INDEX_OFFSET:
+                    part = str(index_offset).encode('utf-8')
+                elif part == CHECKSUM:
+                    # the checksum covers everything up to and including the opening fileChecksum tag
+                    part = sha.hexdigest().encode('utf-8')
+                elif index_offset is None and b'<indexList' in part:
+                    index_offset = position+part.find(b'<indexList')
+                handle.write(part)
+                sha.update(part)
+                position += len(part)
+
+    def export(self, mapping, threads=1):
+        """
+        Writes each file in mapping, a dictionary of file paths to the scan ids it should contain. Returns the number
+        of files written.
+        """
+        self.load_spectra(scan_id for scan_ids in six.itervalues(mapping) for scan_id in scan_ids)
+        pool = ThreadPool(max(1, threads))
+        try:
+            pool.map(lambda x: self.write(*x), list(six.iteritems(mapping)))
+        finally:
+            pool.close()
+            pool.join()
+        return len(mapping)
+
+    def close(self):
+        self.spool.close()
@@ -0,0 +1,98 @@
+import multiprocessing
+import os
+
+# the variables the common BLAS and OpenMP libraries read their thread count from when they are loaded
+THREAD_ENVIRONMENT = (
+    'OMP_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS',
+    'NUMEXPR_NUM_THREADS',
+)
+
+# the exit code of a worker that stopped because it went over its memory limit, so it is replaced without treating
+# the tasks it had left as the cause of a crash
+RECYCLE_EXIT_CODE = 75
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def set_thread_environment(threads):
+    """
+    Sets the thread count of native libraries for processes started from this one that load them anew.
+    """
+    for variable in THREAD_ENVIRONMENT:
+        os.environ[variable] = str(threads)
+
+
+def memory_usage():
+    """
+    The resident memory of this process in bytes, or None if it cannot be determined.
+    """
+    try:
+        import psutil
+    except ImportError:
+        try:
+            with open('/proc/self/statm', 'r') as statm:
+                return int(statm.read().split()[1])*os.sysconf(str('SC_PAGE_SIZE'))
+        except (IOError, OSError, ValueError, AttributeError):
+            return None
+    return psutil.Process().memory_info().rss
+
+
+class Governor(object):
+    """
+    The resources a reader or worker process may use. It is created in the main process and applied by the process
+    it is given to once it starts.
+
+    :param native_threads: The number of threads BLAS and OpenMP may use. If None, they are left alone.
+    :param pin: Whether to pin each process to a core.
+    :param memory_limit: The resident memory in bytes a worker may grow to before it is replaced.
+    :param cores: The cores to pin to. This is set by for_process.
+    """
+    def __init__(self, native_threads=None, pin=False, memory_limit=None, cores=None):
+        self.native_threads = native_threads
+        self.pin = pin
+        self.memory_limit = memory_limit
+        self.cores = cores
+        self.thread_limits = None
+
+    def for_process(self, index):
+        """
+        The governor of one process. The reader is process 0 and each worker is its thread plus one, and processes are
+        spread over the available cores in that order.
+        """
+        cores = None
+        if self.pin:
+            available = available_cores()
+            cores = [available[index % len(available)]]
+        return Governor(native_threads=self.native_threads, pin=self.pin, memory_limit=self.memory_limit, cores=cores)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['thread_limits'] = None
+        return state
+
+    def apply(self):
+        if self.native_threads:
+            set_thread_environment(self.native_threads)
+            try:
+                from threadpoolctl import threadpool_limits
+            except ImportError:
+                # without threadpoolctl, only libraries loaded after this point are limited
+                pass
+            else:
+                # forked processes inherit the thread pools of libraries the main process already loaded
+                self.thread_limits = threadpool_limits(limits=self.native_threads)
+        if self.cores and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, self.cores)
+
+    def over_memory_limit(self):
+        if not self.memory_limit:
+            return False
+        usage = memory_usage()
+        return usage is not None and usage > self.memory_limit
@@ -0,0 +1,181 @@
+import multiprocessing
+import operator
+import os
+from collections import defaultdict, OrderedDict
+
+import numpy as np
+import six
+
+from .scheduler import expected_xic_length
+
+# rough sizes of the reader and worker processes before they hold any scans, which is mostly the scientific python stack
+READER_BASE_MEMORY = 300*1024**2
+WORKER_BASE_MEMORY = 300*1024**2
+
+# the fields of a result that belong to the PSM rather than to the quantification of its peptide
+PSM_FIELDS = ('scan', 'ms1', 'rt', 'accession')
+
+
+def psm_fields(params):
+    scan_info = params['scan_info']
+    target_scan, quant_scan = scan_info['id_scan'], scan_info['quant_scan']
+    return {
+        'key': params['key'],
+        'scan': target_scan.get('id'),
+        'ms1': quant_scan.get('id'),
+        'rt': target_scan.get('rt'),
+        'accession': target_scan.get('accession'),
+    }
+
+
+def merge_redundant_psms(tasks, rt_window):
+    """
+    Merges tasks for PSMs of the same peptide, charge and modifications that elute together, so their XIC is only
+    traced and fit once.
+
+    Tasks are grouped by their peptide, and within a group, a PSM within rt_window of the previous one (in
+    retention time order) is part of the same cluster. Each cluster is quantified by the PSM in the middle of it, and
+    the other PSMs are listed under 'psms' in its params with the fields of the result that are their own, so the
+    result can be reported for each of them. Tasks without a peptide, or with a fixed list of scans to quantify, are
+    left as they are.
+
+    :param tasks: A list of (rt, params) tuples.
+    :param rt_window: The largest retention time difference between neighboring PSMs of a cluster.
+    :return: A list of (rt, params) tuples in retention time order.
+    """
+    groups = defaultdict(list)
+    merged = []
+    for rt, params in tasks:
+        target_scan = params['scan_info']['id_scan']
+        if not target_scan.get('peptide') or params['scan_info']['quant_scan'].get('scans'):
+            merged.append((rt, params))
+            continue
+        filename = params['key'][0]
+        group_key = (
+            filename,
+            target_scan.get('peptide'),
+            target_scan.get('charge'),
+            target_scan.get('modifications'),
+            round(float(target_scan.get('precursor', 0)), 4),
+        )
+        groups[group_key].append((rt, params))
+
+    for group in six.itervalues(groups):
+        group.sort(key=operator.itemgetter(0))
+        clusters = [[group[0]]]
+        for task in group[1:]:
+            if task[0]-clusters[-1][-1][0] <= rt_window:
+                clusters[-1].append(task)
+            else:
+                clusters.append([task])
+        for cluster in clusters:
+            rt, params = cluster[len(cluster)//2]
+            others = [i[1] for i in cluster if i[1] is not params]
+            if others:
+                params['psms'] = [psm_fields(i) for i in others]
+            merged.append((rt, params))
+    merged.sort(key=operator.itemgetter(0))
+    return merged
+
+
+def task_size(params):
+    """
+    The number of PSMs a task reports results for.
+    """
+    return 1+len(params.get('psms', []))
+
+
+def available_memory():
+    """
+    The memory available on this machine in bytes, or None if it cannot be determined.
+    """
+    try:
+        import psutil
+    except ImportError:
+        try:
+            return os.sysconf(str('SC_AVPHYS_PAGES'))*os.sysconf(str('SC_PAGE_SIZE'))
+        except (AttributeError, ValueError, OSError):
+            return None
+    return psutil.virtual_memory().available
+
+
+def distinct_scans(run_map, tasks, xic_window_size=-1):
+    """
+    The number of quant scans within the expected XIC of at least one task.
+    """
+    intervals = []
+    for rt, params in tasks:
+        position = run_map.position(params['scan_info']['quant_scan'].get('id'))
+        if position is None:
+            continue
+        half_width = expected_xic_length(params, xic_window_size=xic_window_size)//2
+        intervals.append((max(position-half_width, 0), min(position+half_width+1, len(run_map))))
+    total, covered_to = 0, 0
+    for start, end in sorted(intervals):
+        start = max(start, covered_to)
+        if end > start:
+            total += end-start
+            covered_to = end
+    return total
+
+
+def plan_file(filename, tasks, run_map, scan_bytes, task_bytes, xic_window_size=-1, tasks_per_worker=2,
+              scan_cache_size=0, cpus=None, memory=None):
+    """
+    Estimates the work and memory quantifying a raw file takes, and suggests how many workers to run for it.
+
+    :param tasks: The (rt, params) tuples of the file.
+    :param scan_bytes: The average size of a scan's m/z and intensity array.
+    :param task_bytes: The average size of a pickled task.
+    :param cpus: The processors available, defaults to every processor of this machine.
+    :param memory: The memory available in bytes. If None, the workers are not limited by memory.
+    :return: An OrderedDict of the estimates.
+    """
+    cpus = multiprocessing.cpu_count() if cpus is None else cpus
+    xic_lengths = [expected_xic_length(params, xic_window_size=xic_window_size) for rt, params in tasks]
+    scans = distinct_scans(run_map, tasks, xic_window_size=xic_window_size)
+    # the reader keeps the scans it has sent for several minutes, so in the worst case it holds every scan of an XIC
+    reader_cache_bytes = scans*scan_bytes
+    worker_bytes = WORKER_BASE_MEMORY+scan_cache_size*scan_bytes+tasks_per_worker*task_bytes
+    # the main process mostly waits on results, so the reader and workers get the processors
+    workers = max(1, min(cpus-1, len(tasks)))
+    if memory is not None:
+        workers = max(1, min(workers, int((memory-READER_BASE_MEMORY-reader_cache_bytes)//worker_bytes)))
+    plan = OrderedDict([
+        ('file', filename),
+        ('targets', len(tasks)),
+        ('psms', sum(task_size(params) for rt, params in tasks)),
+        ('mean_xic_length', float(np.mean(xic_lengths)) if xic_lengths else 0.),
+        ('scan_fetches', sum(xic_lengths)),
+        ('distinct_scans', scans),
+        ('scan_bytes', scan_bytes),
+        ('reader_cache_bytes', reader_cache_bytes),
+        ('task_queue_bytes', workers*tasks_per_worker*task_bytes),
+        ('worker_bytes', worker_bytes),
+        ('readers', 1),
+        ('workers', workers),
+    ])
+    return plan
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024:
+            return '{0:.1f} {1}'.format(size, unit)
+        size /= 1024.
+    return '{0:.1f} TB'.format(size)
+
+
+def format_plan(plan):
+    lines = [
+        '{}:'.format(plan['file']),
+        '  Targets: {} ({} PSMs)'.format(plan['targets'], plan['psms']),
+        '  Expected XIC length: {0:.1f} scans'.format(plan['mean_xic_length']),
+        '  Scan fetches: {} ({} distinct scans)'.format(plan['scan_fetches'], plan['distinct_scans']),
+        '  Scan size: {}'.format(format_bytes(plan['scan_bytes'])),
+        '  Reader cache: up to {}'.format(format_bytes(plan['reader_cache_bytes'])),
+        '  Task queues: {}'.format(format_bytes(plan['task_queue_bytes'])),
+        '  Memory per worker: {}'.format(format_bytes(plan['worker_bytes'])),
+        '  Suggested split: {} reader, {} workers (-p {})'.format(plan['readers'], plan['workers'], plan['workers']),
+    ]
+    return '{}\n'.format('\n'.join(lines))
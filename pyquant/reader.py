@@ -5,57 +5,88 @@ from multiprocessing import Process
 
 from pythomics.proteomics.parsers import GuessIterator
 
+from .export import MzmlExporter
 from .logger import logger
 
+
+def read_scan(raw, scan_id, calibration=None, rt_window=None, run_map=None):
+    """
+    Parses a scan from an open raw file into a dictionary, with its m/z and intensities as an array. Returns None for
+    scans that are missing or outside of the retention time windows.
+    """
+    # scans known to be outside of the retention time windows are not parsed at all
+    if run_map is not None and run_map.excluded(scan_id):
+        return None
+    scan = raw.getScan(scan_id)
+    if scan is None:
+        return None
+    if rt_window is not None and float(scan.rt) not in rt_window:
+        return None
+    scan_vals = np.array(scan.scans)
+    if calibration is not None:
+        scan_vals[:, 0] = calibration(scan_vals[:, 0])
+    return {
+        'vals': scan_vals,
+        'rt': scan.rt,
+        'title': scan.title,
+        'mass': scan.mass,
+        'charge': scan.charge,
+        'centroid': getattr(scan, 'centroid', False)
+    }
+
+
 class Reader(Process):
-    def __init__(self, incoming, outgoing, raw_file=None, spline=None, rt_window=None, timeout_minutes=5):
+    def __init__(self, incoming, outgoing, raw_file=None, calibration=None, rt_window=None, run_map=None, timeout_minutes=5,
+                 governor=None):
         super(Reader, self).__init__()
         self.incoming = incoming
         self.outgoing = outgoing
         self.scan_dict = {}
         self.access_times = {}
         self.raw_path = raw_file
-        self.spline = spline
+        self.calibration = calibration
         self.rt_window = rt_window
+        self.run_map = run_map
+        self.governor = governor
         self.timeout_minutes = timeout_minutes
 
     def run(self):
+        if self.governor is not None:
+            self.governor.apply()
         raw = GuessIterator(self.raw_path, full=True, store=False)
         for scan_request in iter(self.incoming.get, None):
-            thread, scan_id, mz_start, mz_end = scan_request
+            if isinstance(scan_request, dict):
+                # export scans to mzML from the raw file we already have open, the reply goes to the main queue
+                exporter = None
+                try:
+                    exporter = MzmlExporter(raw.parser)
+                    written = exporter.export(scan_request['export'], threads=scan_request.get('threads', 1))
+                except Exception as e:
+                    logger.error('Unable to export scans: {}'.format(e))
+                    self.outgoing['main'].put({'error': str(e)})
+                else:
+                    self.outgoing['main'].put({'written': written})
+                finally:
+                    if exporter is not None:
+                        exporter.close()
+                continue
+            # replies carry the id of their request, so a worker started in place of one that was stopped while waiting
+            # for a scan can tell the scan apart from the ones it asked for
+            thread, scan_id, mz_start, mz_end, request_id = scan_request
             d = self.scan_dict.get(scan_id)
             if not d:
-                scan = raw.getScan(scan_id)
-                if scan is not None:
-                    rt = scan.rt
-                    if self.rt_window is not None and not any([(i[0] < float(rt) < i[1]) for i in self.rt_window]):
-                        d = None
-                    else:
-                        scan_vals = np.array(scan.scans)
-                        if self.spline:
-                            scan_vals[:, 0] = scan_vals[:, 0] / (1 - self.spline(scan_vals[:, 0]) / 1e6)
-                        # add to our database
-                        d = {
-                          'vals': scan_vals,
-                          'rt': scan.rt,
-                          'title': scan.title,
-                          'mass': scan.mass,
-                          'charge': scan.charge,
-                          'centroid': getattr(scan, 'centroid', False)
-                        }
-                        self.scan_dict[scan_id] = d
-                        # the scan has been stored, delete it
-                    del scan
-                else:
-                    d = None
+                d = read_scan(raw, scan_id, calibration=self.calibration, rt_window=self.rt_window, run_map=self.run_map)
+                if d is not None:
+                    # add to our database
+                    self.scan_dict[scan_id] = d
             if d is not None and (mz_start is not None or mz_end is not None):
                 out = copy.deepcopy(d)
                 mz_start = 0 if mz_start is None else mz_start
                 mz_end = out['vals'][-1, 0] + 1 if mz_end is None else mz_end
                 out['vals'] = out['vals'][np.where((out['vals'][:, 0] >= mz_start) & (out['vals'][:, 0] <= mz_end))]
-                self.outgoing[thread].put(out)
+                self.outgoing[thread].put((request_id, out))
             else:
-                self.outgoing[thread].put(d)
+                self.outgoing[thread].put((request_id, d))
             now = datetime.now()
             self.access_times[scan_id] = now
             # evict scans we have not accessed in over 5 minutes
@@ -0,0 +1,79 @@
+import base64
+import os
+import zlib
+from string import Template
+
+import pandas as pd
+import six
+
+REPORT_TEMPLATE = os.path.join(os.path.split(__file__)[0], 'static', 'pyquant_output.html')
+
+
+def read_template(template_file=REPORT_TEMPLATE):
+    header, footer = [], []
+    current = header
+    with open(template_file, 'r') as template:
+        for line in template:
+            if 'HTML BREAK' in line:
+                current = footer
+                continue
+            current.append(line)
+    return Template(''.join(header)), Template(''.join(footer))
+
+
+class HtmlReport(object):
+    """
+    Writes the HTML summary one row at a time.
+
+    Table rows are written directly to the page. The figures and peak reports of every chunk_size rows are compressed
+    separately into chunk files in a directory next to the page (<path>_data), which the page loads when a row of that
+    chunk is viewed. Only a single chunk is ever held in memory.
+    """
+    def __init__(self, path, title, headers, peak_header, chunk_size=500, compression=6):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.peak_header = peak_header
+        self.data_dir = '{}_data'.format(os.path.split(path)[1])
+        self.data_path = os.path.join(os.path.split(path)[0], self.data_dir)
+        if os.path.isdir(self.data_path):
+            for chunk_file in os.listdir(self.data_path):
+                if chunk_file.startswith('chunk_'):
+                    os.remove(os.path.join(self.data_path, chunk_file))
+        else:
+            os.mkdir(self.data_path)
+        self.chunk_index = 0
+        self.chunk = {'html': [], 'peaks': []}
+        header_template, self.footer_template = read_template()
+        self.handle = open(path, 'w')
+        self.handle.write(header_template.substitute({
+            'title': title,
+            'table_header': '\n'.join(['<th>{0}</th>'.format(i) for i in ['Controls']+headers]),
+        }))
+
+    def write_row(self, values, html=None, peaks=None):
+        # the first column is for graph controls
+        cells = ['<td></td>']+['<td>{0}</td>'.format(i) for i in values]
+        self.handle.write('<tr>{}</tr>\n'.format('\n'.join(cells)))
+        self.chunk['html'].append(html if html is not None else {})
+        self.chunk['peaks'].append(peaks if peaks is not None else [])
+        if len(self.chunk['html']) >= self.chunk_size:
+            self.write_chunk()
+
+    def write_chunk(self):
+        payload = pd.io.json.dumps(self.chunk)
+        payload = zlib.compress(payload if six.PY2 else six.binary_type(payload, 'utf-8'), self.compression)
+        with open(os.path.join(self.data_path, 'chunk_{}.js'.format(self.chunk_index)), 'w') as chunk_file:
+            chunk_file.write('pyquantChunk({}, "{}");\n'.format(self.chunk_index, base64.b64encode(payload).decode('utf-8')))
+        self.chunk_index += 1
+        self.chunk = {'html': [], 'peaks': []}
+
+    def close(self):
+        if self.chunk['html']:
+            self.write_chunk()
+        self.handle.write(self.footer_template.safe_substitute({
+            'chunk_size': self.chunk_size,
+            'data_dir': self.data_dir,
+            'peak_header': pd.io.json.dumps(self.peak_header),
+        }))
+        self.handle.close()
@@ -0,0 +1,167 @@
+import os
+import shutil
+import tempfile
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+import six
+
+
+class RunMap(object):
+    """
+    The scan maps of a raw file that workers need to trace XICs, stored as NumPy arrays on disk.
+
+    The maps are written once by the main process, and each worker memory maps them read-only the first time they are
+    used. Only the directory is pickled when a worker is started, so the maps are never copied into each worker and
+    every worker shares the same pages of the operating system's file cache.
+
+    The quant map holds the scans used for quantification in file order, along with their ms level (or mass for
+    MRM runs) and whether they are outside of the retention time windows being quantified. The retention time map
+    holds every scan sorted by retention time.
+
+    :param msn_map: A list of (ms level, scan id) tuples in file order.
+    :param msn_rt_map: A dictionary of scan ids to their retention time.
+    :param quant_level: The ms level of the scans used for quantification. If None, every scan is used.
+    :param excluded: The ids of scans outside of the retention time windows.
+    :param directory: Where to write the arrays. A temporary directory is made if it is not provided.
+    """
+    ARRAYS = ('quant_ids', 'quant_levels', 'quant_excluded', 'quant_sorted_ids', 'quant_sorted_positions', 'rts', 'rt_ids')
+
+    def __init__(self, msn_map, msn_rt_map, quant_level=None, excluded=None, directory=None):
+        self.directory = directory or tempfile.mkdtemp(prefix='pyquant_runmap_')
+        quant_map = [i for i in msn_map if quant_level is None or i[0] == quant_level]
+        quant_ids = np.array([six.text_type(i[1]) for i in quant_map], dtype=six.text_type)
+        order = np.argsort(quant_ids, kind='mergesort')
+        rt_order = sorted(msn_rt_map, key=msn_rt_map.get)
+        excluded = set(six.text_type(i) for i in excluded or [])
+        arrays = {
+            'quant_ids': quant_ids,
+            'quant_levels': np.array([i[0] for i in quant_map], dtype=float),
+            'quant_excluded': np.array([i in excluded for i in quant_ids], dtype=bool),
+            'quant_sorted_ids': quant_ids[order],
+            'quant_sorted_positions': order,
+            'rts': np.array([msn_rt_map[i] for i in rt_order], dtype=float),
+            'rt_ids': np.array([six.text_type(i) for i in rt_order], dtype=six.text_type),
+        }
+        for name, array in six.iteritems(arrays):
+            np.save(os.path.join(self.directory, '{}.npy'.format(name)), array)
+        # the main process maps the arrays like the workers do, so forked workers do not inherit a private copy
+        self.arrays = None
+
+    def __getstate__(self):
+        return {'directory': self.directory}
+
+    def __setstate__(self, state):
+        self.directory = state['directory']
+        self.arrays = None
+
+    def __getattr__(self, name):
+        if name not in RunMap.ARRAYS:
+            raise AttributeError(name)
+        if self.arrays is None:
+            self.arrays = {
+                i: np.load(os.path.join(self.directory, '{}.npy'.format(i)), mmap_mode='r')
+                for i in RunMap.ARRAYS
+            }
+        return self.arrays[name]
+
+    def __len__(self):
+        return len(self.quant_ids)
+
+    def position(self, scan_id):
+        """
+        Returns the position of scan_id in the quant map, or None if it is not a scan used for quantification.
+        """
+        if scan_id is None:
+            return None
+        scan_id = six.text_type(scan_id)
+        index = np.searchsorted(self.quant_sorted_ids, scan_id)
+        if index < len(self.quant_sorted_ids) and self.quant_sorted_ids[index] == scan_id:
+            return int(self.quant_sorted_positions[index])
+        return None
+
+    def excluded(self, scan_id):
+        """
+        Returns True if scan_id is a quant scan outside of the retention time windows.
+        """
+        position = self.position(scan_id)
+        return position is not None and bool(self.quant_excluded[position])
+
+    def find_scan(self, scan_id):
+        return None if self.position(scan_id) is None else scan_id
+
+    def find_prior_scan(self, scan_id):
+        position = self.position(scan_id)
+        return None if position is None or position == 0 else six.text_type(self.quant_ids[position-1])
+
+    def find_next_scan(self, scan_id):
+        position = self.position(scan_id)
+        return None if position is None or position == len(self.quant_ids)-1 else six.text_type(self.quant_ids[position+1])
+
+    def quant_map(self):
+        return list(zip(self.quant_levels.tolist(), self.quant_ids.tolist()))
+
+    def next_rt(self, rt):
+        """
+        Returns the first retention time after rt, or None if rt is the last one.
+        """
+        index = np.searchsorted(self.rts, rt, side='right')
+        return float(self.rts[index]) if index < len(self.rts) else None
+
+    def scan_at_rt(self, rt):
+        index = np.searchsorted(self.rts, rt)
+        if index < len(self.rts) and self.rts[index] == rt:
+            return six.text_type(self.rt_ids[index])
+        return None
+
+    def remove(self):
+        self.arrays = None
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class RTWindows(object):
+    """
+    A set of retention time windows, merged into sorted intervals that do not overlap so a retention time is checked
+    with a single binary search. Like the windows they are made from, the intervals exclude their ends.
+
+    :param windows: A list of (start, end) tuples.
+    """
+    def __init__(self, windows):
+        starts, ends = [], []
+        for start, end in sorted(windows):
+            if starts and start < ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        self.starts = np.array(starts, dtype=float)
+        self.ends = np.array(ends, dtype=float)
+
+    def __contains__(self, rt):
+        index = np.searchsorted(self.starts, rt, side='left')-1
+        return index >= 0 and rt < self.ends[index]
+
+
+class ScanMask(object):
+    """
+    A set of the quant scans of a RunMap, shared by every worker of a raw file.
+
+    Each scan has a byte in shared memory, so checking whether a scan is in the set is a memory read rather than a
+    request to a manager process. Scans are only ever added, and a single byte write is atomic, so no lock is used.
+    Scans that are not in the quant map of the RunMap are never in the set.
+    """
+    def __init__(self, run_map):
+        self.run_map = run_map
+        self.mask = RawArray('b', max(len(run_map), 1))
+
+    def __contains__(self, scan_id):
+        position = self.run_map.position(scan_id)
+        return position is not None and bool(self.mask[position])
+
+    def add(self, scan_id):
+        position = self.run_map.position(scan_id)
+        if position is not None:
+            self.mask[position] = 1
+
+    def __len__(self):
+        return sum(1 for i in self.mask if i)
@@ -0,0 +1,418 @@
+import time
+from collections import deque
+from multiprocessing import Queue
+
+import numpy as np
+import six
+
+# used when nothing is known about the length of a XIC, roughly the number of scans a peptide elutes over
+DEFAULT_XIC_LENGTH = 50
+DEFAULT_ISOTOPOLOGUES = 5
+
+
+def expected_xic_length(task, xic_window_size=-1):
+    """
+    The number of scans the XIC of a task is expected to span.
+    """
+    quant_scan = task['scan_info']['quant_scan']
+    if quant_scan.get('scans'):
+        return len(quant_scan['scans'])
+    elif xic_window_size > 0:
+        return 2*xic_window_size+1
+    return DEFAULT_XIC_LENGTH
+
+
+def estimate_task_cost(task, label_count=1, isotopologue_limit=-1, xic_window_size=-1):
+    """
+    A relative estimate of how long a task takes to quantify. It is the number of XIC points the task is
+    expected to fit: the labels and ions being traced, times the isotopologues of each, times the length of the XIC.
+    """
+    target_scan = task['scan_info']['id_scan']
+    ions = len(target_scan.get('ion_set') or [None])
+    isotopologues = isotopologue_limit if isotopologue_limit is not None and isotopologue_limit > 0 else DEFAULT_ISOTOPOLOGUES
+    xic_length = expected_xic_length(task, xic_window_size=xic_window_size)
+    return float(max(label_count, 1)*ions*isotopologues*xic_length)
+
+
+def number_tasks(tasks):
+    """
+    Sets the order of each task to its position in tasks.
+    """
+    for order, task in enumerate(tasks):
+        task['order'] = order
+        yield task
+
+
+class TaskScheduler(object):
+    """
+    Hands tasks out to workers, keeping at most max_in_flight items queued for each worker.
+
+    Each worker has its own task queue, and a new item is only given to a worker once it reports the results of
+    everything in one of its items. Tasks are pulled from the task iterable as they are needed, so only the tasks
+    being worked on are serialized and queued, however many targets there are. This bounds the queues, not the task
+    params, which are held by whatever the iterable draws from, and which a cost function has the scheduler list in
+    full to find the expensive ones. Every task is given a task_id, which workers return with the result of the task.
+    Items are lists of tasks.
+
+    If a cost function is provided, tasks that cost over expensive_factor times the median are handed out first,
+    each on their own, so long running tasks do not finish last on a single worker. The remaining tasks keep their
+    order and are sent in chunks that should take about chunk_seconds, which is judged from the time workers report
+    for their tasks (seconds_per_cost can be provided from a previous run). Until the time per unit of cost is known,
+    tasks are sent one at a time.
+
+    With rt_bands, the tasks (which are expected to be in retention time order) are split into a contiguous band for
+    every worker when the scheduler starts, so workers quantify neighboring targets that share the same scans. A
+    worker that runs out of tasks takes the later half of the largest remaining band.
+
+    Every task is also given its order, which is its position in the task iterable. With a window, a task is only
+    handed out once every task more than window positions before it is finished, so the results that finished ahead of
+    their turn, which are held to write them in order, never number more than the window. Workers that have nothing
+    they may be given wait until the earliest unfinished task is done. The window does not apply to rt_bands.
+
+    Without tasks, the scheduler is given tasks with extend as they become available, until close is called. Workers
+    with nothing to do wait for them rather than being stopped.
+
+    Once there are no tasks left, every worker is sent None after its last item so it exits.
+
+    A worker that crashes or runs past its time budget is assumed to be stuck on the first task it has not finished.
+    That task is retried once with fast_fit set, and quarantined if it fails again. The rest of its tasks are handed
+    out again as they were.
+    """
+    def __init__(self, tasks=None, max_in_flight=2, cost=None, seconds_per_cost=None, chunk_seconds=0.5,
+                 max_chunk_size=100, expensive_factor=4, rt_bands=False, window=None):
+        self.max_in_flight = max(1, max_in_flight)
+        self.seconds_per_cost = seconds_per_cost
+        self.chunk_seconds = chunk_seconds
+        self.max_chunk_size = max(1, max_chunk_size)
+        self.expensive = deque()
+        # tasks given with extend, and whether more may be
+        self.stream = deque() if tasks is None else None
+        self.streamed = 0
+        self.closed = False
+        tasks = number_tasks([] if tasks is None else tasks)
+        if cost is None:
+            self.tasks = tasks
+        else:
+            tasks = list(tasks)
+            costs = np.array([cost(i) for i in tasks], dtype=float)
+            threshold = expensive_factor*np.median(costs) if len(costs) else 0
+            for task, task_cost in zip(tasks, costs):
+                task['cost'] = float(task_cost)
+            self.expensive.extend(sorted((task for task in tasks if task['cost'] > threshold), key=lambda x: -x['cost']))
+            self.tasks = (task for task in tasks if task['cost'] <= threshold)
+        self.queues = {}
+        self.in_flight = {}
+        self.task_items = {}
+        self.retry = deque()
+        self.stopped = set([])
+        self.next_task_id = 0
+        self.next_item_id = 0
+        self.exhausted = False
+        self.bands = {} if rt_bands else None
+        # when each worker last finished a task or was given work while idle, which is when its current task began
+        self.last_activity = {}
+        self.quarantined = []
+        self.window = window
+        # the earliest task that is not finished, and the later ones that are
+        self.first_unfinished = 0
+        self.finished = set([])
+        # a task taken from the iterable that is outside the window
+        self.held = None
+
+    def add_worker(self, thread):
+        """
+        Creates the task queue for the worker running as thread. If the thread had a previous worker, its unfinished
+        tasks are handed out again.
+        """
+        items = self.in_flight.get(thread, {})
+        for item_id in sorted(items):
+            for task_id in sorted(items[item_id]):
+                del self.task_items[task_id]
+                self.retry.append(items[item_id][task_id])
+        self.queues[thread] = Queue()
+        self.in_flight[thread] = {}
+        self.stopped.discard(thread)
+        return self.queues[thread]
+
+    def current_task(self, thread):
+        """
+        Returns the task the worker running as thread is working on. Workers go through their items in the order they
+        were sent, and the tasks of an item in order.
+        """
+        items = self.in_flight.get(thread)
+        if not items:
+            return None
+        item = items[min(items)]
+        return item[min(item)]
+
+    def fail_worker(self, thread, reason):
+        """
+        Records that the worker running as thread crashed or timed out on its current task. The task is set to be
+        retried with a cheaper fit the first time, and is quarantined the second time, in which case it is returned.
+        """
+        task = self.current_task(thread)
+        if task is None:
+            return None
+        task['attempts'] = task.get('attempts', 0)+1
+        task['failure'] = reason
+        if task['attempts'] < 2:
+            task['fast_fit'] = True
+            return None
+        thread, item_id = self.task_items.pop(task['task_id'])
+        del self.in_flight[thread][item_id][task['task_id']]
+        self.quarantined.append(task)
+        # the worker of this thread is gone, and its replacement is filled once it is added
+        self.finish(task, exclude=thread)
+        return task
+
+    def timed_out(self, timeout, now=None):
+        """
+        Returns the threads whose current task has been running for more than timeout seconds.
+        """
+        now = time.time() if now is None else now
+        return [
+            thread for thread, items in six.iteritems(self.in_flight)
+            if items and now-self.last_activity.get(thread, now) > timeout
+        ]
+
+    def make_bands(self):
+        tasks = list(self.tasks)
+        threads = sorted(self.queues)
+        band_size = len(tasks)/len(threads) if threads else 0
+        for index, thread in enumerate(threads):
+            self.bands[thread] = deque(tasks[int(round(index*band_size)):int(round((index+1)*band_size))])
+        self.tasks = iter([])
+
+    def steal(self, thread):
+        stolen = deque()
+        if not self.bands:
+            self.bands[thread] = stolen
+            return
+        band = self.bands[max(self.bands, key=lambda x: len(self.bands[x]))]
+        for _ in range((len(band)+1)//2):
+            stolen.appendleft(band.pop())
+        self.bands[thread] = stolen
+
+    def in_window(self, task):
+        return self.window is None or task['order'] < self.first_unfinished+self.window
+
+    def finish(self, task, exclude=None):
+        """
+        Records that a task is done. If that moves the window, workers that were waiting on it are given tasks.
+        """
+        self.finished.add(task['order'])
+        if task['order'] != self.first_unfinished:
+            return
+        while self.first_unfinished in self.finished:
+            self.finished.remove(self.first_unfinished)
+            self.first_unfinished += 1
+        if self.window is not None:
+            for thread in self.queues:
+                if thread != exclude:
+                    self.fill(thread)
+
+    def next_task(self, thread=None):
+        if self.held is not None:
+            if not self.in_window(self.held):
+                return None
+            task, self.held = self.held, None
+        elif self.bands is not None:
+            if not self.bands.get(thread):
+                self.steal(thread)
+            if not self.bands[thread]:
+                return None
+            task = self.bands[thread].popleft()
+        elif self.exhausted:
+            return None
+        elif self.stream is not None:
+            if not self.stream:
+                self.exhausted = self.closed
+                return None
+            task = self.stream.popleft()
+        else:
+            try:
+                task = next(self.tasks)
+            except StopIteration:
+                self.exhausted = True
+                return None
+            if not self.in_window(task):
+                self.held = task
+                return None
+        task['task_id'] = self.next_task_id
+        self.next_task_id += 1
+        return task
+
+    def next_item(self, thread=None):
+        if self.retry:
+            return [self.retry.popleft()]
+        task = next((i for i in self.expensive if self.in_window(i)), None)
+        if task is not None:
+            self.expensive.remove(task)
+            task['task_id'] = self.next_task_id
+            self.next_task_id += 1
+            return [task]
+        item = []
+        seconds = 0
+        while len(item) < self.max_chunk_size:
+            task = self.next_task(thread)
+            if task is None:
+                break
+            item.append(task)
+            if self.seconds_per_cost is None or 'cost' not in task:
+                break
+            seconds += task['cost']*self.seconds_per_cost
+            if seconds >= self.chunk_seconds:
+                break
+        return item
+
+    def fill(self, thread):
+        if thread in self.stopped:
+            return
+        in_flight = self.in_flight[thread]
+        if not in_flight:
+            self.last_activity[thread] = time.time()
+        while len(in_flight) < self.max_in_flight:
+            item = self.next_item(thread)
+            if not item and self.pending:
+                # the tasks that are left are outside the window
+                return
+            if not item:
+                # nothing else will be given to this worker, so it can exit once it is done
+                self.queues[thread].put(None)
+                self.stopped.add(thread)
+                return
+            item_id = self.next_item_id
+            self.next_item_id += 1
+            in_flight[item_id] = {task['task_id']: task for task in item}
+            for task in item:
+                self.task_items[task['task_id']] = (thread, item_id)
+            self.queues[thread].put(item)
+
+    def extend(self, tasks):
+        """
+        Adds tasks to a scheduler made without any, and gives them to the workers waiting for work.
+        """
+        for task in tasks:
+            task['order'] = self.streamed
+            self.streamed += 1
+            self.stream.append(task)
+        for thread in self.queues:
+            self.fill(thread)
+
+    def close(self):
+        """
+        Records that extend will not be called again, so workers with nothing left to do are stopped.
+        """
+        self.closed = True
+        for thread in self.queues:
+            self.fill(thread)
+
+    def retire(self, thread):
+        """
+        Stops giving work to the worker running as thread. It finishes the items it already has, and then exits.
+        """
+        if thread not in self.stopped:
+            self.queues[thread].put(None)
+            self.stopped.add(thread)
+
+    @property
+    def pending(self):
+        """
+        Whether there may be tasks that have not been handed out yet.
+        """
+        if self.retry or self.expensive or self.held is not None:
+            return True
+        if self.bands is not None:
+            return any(six.itervalues(self.bands))
+        return not self.exhausted
+
+    def start(self):
+        if self.bands is not None:
+            self.make_bands()
+        for thread in self.queues:
+            self.fill(thread)
+
+    def complete(self, task_id, elapsed=None):
+        """
+        Marks the task as finished, and tops up the queue of its worker if that finishes the item it was sent in.
+        elapsed is the time the task took, which is used to size chunks. Returns False if the task is not outstanding.
+        """
+        thread, item_id = self.task_items.pop(task_id, (None, None))
+        if thread is None:
+            return False
+        item = self.in_flight[thread][item_id]
+        task = item.pop(task_id)
+        self.last_activity[thread] = time.time()
+        if elapsed is not None and task.get('cost'):
+            observed = elapsed/task['cost']
+            self.seconds_per_cost = observed if self.seconds_per_cost is None else 0.9*self.seconds_per_cost+0.1*observed
+        if not item:
+            del self.in_flight[thread][item_id]
+            self.fill(thread)
+        self.finish(task)
+        return True
+
+    @property
+    def queued(self):
+        """
+        The number of tasks given with extend that have not been handed out yet.
+        """
+        return len(self.stream) if self.stream is not None else 0
+
+    @property
+    def outstanding(self):
+        return len(self.task_items)
+
+
+class Autoscaler(object):
+    """
+    Decides when to add or remove workers, from where the time of the tasks finished in the last interval went.
+
+    Workers report how long each task took, how much of that was spent waiting on the reader, and when they finished
+    it, so the main process knows how long results waited before it read them. If workers mostly wait on the reader,
+    or results pile up in front of the main process, more workers would only wait as well, so one is removed. If
+    workers spend their time fitting and there is work left to hand out, one is added.
+    """
+    def __init__(self, min_workers=1, max_workers=1, interval=10., reader_bound=0.5, fit_bound=0.2, backlog_seconds=1.):
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.interval = interval
+        self.reader_bound = reader_bound
+        self.fit_bound = fit_bound
+        self.backlog_seconds = backlog_seconds
+        self.last_decision = time.time()
+        self.reset()
+
+    def reset(self):
+        self.elapsed = 0.
+        self.reader_wait = 0.
+        self.latency = 0.
+        self.results = 0
+
+    def observe(self, result, now=None):
+        now = time.time() if now is None else now
+        self.elapsed += result.get('elapsed') or 0
+        self.reader_wait += result.get('reader_wait') or 0
+        if result.get('finished') is not None:
+            self.latency = max(self.latency, now-result['finished'])
+        self.results += 1
+
+    def decide(self, workers, pending, now=None):
+        """
+        Returns 1 if a worker should be added, -1 if one should be removed, and 0 otherwise.
+
+        :param workers: The number of workers that are being given tasks.
+        :param pending: Whether there are tasks left to hand out.
+        """
+        now = time.time() if now is None else now
+        if now-self.last_decision < self.interval or not self.results:
+            return 0
+        reader_fraction = self.reader_wait/self.elapsed if self.elapsed else 0
+        latency = self.latency
+        self.reset()
+        self.last_decision = now
+        if workers > self.min_workers and (reader_fraction > self.reader_bound or latency > self.backlog_seconds):
+            return -1
+        if workers < self.max_workers and pending and reader_fraction < self.fit_bound:
+            return 1
+        return 0
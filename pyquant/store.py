@@ -0,0 +1,152 @@
+import os
+import struct
+
+import six
+from six.moves import cPickle as pickle
+
+from .logger import logger
+
+STORE_HEADER = b'PQSTORE1'
+RECORD_LENGTH = struct.Struct(str('<I'))
+INDEX_OFFSET = struct.Struct(str('<Q'))
+PICKLE_PROTOCOL = 2
+
+
+class RecordStore(object):
+    """
+    An append-only file of length-prefixed pickled records.
+
+    The offset of every record is kept in a sidecar index (<path>.idx), so records can be fetched by position
+    without reading the records before them, and iterating over the store streams records from the disk one at a time.
+    If a run is interrupted while a record is being written, the incomplete record is dropped when the store is
+    opened again.
+
+    :param path: The file to store records in.
+    :param mode: 'w' to create a new store, 'a' to append to an existing one (it is created if it does not exist) and
+        'r' to read.
+    """
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.index_path = '{}.idx'.format(path)
+        self.mode = mode
+        self.offsets = []
+        if mode == 'w' or (mode == 'a' and not os.path.exists(path)):
+            self.handle = open(path, 'w+b')
+            self.handle.write(STORE_HEADER)
+            self.index_handle = open(self.index_path, 'wb')
+        else:
+            self.handle = open(path, 'rb' if mode == 'r' else 'r+b')
+            if self.handle.read(len(STORE_HEADER)) != STORE_HEADER:
+                self.handle.close()
+                raise ValueError('{} is not a pyquant record store.'.format(path))
+            self.load_index()
+            self.index_handle = None
+            if mode == 'a':
+                # drop anything after the last complete record, and rewrite the index to match the store
+                self.handle.seek(self.end)
+                self.handle.truncate()
+                self.index_handle = open(self.index_path, 'wb')
+                self.index_handle.write(b''.join(INDEX_OFFSET.pack(i) for i in self.offsets))
+                self.index_handle.flush()
+        self.handle.seek(0, os.SEEK_END)
+        self.end = self.handle.tell()
+
+    def load_index(self):
+        self.handle.seek(0, os.SEEK_END)
+        size = self.handle.tell()
+        end = len(STORE_HEADER)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as index_file:
+                index_data = index_file.read()
+            index_data = index_data[:len(index_data) - len(index_data) % INDEX_OFFSET.size]
+            for (offset,) in (INDEX_OFFSET.unpack_from(index_data, i) for i in six.moves.range(0, len(index_data), INDEX_OFFSET.size)):
+                length = self.read_length(offset, size)
+                if length is None or offset != end:
+                    break
+                self.offsets.append(offset)
+                end = offset + RECORD_LENGTH.size + length
+        # the index is written after the store, so there may be records it does not know about yet
+        while True:
+            length = self.read_length(end, size)
+            if length is None:
+                break
+            self.offsets.append(end)
+            end += RECORD_LENGTH.size + length
+        if end != size:
+            logger.info('Dropping {} bytes of an incomplete record from {}'.format(size - end, self.path))
+        self.end = end
+
+    def read_length(self, offset, size):
+        if offset + RECORD_LENGTH.size > size:
+            return None
+        self.handle.seek(offset)
+        length, = RECORD_LENGTH.unpack(self.handle.read(RECORD_LENGTH.size))
+        if offset + RECORD_LENGTH.size + length > size:
+            return None
+        return length
+
+    def append(self, record):
+        payload = pickle.dumps(record, PICKLE_PROTOCOL)
+        self.handle.seek(self.end)
+        self.handle.write(RECORD_LENGTH.pack(len(payload)))
+        self.handle.write(payload)
+        self.offsets.append(self.end)
+        self.index_handle.write(INDEX_OFFSET.pack(self.end))
+        self.end += RECORD_LENGTH.size + len(payload)
+        return len(self.offsets) - 1
+
+    def truncate(self, count):
+        """
+        Drops every record after the first count.
+        """
+        if count >= len(self.offsets):
+            return
+        self.end = self.offsets[count]
+        del self.offsets[count:]
+        self.handle.seek(self.end)
+        self.handle.truncate()
+        self.index_handle.seek(count*INDEX_OFFSET.size)
+        self.index_handle.truncate()
+
+    def flush(self, durable=False):
+        # the store is flushed first so the index never points past the end of the store
+        for handle in (self.handle, self.index_handle):
+            if handle is None:
+                continue
+            handle.flush()
+            if durable:
+                os.fsync(handle.fileno())
+
+    def read_at(self, offset):
+        self.handle.seek(offset)
+        length, = RECORD_LENGTH.unpack(self.handle.read(RECORD_LENGTH.size))
+        return pickle.loads(self.handle.read(length))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        return self.read_at(self.offsets[index])
+
+    def __iter__(self):
+        if self.index_handle is not None:
+            self.flush()
+        # read through a separate handle so appending and scanning do not disturb each other
+        with open(self.path, 'rb') as handle:
+            handle.seek(len(STORE_HEADER))
+            for _ in six.moves.range(len(self.offsets)):
+                length, = RECORD_LENGTH.unpack(handle.read(RECORD_LENGTH.size))
+                yield pickle.loads(handle.read(length))
+
+    def close(self):
+        if self.index_handle is not None:
+            self.flush()
+            self.index_handle.close()
+            self.index_handle = None
+        self.handle.close()
+
+    def remove(self):
+        self.close()
+        for path in (self.path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
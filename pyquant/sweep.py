@@ -0,0 +1,187 @@
+import heapq
+from collections import OrderedDict
+from multiprocessing import Process, Queue
+
+import numpy as np
+import six
+from six.moves.queue import Empty
+
+from .logger import logger
+from .scheduler import expected_xic_length
+
+
+def make_sweep_targets(tasks, run_map, mass_labels, reporter_mode=False, calibration=None, xic_window_size=-1):
+    """
+    The sweep targets of a list of task params. The swept XIC of a task spans its expected length around its quant scan
+    (or the scans it lists), and is traced over the m/z range of its precursors. A worker that follows an XIC past
+    either end of its swept scans requests the rest from the reader, so the sweep only decides which scans are read
+    ahead, not how long an XIC is.
+
+    :return: A list of (index, first, last, mz_start, mz_end) tuples, where index is the position of the task in tasks
+        and first and last are positions in the run map.
+    """
+    from .worker import get_precursors, get_precursor_range
+
+    targets = []
+    for index, params in enumerate(tasks):
+        target_scan = params['scan_info']['id_scan']
+        quant_scan = params['scan_info']['quant_scan']
+        position = run_map.position(quant_scan.get('id'))
+        if position is None or float(target_scan['charge']) == 0:
+            # these tasks are finished without reading any scans
+            targets.append((index, -1, -1, 0., 0.))
+            continue
+        if quant_scan.get('scans'):
+            positions = [position]+[run_map.position(i) for i in quant_scan['scans']]
+            positions = [i for i in positions if i is not None]
+            first, last = min(positions), max(positions)
+        elif reporter_mode:
+            first = last = position
+        else:
+            half_width = expected_xic_length(params, xic_window_size=xic_window_size)//2
+            first, last = position-half_width, position+half_width
+        precursors = get_precursors(target_scan, mass_labels, reporter_mode=reporter_mode, calibration=calibration)
+        _, _, mz_start, mz_end = get_precursor_range(precursors)
+        targets.append((index, first, last, mz_start, mz_end))
+    return targets
+
+
+class Sweep(object):
+    """
+    Extracts the scans of many XICs in a single pass over the quant scans of a run.
+
+    Each target is a (key, first, last, mz_start, mz_end) tuple. The quant scans from position first to last are part
+    of its XIC, and only their m/z between mz_start and mz_end is kept. Positions are visited in order with advance,
+    which starts every target that includes the position and returns the targets that ended before it. The scan at the
+    position is then given to add, which finds the m/z range of every started target in it with one search per bound,
+    however many targets share the scan.
+    """
+    def __init__(self, targets):
+        self.targets = sorted(targets, key=lambda x: x[1])
+        self.next_target = 0
+        self.active = OrderedDict()
+        self.ends = []
+        self.scans = {}
+        self.bounds = None
+
+    def advance(self, position):
+        """
+        Starts the targets that include position. Returns a list of (key, scans) of the targets that ended before it,
+        where scans is a dictionary of scan ids to the scans of the XIC.
+        """
+        while self.next_target < len(self.targets) and self.targets[self.next_target][1] <= position:
+            target = self.targets[self.next_target]
+            self.active[self.next_target] = target
+            self.scans[self.next_target] = {}
+            heapq.heappush(self.ends, (target[2], self.next_target))
+            self.next_target += 1
+            self.bounds = None
+        finished = []
+        while self.ends and self.ends[0][0] < position:
+            _, index = heapq.heappop(self.ends)
+            finished.append((self.active.pop(index)[0], self.scans.pop(index)))
+            self.bounds = None
+        return finished
+
+    def add(self, scan_id, scan):
+        if not self.active:
+            return
+        if scan is None:
+            # recorded, so the worker does not ask the reader for a scan that could not be read
+            for index in self.active:
+                self.scans[index][scan_id] = None
+            return
+        vals = scan['vals']
+        if len(vals) > 1 and (np.diff(vals[:, 0]) < 0).any():
+            # mz values can sometimes be not sorted
+            vals = vals[np.argsort(vals[:, 0], kind='mergesort')]
+        if self.bounds is None:
+            targets = list(six.itervalues(self.active))
+            self.bounds = (
+                list(self.active),
+                np.array([i[3] for i in targets], dtype=float),
+                np.array([i[4] for i in targets], dtype=float),
+            )
+        indices, mz_starts, mz_ends = self.bounds
+        lows = np.searchsorted(vals[:, 0], mz_starts, side='left')
+        highs = np.searchsorted(vals[:, 0], mz_ends, side='right')
+        for index, low, high in zip(indices, lows, highs):
+            xic_scan = dict(scan)
+            # copied, so the full scan is not held for as long as the XICs it is in
+            xic_scan['vals'] = vals[low:high].copy()
+            self.scans[index][scan_id] = xic_scan
+
+    def finish(self):
+        """
+        Returns the (key, scans) of every target that has not been returned yet.
+        """
+        return self.advance(float('inf'))
+
+
+class ScanSweep(Process):
+    """
+    Reads the quant scans of a raw file once, in order, and extracts the XIC of every target from them with a Sweep.
+    Scans that no target includes are not parsed. Each target is put on the outgoing queue with its scans once its
+    last scan is read, and None is put once every target is done. The queue is bounded, so the sweep waits for its
+    targets to be handed out rather than holding every XIC of the file. The process taking the targets should likewise
+    only take more once it has handed out most of the ones it has, see ready_tasks.
+    """
+    def __init__(self, raw_file, targets, run_map, calibration=None, rt_window=None, governor=None, queue_size=100):
+        super(ScanSweep, self).__init__()
+        self.raw_path = raw_file
+        self.targets = targets
+        self.run_map = run_map
+        self.calibration = calibration
+        self.rt_window = rt_window
+        self.governor = governor
+        self.queue_size = queue_size
+        self.outgoing = Queue(maxsize=queue_size)
+        # set in the process taking the targets once the sweep has put None
+        self.done = False
+
+    def run(self):
+        from pythomics.proteomics.parsers import GuessIterator
+        from .reader import read_scan
+
+        if self.governor is not None:
+            self.governor.apply()
+        raw = GuessIterator(self.raw_path, full=True, store=False)
+        sweep = Sweep(self.targets)
+        for position in six.moves.range(len(self.run_map)):
+            for finished in sweep.advance(position):
+                self.outgoing.put(finished)
+            if not sweep.active:
+                continue
+            scan_id = six.text_type(self.run_map.quant_ids[position])
+            sweep.add(scan_id, read_scan(raw, scan_id, calibration=self.calibration, rt_window=self.rt_window,
+                                         run_map=self.run_map))
+        for finished in sweep.finish():
+            self.outgoing.put(finished)
+        self.outgoing.put(None)
+        logger.info('Sweep done')
+
+    def ready_tasks(self, tasks, limit=None):
+        """
+        Returns the params in tasks whose XICs have been extracted since the last call, without waiting for any, with
+        the scans of the XIC under 'xic_scans'. At most limit are returned, and the rest are left with the sweep, which
+        stops once its queue is full. The params in tasks are not changed. done is set once every XIC has been
+        returned.
+        """
+        ready = []
+        while not self.done and (limit is None or len(ready) < limit):
+            try:
+                item = self.outgoing.get(block=False)
+            except Empty:
+                if self.is_alive():
+                    break
+                # the sweep may have exited right after putting its last target
+                try:
+                    item = self.outgoing.get(timeout=1)
+                except Empty:
+                    raise RuntimeError('The scan sweep of {} exited before every XIC was extracted.'.format(self.raw_path))
+            if item is None:
+                self.done = True
+                break
+            index, scans = item
+            ready.append(dict(tasks[index], xic_scans=scans))
+        return ready
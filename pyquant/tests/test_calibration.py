@@ -0,0 +1,38 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+from scipy.interpolate import UnivariateSpline
+
+from pyquant.calibration import MassCalibration
+
+
+class TestMassCalibration(TestCase):
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        random = np.random.RandomState(0)
+        self.observed = np.sort(random.uniform(400, 1200, 200))
+        self.errors = 3+self.observed/400+random.normal(0, 1, 200)
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_matches_spline(self):
+        calibration = MassCalibration.fit(self.observed, self.errors)
+        spline = UnivariateSpline(self.observed, self.errors, s=1e6)
+        mz = np.linspace(400, 1200, 1000)
+        np.testing.assert_allclose(calibration(mz), mz/(1-spline(mz)/1e6), rtol=1e-9)
+        self.assertAlmostEqual(calibration(500.), 500./(1-spline(500.)/1e6), places=6)
+
+    def test_too_few_points(self):
+        self.assertIsNone(MassCalibration.fit(self.observed[:10], self.errors[:10]))
+
+    def test_save(self):
+        path = os.path.join(self.out_dir, 'raw.calibration.npz')
+        calibration = MassCalibration.fit(self.observed, self.errors)
+        calibration.save(path, source=['raw', 10])
+        self.assertIsNone(MassCalibration.load(path, source=['raw', 11]))
+        loaded = MassCalibration.load(path, source=['raw', 10])
+        np.testing.assert_array_equal(loaded.factors, calibration.factors)
@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from pyquant.checkpoint import Checkpoint
+
+
+class TestCheckpoint(TestCase):
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.out_dir, 'out.checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_keys(self):
+        checkpoint = Checkpoint(self.path, mode='w')
+        checkpoint.append(('raw', 'PEPTIDE', '2', '100', 'None'))
+        checkpoint.append(('raw', 'PEPTIDE', '2', '100', 'None'))
+        checkpoint.flush()
+        checkpoint.close()
+        checkpoint = Checkpoint(self.path, mode='a')
+        self.assertIn(('raw', 'PEPTIDE', '2', '100', 'None'), checkpoint)
+        self.assertNotIn(('raw', 'PEPTIDE', '3', '100', 'None'), checkpoint)
+        self.assertEqual(len(checkpoint), 1)
+        checkpoint.close()
+        checkpoint = Checkpoint(self.path, mode='w')
+        self.assertEqual(len(checkpoint), 0)
+        checkpoint.remove()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_file_state(self):
+        checkpoint = Checkpoint(self.path, mode='w')
+        self.assertIsNone(checkpoint.get_file_state('raw'))
+        state = {'msn_map': [(1, '1'), (2, '2')], 'tasks': [(10.5, {'key': ('raw',)})]}
+        checkpoint.save_file_state('raw', state)
+        self.assertEqual(checkpoint.get_file_state('raw'), (state, False))
+        checkpoint.mark_complete('raw')
+        checkpoint.close()
+        checkpoint = Checkpoint(self.path, mode='a')
+        self.assertEqual(checkpoint.get_file_state('raw'), (state, True))
+        checkpoint.close()
+
+    def test_read(self):
+        self.assertRaises(IOError, Checkpoint, self.path, mode='r')
+        checkpoint = Checkpoint(self.path, mode='w')
+        checkpoint.append(('raw', 'PEPTIDE', '2', '100', 'None'))
+        checkpoint.save_file_state('raw', {'tasks': []})
+        checkpoint.close()
+        with open(self.path, 'rb') as checkpoint_file:
+            contents = checkpoint_file.read()
+        checkpoint = Checkpoint(self.path, mode='r')
+        self.assertIn(('raw', 'PEPTIDE', '2', '100', 'None'), checkpoint)
+        self.assertEqual(checkpoint.get_file_state('raw'), ({'tasks': []}, False))
+        checkpoint.close()
+        with open(self.path, 'rb') as checkpoint_file:
+            self.assertEqual(checkpoint_file.read(), contents)
@@ -0,0 +1,58 @@
+import multiprocessing
+import subprocess
+import sys
+from unittest import TestCase, skipIf
+
+from pyquant.command_line import wait_for_events
+
+
+def put_results(queue, results):
+    for i in results:
+        queue.put(i)
+
+
+class TestWaitForEvents(TestCase):
+    def test_results_after_exit(self):
+        result_queue = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(target=put_results, args=(result_queue, list(range(i*50, (i+1)*50))))
+            for i in range(2)
+        ]
+        for worker in workers:
+            worker.start()
+        # both workers exit with their results still waiting in the pipe
+        for worker in workers:
+            worker.join()
+
+        results = []
+        result = None
+        while workers or result is not None:
+            result, exited = wait_for_events(result_queue, workers, timeout=None if workers else 0)
+            workers = [i for i in workers if i not in exited]
+            if result is not None:
+                results.append(result)
+        self.assertEqual(sorted(results), list(range(100)))
+
+
+class TestStartup(TestCase):
+    def run_python(self, code):
+        # in a fresh interpreter, as the start method and the imported modules are global to a process
+        return subprocess.check_output([sys.executable, '-c', code]).decode('utf-8').strip()
+
+    @skipIf(not hasattr(multiprocessing, 'set_start_method'), 'start methods cannot be set in this version of python')
+    def test_set_start_method(self):
+        self.assertEqual(self.run_python(
+            'import multiprocessing\n'
+            'from pyquant.command_line import set_start_method\n'
+            'set_start_method("forkserver")\n'
+            'print(multiprocessing.get_start_method())'
+        ), 'forkserver')
+
+    def test_lazy_imports(self):
+        # the scientific stack and the raw file parsers are only imported once the arguments are parsed
+        self.assertEqual(self.run_python(
+            'import sys\n'
+            'import pyquant.command_line\n'
+            'heavy = ("numpy", "pandas", "scipy", "pythomics.proteomics.parsers", "pyquant.peaks", "pyquant.worker")\n'
+            'print(sorted(i for i in heavy if i in sys.modules))'
+        ), '[]')
@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from lxml import etree
+from pythomics.proteomics.parsers import GuessIterator
+
+from pyquant.export import MZML_NAMESPACE, MzmlExporter
+from pyquant.tests import mixins
+
+
+class TestMzmlExporter(mixins.FileMixins, TestCase):
+    def setUp(self):
+        super(TestMzmlExporter, self).setUp()
+        self.export_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.export_dir)
+
+    def test_export(self):
+        scan_ids = [i.id for i in GuessIterator(self.itraq_mzml, full=False, store=False)][:10]
+        raw = GuessIterator(self.itraq_mzml, full=True, store=False)
+        mapping = {
+            os.path.join(self.export_dir, 'first.mzML'): set(scan_ids[2:6]),
+            os.path.join(self.export_dir, 'second.mzML'): set(scan_ids[4:9]),
+        }
+        # exports are copied from the spool in chunks smaller than either of them
+        exporter = MzmlExporter(raw.parser, chunk_size=3)
+        self.assertEqual(exporter.export(mapping, threads=2), 2)
+        # overlapping scans are only read once
+        self.assertEqual(len(exporter.spectra), 7)
+        exporter.close()
+        for path, scans in mapping.items():
+            exported = GuessIterator(path, full=True, store=False)
+            self.assertEqual(sorted(i.id for i in GuessIterator(path, full=False, store=False)), sorted(scans))
+            # the index of the exported file points to its spectra
+            scan_id = sorted(scans)[-1]
+            self.assertEqual(exported.getScan(scan_id).rt, raw.getScan(scan_id).rt)
+            # spectra keep the order of the raw file, and are indexed by their position in the export
+            spectra = list(etree.parse(path).iter('{}spectrum'.format(MZML_NAMESPACE)))
+            self.assertEqual([i.get('index') for i in spectra], [str(i) for i in range(len(scans))])
+            self.assertEqual([i.id for i in GuessIterator(path, full=False, store=False)], [i for i in scan_ids if i in scans])
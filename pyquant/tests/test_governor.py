@@ -0,0 +1,33 @@
+import os
+from unittest import TestCase
+
+from pyquant.governor import Governor, THREAD_ENVIRONMENT, available_cores
+
+
+class TestGovernor(TestCase):
+    def setUp(self):
+        self.environment = {i: os.environ.get(i) for i in THREAD_ENVIRONMENT}
+
+    def tearDown(self):
+        for variable, value in self.environment.items():
+            if value is None:
+                os.environ.pop(variable, None)
+            else:
+                os.environ[variable] = value
+
+    def test_for_process(self):
+        cores = available_cores()
+        governor = Governor(native_threads=2, pin=True, memory_limit=10)
+        self.assertEqual(governor.for_process(0).cores, [cores[0]])
+        self.assertEqual(governor.for_process(len(cores)+1).cores, [cores[1 % len(cores)]])
+        self.assertEqual(governor.for_process(1).memory_limit, 10)
+        self.assertIsNone(Governor().for_process(1).cores)
+
+    def test_apply(self):
+        Governor(native_threads=3).apply()
+        self.assertEqual(os.environ['OMP_NUM_THREADS'], '3')
+
+    def test_memory_limit(self):
+        self.assertFalse(Governor().over_memory_limit())
+        self.assertTrue(Governor(memory_limit=1).over_memory_limit())
+        self.assertFalse(Governor(memory_limit=1024**4).over_memory_limit())
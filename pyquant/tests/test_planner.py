@@ -0,0 +1,56 @@
+from unittest import TestCase
+
+from pyquant.planner import (
+    READER_BASE_MEMORY, WORKER_BASE_MEMORY, distinct_scans, format_plan, merge_redundant_psms, plan_file, task_size,
+)
+from pyquant.runmap import RunMap
+
+
+def make_task(scan_id, rt, peptide='PEPTIDE', charge=2):
+    target_scan = {'id': scan_id, 'rt': rt, 'peptide': peptide, 'charge': charge, 'precursor': 400.2}
+    params = {
+        'scan_info': {'id_scan': target_scan, 'quant_scan': {'id': 'ms1_{}'.format(scan_id)}},
+        'key': ('raw', peptide, str(charge), scan_id, 'None'),
+    }
+    return rt, params
+
+
+class TestMergeRedundantPsms(TestCase):
+    def test_merge_by_rt(self):
+        tasks = [
+            make_task('1', 10.0), make_task('2', 10.2), make_task('3', 10.4), make_task('4', 20.0),
+            make_task('5', 10.05, charge=3), make_task('6', 10.1, peptide=''), make_task('7', 10.15, peptide=''),
+        ]
+        merged = merge_redundant_psms(tasks, 0.3)
+        self.assertEqual(
+            [(i[1]['key'][3], [j['scan'] for j in i[1].get('psms', [])]) for i in merged],
+            [('5', []), ('6', []), ('7', []), ('2', ['1', '3']), ('4', [])],
+        )
+        self.assertEqual(sum(task_size(i[1]) for i in merged), len(tasks))
+        psm = merged[3][1]['psms'][0]
+        self.assertEqual((psm['key'][3], psm['ms1'], psm['rt']), ('1', 'ms1_1', 10.0))
+
+
+class TestPlanFile(TestCase):
+    def setUp(self):
+        msn_map = [(1, str(i)) for i in range(100)]
+        self.run_map = RunMap(msn_map, {str(i): i/10. for i in range(100)}, quant_level=1)
+        self.tasks = [make_task(str(i), i/10.) for i in (10, 12, 80)]
+        for rt, params in self.tasks:
+            params['scan_info']['quant_scan']['id'] = params['scan_info']['id_scan']['id']
+
+    def tearDown(self):
+        self.run_map.remove()
+
+    def test_distinct_scans(self):
+        # windows of 5 scans on either side, the first two overlap
+        self.assertEqual(distinct_scans(self.run_map, self.tasks, xic_window_size=5), 13+11)
+
+    def test_plan_file(self):
+        plan = plan_file('raw', self.tasks, self.run_map, scan_bytes=1000, task_bytes=100, xic_window_size=5, cpus=8)
+        self.assertEqual((plan['targets'], plan['scan_fetches'], plan['reader_cache_bytes']), (3, 33, 24000))
+        self.assertEqual(plan['workers'], 3)
+        plan = plan_file('raw', self.tasks*10, self.run_map, scan_bytes=1000, task_bytes=100, cpus=8,
+                         memory=READER_BASE_MEMORY+WORKER_BASE_MEMORY*2.5)
+        self.assertEqual(plan['workers'], 2)
+        self.assertIn('Suggested split: 1 reader, 2 workers', format_plan(plan))
@@ -20,14 +20,15 @@ class TestReader(mixins.FileMixins, TestCase):
         reader = Reader(self.input, output, raw_file=self.ecoli_mzml)
         reader.start()
         queue = output[0]
-        self.input.put((0, '80', 0, 10000))
-        # Test we get the scan
-        scan = queue.get()
+        self.input.put((0, '80', 0, 10000, 1))
+        # Test we get the scan, along with the id of the request
+        request_id, scan = queue.get()
+        self.assertEqual(request_id, 1)
         self.assertEqual(scan['title'], '80')
         # test we get a subset
         mz_min, mz_max = scan['vals'][300, 0], scan['vals'][500, 0]
-        self.input.put((0, '80', mz_min, mz_max))
-        scan = queue.get()
+        self.input.put((0, '80', mz_min, mz_max, 2))
+        _, scan = queue.get()
         self.assertTrue(scan['vals'][0, 0] >= mz_min)
         self.assertTrue(scan['vals'][-1, 0] <= mz_max)
 
@@ -40,15 +41,15 @@ class TestReader(mixins.FileMixins, TestCase):
         # test that we can get scans that have been deleted
         reader = Reader(self.input, output, raw_file=self.ecoli_mzml, timeout_minutes=0.01)
         reader.start()
-        self.input.put((0, '80', 0, 10000))
-        self.input.put((0, '81', 0, 10000))
-        scan = queue.get()
-        scan = queue.get()
+        self.input.put((0, '80', 0, 10000, 1))
+        self.input.put((0, '81', 0, 10000, 2))
+        _, scan = queue.get()
+        _, scan = queue.get()
         time.sleep(1)
         # accessing 81 should cause 80 to be deleted
-        self.input.put((0, '81', 0, 10000))
-        scan = queue.get()
+        self.input.put((0, '81', 0, 10000, 2))
+        _, scan = queue.get()
         # make sure we can get it back
-        self.input.put((0, '80', 0, 10000))
-        scan = queue.get()
+        self.input.put((0, '80', 0, 10000, 1))
+        _, scan = queue.get()
         self.assertEqual(scan['title'], '80')
\ No newline at end of file
@@ -0,0 +1,48 @@
+import base64
+import json
+import os
+import shutil
+import tempfile
+import zlib
+from unittest import TestCase
+
+from pyquant.report import HtmlReport
+
+
+class TestHtmlReport(TestCase):
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.out_dir, 'out.html')
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def read_chunk(self, index):
+        with open(os.path.join('{}_data'.format(self.path), 'chunk_{}.js'.format(index)), 'r') as chunk_file:
+            content = chunk_file.read()
+        self.assertTrue(content.startswith('pyquantChunk({}, "'.format(index)))
+        payload = content.split('"')[1]
+        return json.loads(zlib.decompress(base64.b64decode(payload)).decode('utf-8'))
+
+    def test_chunks(self):
+        report = HtmlReport(self.path, title='test', headers=['Raw File', 'Peptide'], peak_header=['Peak Area'], chunk_size=2)
+        for i in range(5):
+            report.write_row(['raw', 'PEPTIDE{}'.format(i)], html={'xic': [i]}, peaks=[[i]])
+        report.close()
+        self.assertEqual(sorted(os.listdir('{}_data'.format(self.path))), ['chunk_0.js', 'chunk_1.js', 'chunk_2.js'])
+        self.assertEqual(self.read_chunk(1), {'html': [{'xic': [2]}, {'xic': [3]}], 'peaks': [[[2]], [[3]]]})
+        self.assertEqual(self.read_chunk(2), {'html': [{'xic': [4]}], 'peaks': [[[4]]]})
+        with open(self.path, 'r') as html:
+            content = html.read()
+        self.assertIn('<td>PEPTIDE4</td>', content)
+        self.assertIn('var chunk_size = 2;', content)
+        self.assertIn('var data_dir = "out.html_data";', content)
+        self.assertIn('var peak_header = ["Peak Area"];', content)
+
+    def test_old_chunks_are_removed(self):
+        for chunk_size in (1, 10):
+            report = HtmlReport(self.path, title='test', headers=['Peptide'], peak_header=[], chunk_size=chunk_size)
+            for i in range(3):
+                report.write_row(['PEPTIDE'])
+            report.close()
+        self.assertEqual(os.listdir('{}_data'.format(self.path)), ['chunk_0.js'])
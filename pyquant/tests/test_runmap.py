@@ -0,0 +1,78 @@
+import pickle
+from multiprocessing import Process
+from unittest import TestCase
+
+from pyquant.runmap import RunMap, RTWindows, ScanMask
+
+
+def skip_scan(scan_mask, scan_id):
+    scan_mask.add(scan_id)
+
+
+class TestRunMap(TestCase):
+    def setUp(self):
+        msn_map = [(1, '1'), (2, '2'), (1, '3'), (2, '4'), (1, '10')]
+        msn_rt_map = {'1': 0.5, '2': 0.6, '3': 0.7, '4': 0.8, '10': 0.9}
+        self.run_map = RunMap(msn_map, msn_rt_map, quant_level=1, excluded=['3', '4'])
+
+    def tearDown(self):
+        self.run_map.remove()
+
+    def test_excluded(self):
+        self.assertTrue(self.run_map.excluded('3'))
+        self.assertFalse(self.run_map.excluded('1'))
+        # only quant scans are tracked
+        self.assertFalse(self.run_map.excluded('4'))
+
+    def test_quant_map(self):
+        self.assertEqual(len(self.run_map), 3)
+        self.assertEqual(self.run_map.find_scan('3'), '3')
+        self.assertIsNone(self.run_map.find_scan('2'))
+        self.assertEqual(self.run_map.find_prior_scan('10'), '3')
+        self.assertEqual(self.run_map.find_next_scan('3'), '10')
+        self.assertIsNone(self.run_map.find_prior_scan('1'))
+        self.assertIsNone(self.run_map.find_next_scan('10'))
+        self.assertEqual(self.run_map.quant_map(), [(1.0, '1'), (1.0, '3'), (1.0, '10')])
+
+    def test_rt_map(self):
+        self.assertEqual(self.run_map.next_rt(0.6), 0.7)
+        self.assertIsNone(self.run_map.next_rt(0.9))
+        self.assertEqual(self.run_map.scan_at_rt(0.8), '4')
+        self.assertIsNone(self.run_map.scan_at_rt(0.85))
+
+    def test_pickle_maps_arrays(self):
+        payload = pickle.dumps(self.run_map)
+        # only the location of the arrays is sent to workers
+        self.assertLess(len(payload), 200)
+        run_map = pickle.loads(payload)
+        self.assertEqual(run_map.find_prior_scan('3'), '1')
+        self.assertEqual(run_map.rts.tolist(), [0.5, 0.6, 0.7, 0.8, 0.9])
+
+
+class TestRTWindows(TestCase):
+    def test_contains(self):
+        windows = [(5, 7), (1, 3), (2, 4), (4, 5)]
+        rt_windows = RTWindows(windows)
+        self.assertEqual(rt_windows.starts.tolist(), [1, 4, 5])
+        for rt in (0, 1, 1.5, 3, 4, 4.5, 5, 6.9, 7, 8):
+            self.assertEqual(rt in rt_windows, any(i[0] < rt < i[1] for i in windows), rt)
+
+
+class TestScanMask(TestCase):
+    def setUp(self):
+        self.run_map = RunMap([(1, '1'), (2, '2'), (1, '3')], {'1': 0.5, '2': 0.6, '3': 0.7}, quant_level=1)
+
+    def tearDown(self):
+        self.run_map.remove()
+
+    def test_shared_between_processes(self):
+        scan_mask = ScanMask(self.run_map)
+        process = Process(target=skip_scan, args=(scan_mask, '3'))
+        process.start()
+        process.join()
+        self.assertIn('3', scan_mask)
+        self.assertNotIn('1', scan_mask)
+        # scans that are not quantified cannot be skipped
+        scan_mask.add('2')
+        self.assertNotIn('2', scan_mask)
+        self.assertEqual(len(scan_mask), 1)
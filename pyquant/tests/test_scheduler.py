@@ -0,0 +1,189 @@
+from unittest import TestCase
+
+from pyquant.scheduler import Autoscaler, TaskScheduler, estimate_task_cost
+
+
+class TestTaskScheduler(TestCase):
+    def drain(self, queue, count):
+        return [queue.get(timeout=1) for _ in range(count)]
+
+    def test_bounded(self):
+        produced = []
+
+        def tasks():
+            for i in range(5):
+                produced.append(i)
+                yield {'index': i}
+
+        scheduler = TaskScheduler(tasks(), max_in_flight=2)
+        queues = [scheduler.add_worker(i) for i in range(2)]
+        scheduler.start()
+        # only the tasks that fit in the queues have been produced
+        self.assertEqual(len(produced), 4)
+        first = [i[0] for i in self.drain(queues[0], 2)]
+        self.assertEqual([i['index'] for i in first], [0, 1])
+        self.assertTrue(scheduler.complete(first[0]['task_id']))
+        self.assertFalse(scheduler.complete(first[0]['task_id']))
+        self.assertEqual(self.drain(queues[0], 1)[0][0]['index'], 4)
+        self.assertEqual(len(produced), 5)
+        # the worker is told to exit once there is nothing left for it
+        scheduler.complete(first[1]['task_id'])
+        self.assertIsNone(self.drain(queues[0], 1)[0])
+        self.assertEqual(scheduler.outstanding, 3)
+
+    def test_dead_worker_tasks_are_requeued(self):
+        scheduler = TaskScheduler(({'index': i} for i in range(3)), max_in_flight=2)
+        queue = scheduler.add_worker(0)
+        scheduler.start()
+        lost = self.drain(queue, 2)
+        queue = scheduler.add_worker(0)
+        scheduler.fill(0)
+        self.assertEqual([i[0]['index'] for i in self.drain(queue, 2)], [0, 1])
+        # requeued tasks keep their ids
+        self.assertTrue(scheduler.complete(lost[0][0]['task_id']))
+        self.assertEqual(self.drain(queue, 1)[0][0]['index'], 2)
+
+    def test_failed_tasks_are_retried_then_quarantined(self):
+        scheduler = TaskScheduler(({'index': i} for i in range(3)), max_in_flight=2)
+        queue = scheduler.add_worker(0)
+        scheduler.start()
+        self.drain(queue, 2)
+        self.assertIsNone(scheduler.fail_worker(0, 'crash'))
+        queue = scheduler.add_worker(0)
+        scheduler.fill(0)
+        retried, requeued = [i[0] for i in self.drain(queue, 2)]
+        self.assertEqual((retried['index'], retried.get('fast_fit')), (0, True))
+        self.assertEqual((requeued['index'], requeued.get('fast_fit')), (1, None))
+        task = scheduler.fail_worker(0, 'timeout')
+        self.assertEqual((task['index'], task['failure']), (0, 'timeout'))
+        self.assertEqual(scheduler.quarantined, [task])
+        self.assertFalse(scheduler.complete(task['task_id']))
+        queue = scheduler.add_worker(0)
+        scheduler.fill(0)
+        self.assertEqual([i[0]['index'] for i in self.drain(queue, 2)], [1, 2])
+
+    def test_timed_out(self):
+        scheduler = TaskScheduler(({'index': i} for i in range(3)), max_in_flight=1)
+        queues = [scheduler.add_worker(i) for i in range(2)]
+        scheduler.start()
+        now = scheduler.last_activity[0]
+        self.assertEqual(scheduler.timed_out(10, now=now+5), [])
+        scheduler.complete(self.drain(queues[1], 1)[0][0]['task_id'])
+        scheduler.last_activity[1] = now+8
+        self.assertEqual(scheduler.timed_out(10, now=now+11), [0])
+
+    def test_retire(self):
+        scheduler = TaskScheduler(({'index': i} for i in range(6)), max_in_flight=1)
+        queues = [scheduler.add_worker(i) for i in range(2)]
+        scheduler.start()
+        scheduler.retire(1)
+        last = self.drain(queues[1], 2)
+        self.assertIsNone(last[1])
+        # the retired worker's task still counts, and nothing more is sent to it
+        self.assertTrue(scheduler.complete(last[0][0]['task_id']))
+        self.assertTrue(queues[1].empty())
+        self.assertTrue(scheduler.pending)
+
+    def test_expensive_tasks_first(self):
+        costs = [1, 1, 10, 1, 20, 1]
+        scheduler = TaskScheduler(({'index': i, 'c': v} for i, v in enumerate(costs)), max_in_flight=3, cost=lambda x: x['c'])
+        queue = scheduler.add_worker(0)
+        scheduler.start()
+        self.assertEqual([[j['index'] for j in i] for i in self.drain(queue, 3)], [[4], [2], [0]])
+
+    def test_chunks(self):
+        scheduler = TaskScheduler(
+            ({'index': i} for i in range(10)), max_in_flight=1, cost=lambda x: 1, chunk_seconds=0.3,
+        )
+        queue = scheduler.add_worker(0)
+        scheduler.start()
+        # nothing is known about how long tasks take, so the first is sent alone
+        item = self.drain(queue, 1)[0]
+        self.assertEqual(len(item), 1)
+        scheduler.complete(item[0]['task_id'], elapsed=0.1)
+        self.assertEqual([i['index'] for i in self.drain(queue, 1)[0]], [1, 2, 3])
+
+    def test_rt_bands(self):
+        scheduler = TaskScheduler(({'index': i} for i in range(10)), max_in_flight=1, rt_bands=True)
+        queues = [scheduler.add_worker(i) for i in range(2)]
+        scheduler.start()
+        self.assertEqual(self.drain(queues[0], 1)[0][0]['index'], 0)
+        second = self.drain(queues[1], 1)[0][0]
+        self.assertEqual(second['index'], 5)
+        for index in range(6, 10):
+            scheduler.complete(second['task_id'])
+            second = self.drain(queues[1], 1)[0][0]
+            self.assertEqual(second['index'], index)
+        # the second band is finished, so the later half of the first band is taken
+        scheduler.complete(second['task_id'])
+        self.assertEqual(self.drain(queues[1], 1)[0][0]['index'], 3)
+
+    def test_window(self):
+        scheduler = TaskScheduler(({'index': i} for i in range(6)), max_in_flight=1, window=2)
+        queues = [scheduler.add_worker(i) for i in range(3)]
+        scheduler.start()
+        first, second = [self.drain(queues[i], 1)[0][0] for i in range(2)]
+        self.assertEqual((first['order'], second['order']), (0, 1))
+        # the third worker waits until the first task is done
+        self.assertTrue(queues[2].empty())
+        scheduler.complete(second['task_id'])
+        self.assertTrue(queues[2].empty())
+        scheduler.complete(first['task_id'])
+        self.assertEqual([self.drain(queues[i], 1)[0][0]['order'] for i in range(2)], [2, 3])
+        self.assertTrue(queues[2].empty())
+
+    def test_extend(self):
+        scheduler = TaskScheduler(max_in_flight=1)
+        queues = [scheduler.add_worker(i) for i in range(2)]
+        scheduler.start()
+        # workers wait for tasks rather than being stopped
+        self.assertTrue(scheduler.pending)
+        self.assertTrue(queues[0].empty())
+        scheduler.extend([{'index': 0}])
+        first = self.drain(queues[0], 1)[0][0]
+        self.assertEqual((first['index'], first['order']), (0, 0))
+        self.assertTrue(queues[1].empty())
+        scheduler.close()
+        self.assertIsNone(self.drain(queues[1], 1)[0])
+        scheduler.complete(first['task_id'])
+        self.assertIsNone(self.drain(queues[0], 1)[0])
+        self.assertFalse(scheduler.pending)
+
+    def test_queued(self):
+        scheduler = TaskScheduler(max_in_flight=1)
+        queue = scheduler.add_worker(0)
+        scheduler.start()
+        scheduler.extend([{'index': i} for i in range(3)])
+        # the worker has one, and the other two wait in the scheduler
+        self.assertEqual(scheduler.queued, 2)
+        scheduler.complete(self.drain(queue, 1)[0][0]['task_id'])
+        self.assertEqual(scheduler.queued, 1)
+        self.assertEqual(TaskScheduler([{'index': 0}]).queued, 0)
+
+    def test_estimate_task_cost(self):
+        task = {'scan_info': {'id_scan': {}, 'quant_scan': {}}}
+        base = estimate_task_cost(task, label_count=2)
+        self.assertEqual(estimate_task_cost(task, label_count=4), base*2)
+        task['scan_info']['quant_scan']['scans'] = list(range(500))
+        self.assertEqual(estimate_task_cost(task, label_count=2), base*10)
+
+
+class TestAutoscaler(TestCase):
+    def test_decide(self):
+        autoscaler = Autoscaler(min_workers=1, max_workers=4, interval=10)
+        now = autoscaler.last_decision
+        autoscaler.observe({'elapsed': 1, 'reader_wait': 0.1, 'finished': now}, now=now)
+        # nothing changes until the interval has passed
+        self.assertEqual(autoscaler.decide(2, True, now=now+5), 0)
+        self.assertEqual(autoscaler.decide(2, True, now=now+10), 1)
+        # the fitting bound run has no work left to hand out
+        autoscaler.observe({'elapsed': 1, 'reader_wait': 0.1, 'finished': now+15}, now=now+15)
+        self.assertEqual(autoscaler.decide(2, False, now=now+20), 0)
+        # workers waiting on the reader
+        autoscaler.observe({'elapsed': 1, 'reader_wait': 0.8, 'finished': now+25}, now=now+25)
+        self.assertEqual(autoscaler.decide(2, True, now=now+30), -1)
+        # results waiting on the main process
+        autoscaler.observe({'elapsed': 1, 'reader_wait': 0, 'finished': now+31}, now=now+35)
+        self.assertEqual(autoscaler.decide(2, True, now=now+40), -1)
+        autoscaler.observe({'elapsed': 1, 'reader_wait': 0.8, 'finished': now+45}, now=now+45)
+        self.assertEqual(autoscaler.decide(1, True, now=now+50), 0)
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from pyquant.store import RecordStore
+
+
+class TestRecordStore(TestCase):
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.out_dir, 'store')
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def write_records(self, count, mode='w'):
+        store = RecordStore(self.path, mode=mode)
+        for i in range(count):
+            store.append({'index': i, 'value': np.float64(i) / 3, 'html': {'xic': [i] * i}})
+        store.close()
+
+    def test_scan_and_random_access(self):
+        self.write_records(10)
+        store = RecordStore(self.path)
+        self.assertEqual(len(store), 10)
+        self.assertEqual([i['index'] for i in store], list(range(10)))
+        self.assertEqual(store[7]['value'], np.float64(7) / 3)
+        self.assertEqual(store[-1]['html'], {'xic': [9] * 9})
+        store.close()
+
+    def test_append(self):
+        self.write_records(3)
+        self.write_records(2, mode='a')
+        store = RecordStore(self.path)
+        self.assertEqual([i['index'] for i in store], [0, 1, 2, 0, 1])
+        store.close()
+
+    def test_truncate(self):
+        self.write_records(5)
+        store = RecordStore(self.path, mode='a')
+        store.truncate(3)
+        store.append({'index': 5})
+        store.close()
+        store = RecordStore(self.path)
+        self.assertEqual([i['index'] for i in store], [0, 1, 2, 5])
+        self.assertEqual(store[3], {'index': 5})
+        store.close()
+
+    def test_incomplete_record_is_dropped(self):
+        self.write_records(3)
+        # simulate a crash while the last record was being written, and before its offset was indexed
+        with open(self.path, 'r+b') as handle:
+            handle.seek(-5, os.SEEK_END)
+            handle.truncate()
+        with open('{}.idx'.format(self.path), 'r+b') as handle:
+            handle.seek(-8, os.SEEK_END)
+            handle.truncate()
+        store = RecordStore(self.path, mode='a')
+        self.assertEqual(len(store), 2)
+        store.append({'index': 3})
+        self.assertEqual([i['index'] for i in store], [0, 1, 3])
+        store.close()
+
+    def test_missing_index_is_rebuilt(self):
+        self.write_records(4)
+        os.remove('{}.idx'.format(self.path))
+        store = RecordStore(self.path)
+        self.assertEqual(store[3]['index'], 3)
+        store.close()
+
+    def test_remove(self):
+        self.write_records(1)
+        RecordStore(self.path, mode='a').remove()
+        self.assertEqual(os.listdir(self.out_dir), [])
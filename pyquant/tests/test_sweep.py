@@ -0,0 +1,67 @@
+from unittest import TestCase
+
+import numpy as np
+
+from pyquant.sweep import ScanSweep, Sweep
+
+
+class TestSweep(TestCase):
+    def get_scan(self, position):
+        mz = np.array([100., 200., 300., 400., 500.])
+        return {'vals': np.column_stack([mz, mz+position]), 'rt': float(position)}
+
+    def test_sweep(self):
+        sweep = Sweep([('b', 2, 4, 150, 300), ('a', 0, 2, 350, 600), ('c', 6, 7, 0, 1000)])
+        finished = []
+        for position in range(6):
+            finished.extend(sweep.advance(position))
+            sweep.add(str(position), self.get_scan(position))
+        finished.extend(sweep.finish())
+        self.assertEqual([i[0] for i in finished], ['a', 'b', 'c'])
+        scans = dict(finished)
+        self.assertEqual(sorted(scans['a']), ['0', '1', '2'])
+        np.testing.assert_array_equal(scans['a']['1']['vals'][:, 0], [400, 500])
+        np.testing.assert_array_equal(scans['a']['1']['vals'][:, 1], [401, 501])
+        self.assertEqual(sorted(scans['b']), ['2', '3', '4'])
+        np.testing.assert_array_equal(scans['b']['4']['vals'][:, 0], [200, 300])
+        self.assertEqual(scans['c'], {})
+
+    def test_unsorted_scan(self):
+        sweep = Sweep([('a', 0, 0, 150, 350)])
+        sweep.advance(0)
+        sweep.add('0', {'vals': np.array([[300., 3.], [100., 1.], [200., 2.]])})
+        np.testing.assert_array_equal(sweep.finish()[0][1]['0']['vals'], [[200, 2], [300, 3]])
+
+    def test_missing_scan(self):
+        sweep = Sweep([('a', 0, 1, 150, 350)])
+        sweep.advance(0)
+        sweep.add('0', None)
+        sweep.advance(1)
+        sweep.add('1', self.get_scan(1))
+        scans = sweep.finish()[0][1]
+        # the worker reads the scan as missing rather than requesting it
+        self.assertEqual(sorted(scans), ['0', '1'])
+        self.assertIsNone(scans['0'])
+
+    def test_ready_tasks(self):
+        sweep = ScanSweep('raw', [], None)
+        sweep.outgoing.put((1, {'1': {'rt': 1.0}}))
+        sweep.outgoing.put(None)
+        tasks = [{'key': 'a'}, {'key': 'b'}]
+        self.assertEqual(sweep.ready_tasks(tasks), [{'key': 'b', 'xic_scans': {'1': {'rt': 1.0}}}])
+        self.assertTrue(sweep.done)
+        self.assertEqual(tasks[1], {'key': 'b'})
+        # a sweep that exited without finishing is an error
+        self.assertRaises(RuntimeError, ScanSweep('raw', [], None).ready_tasks, tasks)
+
+    def test_ready_tasks_limit(self):
+        sweep = ScanSweep('raw', [], None)
+        for index in range(2):
+            sweep.outgoing.put((index, {}))
+        sweep.outgoing.put(None)
+        tasks = [{'key': 'a'}, {'key': 'b'}]
+        # the rest are left with the sweep
+        self.assertEqual([i['key'] for i in sweep.ready_tasks(tasks, limit=1)], ['a'])
+        self.assertFalse(sweep.done)
+        self.assertEqual([i['key'] for i in sweep.ready_tasks(tasks, limit=5)], ['b'])
+        self.assertTrue(sweep.done)
@@ -130,6 +130,12 @@ class UtilsTests(GaussianMixin, unittest.TestCase):
         merged = utils.merge_close_peaks(np.array([]), ty, distance=6)
         np.testing.assert_array_equal(merged, np.array([]))
 
+    def test_mono_ratio(self):
+        self.assertEqual(utils.mono_ratio({0: 1000, 1: 800}, {0: 500, 1: 400}), 2)
+        # the ratio of the fourth isotope is an outlier, and the fifth is under 15% of the fourth
+        ratio = utils.mono_ratio({0: 1000, 1: 850, 2: 620, 3: 5000, 4: 700}, {0: 1000, 1: 800, 2: 600, 3: 1000, 4: 700})
+        self.assertAlmostEqual(ratio, (1 + 850/800. + 620/600.)/3)
+
     def test_get_formatted_mass(self):
         self.assertEqual(utils.get_formatted_mass('0.123'), utils.get_formatted_mass(0.123))
         self.assertEqual(utils.get_formatted_mass('0.12300'), utils.get_formatted_mass(0.123))
@@ -183,6 +189,14 @@ class UtilsTests(GaussianMixin, unittest.TestCase):
         resolution = utils.get_scan_resolution(scan)
         self.assertAlmostEqual(resolution, 90781.241173982111)
 
+    def test_get_scan_resolution_tuple(self):
+        with open(os.path.join(self.data_dir, 'peak_data.pickle'), 'rb') as peak_file:
+            data = pickle.load(peak_file, encoding='latin1') if six.PY3 else pickle.load(peak_file)
+        x, y = data['low_res_scan']
+        resolution = utils.get_scan_resolution((np.asarray(x), np.asarray(y)))
+        self.assertEqual(resolution, utils.get_scan_resolution(pd.Series(y, index=x)))
+        self.assertAlmostEqual(int(resolution), 30459)
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,68 @@
+from unittest import TestCase
+
+import numpy as np
+
+from pyquant import pyquant_parser
+from pyquant.worker import Worker, envelope_key
+
+
+class TestConvertScan(TestCase):
+    def test_convert_scan(self):
+        worker = Worker(raw_name='raw.mzML', parser_args=pyquant_parser.parse_args([]), precision=2)
+        scan = {'vals': np.array([[300.0, 3.], [100.001, 1.], [200.0, 2.], [100.004, 4.], [100.0, 5.]]), 'rt': 1.5}
+        mz, intensities, name = worker.convertScan(scan)
+        # points that round to the same m/z are summed
+        np.testing.assert_array_equal(mz, [100.0, 200.0, 300.0])
+        np.testing.assert_array_equal(intensities, [10., 2., 3.])
+        self.assertEqual(intensities.dtype, float)
+        self.assertEqual(name, 1.5)
+        self.assertIsNone(worker.convertScan({'vals': np.zeros((0, 2)), 'rt': 1.5}))
+
+
+class TestEnvelopeCache(TestCase):
+    def setUp(self):
+        # three isotopes of a doubly charged ion, each a peak a few readings wide
+        self.xdata = np.arange(499.0, 502.5, 0.005)
+        self.ydata = np.zeros_like(self.xdata)
+        for isotope, height in enumerate([1000., 600., 250.]):
+            center = 500.0+isotope*1.00335/2
+            self.ydata += height*np.exp(-(self.xdata-center)**2/(2*0.002**2))
+        self.search = dict(measured_mz=500.0, theo_mz=500.0, charge=2, precursor_ppm=10, isotope_ppm=10)
+
+    def get_worker(self, envelope_cache_size):
+        return Worker(raw_name='raw.mzML', parser_args=pyquant_parser.parse_args([]),
+                      envelope_cache_size=envelope_cache_size)
+
+    def get_key(self, scan, last_precursor, fragment_scan):
+        return envelope_key(scan, (495., 507.), 500.0, 500.0, None, 2, None, 'Light', set([]), last_precursor,
+                            fragment_scan, False)
+
+    def find_envelope(self, worker, scan, last_precursor, fragment_scan):
+        envelope = worker.find_envelope(
+            self.get_key(scan, last_precursor, fragment_scan), self.xdata, self.ydata, last_precursor=last_precursor,
+            fragment_scan=fragment_scan, **self.search
+        )
+        # as quantify_peaks does
+        for isotope, vals in envelope['micro_envelopes'].items():
+            vals['isotope'] = isotope
+        return envelope
+
+    def test_initial_scan_hit(self):
+        worker = self.get_worker(10)
+        # the initial scan is searched from the measured precursor, and later from the precursor fitted in it
+        first = self.find_envelope(worker, '1', 500.0, True)
+        second = self.find_envelope(worker, '1', 500.0004, True)
+        self.assertEqual(len(worker.envelope_cache), 1)
+        self.assertIsNot(second, first)
+        np.testing.assert_equal(second, first)
+        # other scans are searched from the precursor last fitted
+        self.assertNotEqual(self.get_key('2', 500.0, False), self.get_key('2', 500.0004, False))
+
+    def test_cache_matches_uncached(self):
+        searches = [('1', 500.0, True), ('2', 500.0004, False), ('1', 500.0004, True), ('2', 500.0004, False),
+                    ('2', 500.0008, False), ('3', 500.0, False), ('1', 500.0, True)]
+        cached = self.get_worker(2)
+        uncached = self.get_worker(0)
+        for search in searches:
+            np.testing.assert_equal(self.find_envelope(cached, *search), self.find_envelope(uncached, *search))
+        self.assertEqual(len(uncached.envelope_cache), 0)
@@ -0,0 +1,186 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase, skipIf
+
+from pyquant.writer import ReorderBuffer, ResultWriter, TextSink, ColumnarSink, FLOAT, STRING, ARROW, PARQUET, truncate_lines
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+class TestResultWriter(TestCase):
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.out = open(os.path.join(self.out_dir, 'out'), 'w')
+        self.tmp = open(os.path.join(self.out_dir, 'out.tmp'), 'w')
+
+    def tearDown(self):
+        self.out.close()
+        self.tmp.close()
+        shutil.rmtree(self.out_dir)
+
+    def read(self, handle):
+        with open(handle.name, 'r') as f:
+            return f.read()
+
+    def get_writer(self, **kwargs):
+        writer = ResultWriter(
+            [TextSink(self.out, formatter=lambda x: '{}\n'.format(x)), TextSink(self.tmp, formatter=lambda x: 'tmp {}\n'.format(x))],
+            **kwargs
+        )
+        writer.start()
+        return writer
+
+    def test_writes_in_order(self):
+        writer = self.get_writer(batch_size=3, flush_interval=60)
+        for i in range(10):
+            writer.put(i)
+        writer.close()
+        self.assertEqual(self.read(self.out), ''.join('{}\n'.format(i) for i in range(10)))
+        self.assertEqual(self.read(self.tmp), ''.join('tmp {}\n'.format(i) for i in range(10)))
+
+    def test_flush_interval(self):
+        writer = self.get_writer(batch_size=100, flush_interval=0.05)
+        writer.put(1)
+        time.sleep(0.5)
+        self.assertEqual(self.read(self.out), '1\n')
+        self.assertEqual(self.read(self.tmp), 'tmp 1\n')
+        writer.close()
+
+    def test_flush_interval_after_idle(self):
+        writer = self.get_writer(batch_size=100, flush_interval=1)
+        time.sleep(1.2)
+        writer.put(1)
+        writer.put(2)
+        time.sleep(0.2)
+        # the interval counts from the first record, not from when the writer was last idle
+        self.assertEqual(self.read(self.out), '')
+        time.sleep(1.3)
+        self.assertEqual(self.read(self.out), '1\n2\n')
+        writer.close()
+
+    def test_put_all(self):
+        batches = []
+
+        class BatchSink(object):
+            def __init__(self):
+                self.batch = []
+
+            def write(self, record):
+                self.batch.append(record)
+
+            def flush(self, durable=False):
+                batches.append(self.batch)
+                self.batch = []
+
+            def close(self):
+                pass
+
+        writer = ResultWriter([BatchSink()], batch_size=2, flush_interval=60)
+        writer.start()
+        writer.put(1)
+        writer.put_all([2, 3])
+        writer.put_all([4, 5, 6])
+        writer.put(7)
+        writer.close()
+        # the records put together are never split between batches, even past the batch size
+        self.assertEqual(batches, [[1, 2, 3], [4, 5, 6], [7]])
+
+    def test_flush(self):
+        writer = self.get_writer(batch_size=100, flush_interval=60)
+        writer.put(1)
+        writer.put(2)
+        writer.flush()
+        self.assertEqual(self.read(self.out), '1\n2\n')
+        self.assertEqual(self.read(self.tmp), 'tmp 1\ntmp 2\n')
+        writer.close()
+
+    def test_durable(self):
+        writer = self.get_writer(batch_size=100, flush_interval=60, durable=True)
+        writer.put(1)
+        # durable writes are on disk as soon as put returns
+        self.assertEqual(self.read(self.out), '1\n')
+        self.assertEqual(self.read(self.tmp), 'tmp 1\n')
+        writer.close()
+
+    def test_truncate_lines(self):
+        self.out.write('header\n1\n2\n3\n')
+        self.out.close()
+        self.assertEqual(truncate_lines(self.out.name, 2), 2)
+        self.assertEqual(self.read(self.out), 'header\n1\n')
+        self.assertEqual(truncate_lines(self.out.name, 5), 0)
+        self.assertEqual(self.read(self.out), 'header\n1\n')
+
+    def test_errors_are_raised(self):
+        def bad_formatter(x):
+            raise ValueError('bad record')
+        writer = ResultWriter([TextSink(self.out, formatter=bad_formatter)], batch_size=1)
+        writer.start()
+        writer.put(1)
+        with self.assertRaises(ValueError):
+            writer.close()
+
+
+class TestReorderBuffer(TestCase):
+    def test_put(self):
+        written = []
+
+        class Writer(object):
+            def put_all(self, records):
+                written.append(records)
+
+        reorder_buffer = ReorderBuffer(Writer())
+        reorder_buffer.put(2, ['c'])
+        reorder_buffer.put(1, ['b1', 'b2'])
+        self.assertEqual((written, len(reorder_buffer)), ([], 2))
+        reorder_buffer.skip(3)
+        reorder_buffer.put(0, ['a'])
+        self.assertEqual((written, len(reorder_buffer)), ([['a'], ['b1', 'b2'], ['c']], 0))
+
+
+@skipIf(pyarrow is None, 'pyarrow is not installed')
+class TestColumnarSink(TestCase):
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def write(self, file_format):
+        path = os.path.join(self.out_dir, 'out.{}'.format(file_format))
+        sink = ColumnarSink(
+            path,
+            [('Peptide', STRING), ('Light Intensity', FLOAT)],
+            formatter=lambda x: ([x['peptide'], x['intensity']], x['peaks']),
+            peak_columns=[('Peak Label', STRING), ('Peak Area', FLOAT)],
+            file_format=file_format,
+            batch_size=2,
+        )
+        records = [
+            {'peptide': 'PEPTIDE', 'intensity': 1.0/3, 'peaks': [['Light', 2.5], ['Heavy', 'NA']]},
+            {'peptide': 'NA', 'intensity': 'NA', 'peaks': []},
+            {'peptide': 'PEPTIDES', 'intensity': 1e20, 'peaks': [['Light', 1]]},
+        ]
+        for record in records:
+            sink.write(record)
+            sink.flush()
+        sink.close()
+        return path
+
+    def check_table(self, table):
+        self.assertEqual(table.num_rows, 3)
+        self.assertEqual(table.column('Peptide').to_pylist(), ['PEPTIDE', None, 'PEPTIDES'])
+        # floats are stored without any formatting
+        self.assertEqual(table.column('Light Intensity').to_pylist(), [1.0/3, None, 1e20])
+        self.assertEqual(table.column('Peaks').to_pylist()[0], [{'Peak Label': 'Light', 'Peak Area': 2.5}, {'Peak Label': 'Heavy', 'Peak Area': None}])
+
+    def test_parquet(self):
+        import pyarrow.parquet as pq
+        self.check_table(pq.read_table(self.write(PARQUET)))
+
+    def test_arrow(self):
+        self.check_table(pyarrow.ipc.open_file(self.write(ARROW)).read_all())
@@ -0,0 +1,103 @@
+from unittest import TestCase
+
+import numpy as np
+
+from pyquant.xic import XICMatrix, chosen_isotopes
+
+
+class FakeRunMap(object):
+    rts = [1.0, 1.5, 2.0]
+
+    def next_rt(self, rt):
+        return 2.0 if rt == 1.5 else None
+
+
+class TestXICMatrix(TestCase):
+    def setUp(self):
+        self.labels = {
+            100.0: {'label': 'Light', 'isotope_index': 0},
+            100.5: {'label': 'Light', 'isotope_index': 1},
+            104.0: {'label': 'Heavy', 'isotope_index': 0},
+        }
+
+    def get_xic(self):
+        xic = XICMatrix(rows=1, columns=1)
+        xic.add(2.0, {100.0: 1, 104.0: 3})
+        xic.add(1.0, {100.5: 2})
+        xic.add(1.0, {100.5: 1, 100.0: 5})
+        xic.zero(3.0)
+        xic.add(4.0, {104.0: 7})
+        xic.remove(4.0)
+        return xic
+
+    def test_compact(self):
+        xic = self.get_xic()
+        self.assertIn(3.0, xic)
+        self.assertNotIn(4.0, xic)
+        xic.compact()
+        self.assertEqual(xic.keys, [100.0, 100.5, 104.0])
+        np.testing.assert_array_equal(xic.rts, [1.0, 2.0, 3.0])
+        np.testing.assert_array_equal(xic.intensities, [[5, 1, 0], [3, 0, 0], [0, 3, 0]])
+        self.assertTrue(XICMatrix().empty)
+
+    def test_transpose(self):
+        xic = self.get_xic()
+        xic.compact()
+        xic.transpose()
+        self.assertEqual(xic.keys, [1.0, 2.0, 3.0])
+        np.testing.assert_array_equal(xic.rts, [100.0, 100.5, 104.0])
+        np.testing.assert_array_equal(xic.intensities[0], [5, 3, 0])
+
+    def test_mrm_merge_labels(self):
+        # MRM scans are chromatograms, so they are added by transition and transposed to be traced over time
+        xic = XICMatrix()
+        xic.add(11, {1.0: 1, 2.0: 2})
+        xic.add(12, {1.0: 3})
+        xic.compact()
+        xic.transpose()
+        xic.label({11: {'label': 'Light', 'isotope_index': 0}, 12: {'label': 'Light', 'isotope_index': 1}})
+        xic.merge_labels('_'.join(map(str, xic.keys)))
+        self.assertEqual(xic.keys, ['11_12'])
+        np.testing.assert_array_equal(xic.rts, [1.0, 2.0])
+        np.testing.assert_array_equal(xic.intensities, [[4, 2]])
+
+    def test_merge_isotopes(self):
+        xic = self.get_xic()
+        xic.compact()
+        xic.label(self.labels)
+        xic.merge_isotopes()
+        self.assertEqual(xic.keys, [100.0, 104.0])
+        self.assertEqual(xic.rows['label'].tolist(), ['Light', 'Heavy'])
+        np.testing.assert_array_equal(xic.intensities, [[8, 1, 0], [0, 3, 0]])
+
+    def test_merge_labels(self):
+        xic = self.get_xic()
+        xic.compact()
+        xic.label(self.labels)
+        xic.merge_labels('merged')
+        self.assertEqual(xic.keys, ['merged'])
+        self.assertEqual(xic.rows['label'].tolist(), ['merged'])
+        np.testing.assert_array_equal(xic.intensities, [[8, 4, 0]])
+
+    def test_bookend(self):
+        xic = self.get_xic()
+        xic.compact()
+        xic.bookend(FakeRunMap())
+        np.testing.assert_array_equal(xic.rts, [0.0, 1.0, 2.0, 3.0, 4.0])
+        np.testing.assert_array_equal(xic.intensities[0], [0, 5, 1, 0, 0])
+
+        xic = XICMatrix()
+        xic.add(1.5, {100.0: 1})
+        xic.compact()
+        xic.bookend(FakeRunMap())
+        np.testing.assert_array_equal(xic.rts, [1.0, 1.5, 2.0])
+        xic = XICMatrix()
+        xic.add(2.0, {100.0: 1})
+        xic.compact()
+        xic.bookend(FakeRunMap())
+        np.testing.assert_array_equal(xic.rts, [1.5, 2.0, 2.5])
+
+    def test_chosen_isotopes(self):
+        chosen = chosen_isotopes({(1.0, 100.0): {'label': 'Light', 'isotope_index': 0, 'amplitude': 5.0}})
+        self.assertEqual(chosen['label'].tolist(), ['Light'])
+        self.assertEqual(chosen['mz'].tolist(), [100.0])
@@ -99,14 +99,20 @@ def find_scan(msn_map, current_scan):
 
 
 def get_scans_under_peaks(rt_scan_map, found_peaks):
+    # rt_scan_map is a tuple of retention times in ascending order and the scan ids they belong to. A series of scan
+    # ids indexed by retention time is also accepted.
+    if isinstance(rt_scan_map, pd.Series):
+        scan_rts, scan_ids = rt_scan_map.index.values, rt_scan_map.values
+    else:
+        scan_rts, scan_ids = rt_scan_map
     scans = {}
     for peak_isotope, isotope_peak_data in six.iteritems(found_peaks):
         scans[peak_isotope] = {}
         for xic_peak_index, xic_peak_params in six.iteritems(isotope_peak_data):
             mean, stdl, stdr = xic_peak_params['peak_mean'], xic_peak_params['std'], xic_peak_params['std2']
             left, right = mean - 2 * stdl, mean + 2 * stdr
-            scans[peak_isotope][xic_peak_index] = set(
-                rt_scan_map[(rt_scan_map.index >= left) & (rt_scan_map.index <= right)].values)
+            start, end = np.searchsorted(scan_rts, left, side='left'), np.searchsorted(scan_rts, right, side='right')
+            scans[peak_isotope][xic_peak_index] = set(scan_ids[start:end])
     return scans
 
 
@@ -204,6 +210,34 @@ def nanmean(arr, empty=0):
         return empty
 
 
+def mono_ratio(quant1, quant2):
+    """
+    The ratio of two labels from the ratios of their common isotopes. Isotopes are used while both labels are above
+    100 and 15% of the previous isotope, and when their log2 ratios vary, outlying ratios are left out.
+    """
+    from sklearn.covariance import EllipticEnvelope
+
+    common_isotopes = set(quant1.keys()).intersection(quant2.keys())
+    x = []
+    y = []
+    l1, l2 = 0, 0
+    for i in common_isotopes:
+        q1 = quant1.get(i)
+        q2 = quant2.get(i)
+        if q1 > 100 and q2 > 100 and q1 > l1 * 0.15 and q2 > l2 * 0.15:
+            x.append(i)
+            y.append(float(q1) / q2)
+            l1, l2 = q1, q2
+    # fit it and take the intercept
+    if len(x) >= 3 and np.std(np.log2(y)) > 0.3:
+        classifier = EllipticEnvelope(contamination=0.25, random_state=0)
+        fit_data = np.log2(np.array(y).reshape(len(y), 1))
+        true_pred = (True, 1)
+        classifier.fit(fit_data)
+        return nanmean([y[i] for i, v in enumerate(classifier.predict(fit_data)) if v in true_pred])
+    return nanmean(np.array(y))
+
+
 def divide_peaks(peaks, min_sep=5, chunk_factor=0.1):
     # We divide up the list of peaks to reduce the number of dimensions each fitting routine is working on
     # to improve convergence speeds. Note -- this function can never rely on our peak estimates because we
@@ -896,22 +930,26 @@ def get_formatted_mass(mass):
 def get_scan_resolution(scan):
     """
 
-    :param scan: A scan series (pandas series)
+    :param scan: A scan series (pandas series), or a tuple of the scan's m/z and intensities as arrays
     :return:
     """
     from .peaks import findAllPeaks
 
-    max_peak = np.argmax(scan.values)
+    if isinstance(scan, tuple):
+        mz, intensities = scan[0], scan[1]
+    else:
+        mz, intensities = scan.index.values, scan.values
+    max_peak = np.argmax(intensities)
 
     left = max_peak-30
     right = max_peak+30
     if left < 0:
         left = 0
-    if right > len(scan):
-        right = len(scan)
+    if right > len(intensities):
+        right = len(intensities)
 
-    x = scan.index.values[left:right].astype(float)
-    y = scan.values[left:right].astype(float)
+    x = mz[left:right].astype(float)
+    y = intensities[left:right].astype(float)
     peaks, residual = findAllPeaks(x, y, peak_width_start=1, max_peaks=-1)
     if peaks is None or not peaks.any():
         print('no peaks in ', scan)
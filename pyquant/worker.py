@@ -1,6 +1,8 @@
 from __future__ import division, unicode_literals, print_function
 import sys
 import os
+import signal
+import time
 import copy
 import operator
 import traceback
@@ -16,8 +18,6 @@ if six.PY3:
 
 from itertools import groupby, combinations
 from collections import OrderedDict, defaultdict
-from sklearn.covariance import EllipticEnvelope
-from sklearn.svm import OneClassSVM
 from multiprocessing import Process
 
 try:
@@ -31,26 +31,126 @@ from scipy.ndimage.filters import gaussian_filter1d
 
 from pythomics.proteomics import config
 
-from . import PEAK_RESOLUTION_RT_MODE, PEAK_RESOLUTION_COMMON_MODE
+from . import PEAK_RESOLUTION_RT_MODE, PEAK_RESOLUTION_COMMON_MODE, PEAK_FIT_MODE_FAST
 from . import peaks
-from .utils import calculate_theoretical_distribution, find_scan, find_prior_scan, find_next_scan, nanmean, find_common_peak_mean, get_scan_resolution
+from .governor import RECYCLE_EXIT_CODE
+from .xic import XICMatrix, chosen_isotopes
+from .utils import calculate_theoretical_distribution, find_prior_scan, find_next_scan, nanmean, find_common_peak_mean, get_scan_resolution, mono_ratio
+
+
+def get_precursors(target_scan, mass_labels, reporter_mode=False, calibration=None):
+    """
+    Returns the uncalibrated, calibrated and theoretical m/z of each ion and label of a target, in the order they are
+    listed.
+    """
+    def get_calibrated_mass(mass):
+        return float(calibration(mass)) if calibration is not None else mass
+
+    precursor = target_scan['precursor']
+    charge = target_scan['charge']
+    peptide = target_scan.get('peptide')
+    theor_mass = target_scan.get('theor_mass', get_calibrated_mass(precursor))
+    precursors = OrderedDict()
+    for ion in target_scan.get('ion_set', []):
+        precursors[str(ion)] = {
+            'uncalibrated_mz': ion,
+            'calibrated_mz': get_calibrated_mass(ion),
+            'theoretical_mz': ion,
+        }
+    for silac_label, silac_masses in mass_labels.items():
+        silac_shift = 0
+        global_mass = None
+        added_residues = set([])
+        cterm_mass = 0
+        nterm_mass = 0
+        mass_keys = list(silac_masses.keys())
+        if reporter_mode:
+            silac_shift = sum(mass_keys)
+            label_mz = silac_shift
+            theo_mz = silac_shift
+        else:
+            if peptide:
+                for label_mass, label_masses in silac_masses.items():
+                    if 'X' in label_masses:
+                        global_mass = label_mass
+                    if ']' in label_masses:
+                        cterm_mass = label_mass
+                    if '[' in label_masses:
+                        nterm_mass = label_mass
+                    added_residues = added_residues.union(label_masses)
+                    labels = [label_mass for mod_aa in peptide if mod_aa in label_masses]
+                    silac_shift += sum(labels)
+            else:
+                # no mass, just assume we have one of the labels
+                silac_shift += mass_keys[0]
+            if global_mass is not None:
+                silac_shift += sum([global_mass for mod_aa in peptide if mod_aa not in added_residues])
+            silac_shift += cterm_mass + nterm_mass
+
+            label_mz = precursor + (silac_shift / float(charge))
+            theo_mz = theor_mass + (silac_shift / float(charge))
+        precursors[silac_label] = {
+            'uncalibrated_mz': label_mz,
+            'calibrated_mz': get_calibrated_mass(label_mz),
+            'theoretical_mz': theo_mz,
+        }
+    if not precursors:
+        precursors[''] = {
+            'uncalibrated_mz': precursor,
+            'calibrated_mz': get_calibrated_mass(precursor),
+            'theoretical_mz': precursor,
+        }
+    return precursors
+
+
+def get_precursor_range(precursors):
+    """
+    Sorts the precursors of a target by m/z. Returns them along with the highest m/z of the precursor after each one,
+    and the lowest and highest m/z the XIC of the target is traced over.
+    """
+    precursors = OrderedDict(
+        sorted(precursors.items(), key=cmp_to_key(lambda x, y: int(x[1]['uncalibrated_mz'] - y[1]['uncalibrated_mz']))))
+    shift_maxes = {i: max([j['uncalibrated_mz'], j['calibrated_mz'], j['theoretical_mz']]) for i, j in
+                   zip(precursors.keys(), list(precursors.values())[1:])}
+    lowest_precursor_mz = min(
+        [label_val for label, label_info in precursors.items() for label_info_key, label_val in label_info.items() if
+         label_info_key.endswith('mz')])
+    highest_precursor_mz = max(shift_maxes.values()) if shift_maxes else lowest_precursor_mz
+    # do these here, remember when you tried to do this in one line with () and spent an hour debugging it?
+    lowest_precursor_mz -= 5
+    highest_precursor_mz += 5
+    return precursors, shift_maxes, lowest_precursor_mz, highest_precursor_mz
+
+
+def envelope_key(scan, mz_range, measured_mz, theo_mz, max_mz, charge, peptide, label, skip_isotopes, last_precursor,
+                 fragment_scan, centroid):
+    """
+    The key of an envelope search in a scan, made of every findEnvelope argument that differs between searches.
+    findEnvelope only falls back on last_precursor in scans that were not fragmented, so it is left out for fragmented
+    scans, which are then found again whichever way their XIC was being traced.
+    """
+    return (
+        scan, mz_range, measured_mz, theo_mz, max_mz, charge, peptide, label, frozenset(skip_isotopes),
+        None if fragment_scan else last_precursor, fragment_scan, centroid,
+    )
 
 
 class Worker(Process):
     def __init__(self, queue=None, results=None, precision=6, raw_name=None, mass_labels=None, isotope_ppms=None,
                  debug=False, html=False, mono=False, precursor_ppm=5.0, isotope_ppm=2.5, quant_method='integrate',
-                 reader_in=None, reader_out=None, thread=None, fitting_run=False, msn_rt_map=None, reporter_mode=False,
-                 spline=None, isotopologue_limit=-1, labels_needed=1, overlapping_mz=False, min_resolution=0, min_scans=3,
-                 quant_msn_map=None, mrm=False, mrm_pair_info=None, peak_cutoff=0.05, ratio_cutoff=0, replicate=False,
-                 ref_label=None, max_peaks=4, parser_args=None, scans_to_skip=None):
+                 reader_in=None, reader_out=None, thread=None, fitting_run=False, run_map=None, reporter_mode=False,
+                 calibration=None, isotopologue_limit=-1, labels_needed=1, overlapping_mz=False, min_resolution=0, min_scans=3,
+                 mrm=False, mrm_pair_info=None, peak_cutoff=0.05, ratio_cutoff=0, replicate=False,
+                 ref_label=None, max_peaks=4, parser_args=None, scans_to_skip=None, scan_cache_size=0,
+                 governor=None, envelope_cache_size=0):
         super(Worker, self).__init__()
         self.precision = precision
         self.precursor_ppm = precursor_ppm
         self.isotope_ppm = isotope_ppm
         self.queue = queue
         self.reader_in, self.reader_out = reader_in, reader_out
-        self.msn_rt_map = pd.Series(msn_rt_map)
-        self.msn_rt_map.sort_values(inplace=True)
+        # the scan maps are memory mapped by each worker on first use, see RunMap
+        self.run_map = run_map
         self.results = results
         self.mass_labels = {'Light': {}} if mass_labels is None else mass_labels
         self.shifts = {0: "Light"}
@@ -67,13 +167,12 @@ class Worker(Process):
         self.isotope_ppms = isotope_ppms
         self.quant_method = quant_method
         self.reporter_mode = reporter_mode
-        self.spline = spline
+        self.calibration = calibration
         self.isotopologue_limit = isotopologue_limit
         self.labels_needed = labels_needed
         self.overlapping_mz = overlapping_mz
         self.min_resolution = min_resolution
         self.min_scans = min_scans
-        self.quant_msn_map = quant_msn_map
         self.mrm = mrm
         self.mrm_pair_info = mrm_pair_info
         self.peak_cutoff = peak_cutoff
@@ -82,9 +181,7 @@ class Worker(Process):
         self.ref_label = ref_label
         self.max_peaks = max_peaks
         self.parser_args = parser_args
-        if mrm:
-            self.quant_mrm_map = {label: list(group) for label, group in
-                                                        groupby(self.quant_msn_map, key=operator.itemgetter(0))}
+        self.quant_mrm_map = None
         self.peaks_n = self.parser_args.peaks_n
         self.rt_guide = not self.parser_args.no_rt_guide
         self.filter_peaks = not self.parser_args.disable_peak_filtering
@@ -92,7 +189,23 @@ class Worker(Process):
         self.bigauss_stepsize = 6 if self.parser_args.remove_baseline else 4
         self.xic_missing_ion_count = self.parser_args.xic_missing_ion_count
 
-        self.scans_to_skip = scans_to_skip or {}
+        self.scans_to_skip = set([]) if scans_to_skip is None else scans_to_skip
+        # full scans from the reader, so neighboring targets do not request the same scans again
+        self.scan_cache = OrderedDict()
+        self.scan_cache_size = scan_cache_size
+        # envelopes already searched for, since overlapping targets search the same scans for the same ions
+        self.envelope_cache = OrderedDict()
+        self.envelope_cache_size = envelope_cache_size
+        # the scans of the current task when they were extracted by a ScanSweep
+        self.task_scans = None
+        self.reader_wait = 0
+        # scan requests are numbered, so replies meant for a worker that was stopped in our place are discarded
+        self.request_count = 0
+        # whether we are putting to or getting from a queue shared with other processes, and whether we were asked
+        # to stop while doing so
+        self.in_queue = False
+        self.stopping = False
+        self.governor = governor
 
         # This is a convenience object to pass to the findAllPeaks function since it is called quite a few times
 
@@ -111,9 +224,12 @@ class Worker(Process):
             'gap_interpolation': self.parser_args.gap_interpolation,
             'fit_mode': self.parser_args.peak_find_mode,
         }
+        self.default_peak_finding_kwargs = self.peak_finding_kwargs
+        # tasks that crashed or timed out a worker are retried with the cheapest fit
+        self.fast_peak_finding_kwargs = dict(self.peak_finding_kwargs, fit_mode=PEAK_FIT_MODE_FAST)
 
     def get_calibrated_mass(self, mass):
-        return mass / (1 - self.spline(mass) / 1e6) if self.spline else mass
+        return float(self.calibration(mass)) if self.calibration is not None else mass
 
     def low_snr(self, scan_intensities, thresh=0.3):
         std = np.std(scan_intensities)
@@ -122,6 +238,9 @@ class Worker(Process):
         return (last_point / std) < thresh
 
     def replaceOutliers(self, common_peaks, combined_data, debug=False):
+        # scikit-learn is slow to import and only needed here
+        from sklearn.covariance import EllipticEnvelope
+        from sklearn.svm import OneClassSVM
         x = []
         y = []
         tx = []
@@ -247,27 +366,119 @@ class Worker(Process):
         return x_mean
 
     def convertScan(self, scan):
-        import numpy as np
+        """
+        Returns the m/z and intensities of a scan as arrays sorted by m/z, along with its name, which is its retention
+        time (or its title in MRM runs). Returns None for scans without any points.
+        """
         scan_vals = scan['vals']
-        res = pd.Series(scan_vals[:, 1].astype(np.uint64), index=np.round(scan_vals[:, 0], self.precision),
-                                        name=int(scan['title']) if self.mrm else scan['rt'], dtype='uint64')
+        if not len(scan_vals):
+            return None
+        mz = np.round(scan_vals[:, 0], self.precision)
+        intensities = scan_vals[:, 1].astype(np.uint64)
         # mz values can sometimes be not sorted -- rare but it happens
-        res = res.sort_index()
-        del scan_vals
+        if (np.diff(mz) < 0).any():
+            order = np.argsort(mz, kind='mergesort')
+            mz, intensities = mz[order], intensities[order]
         # due to precision, we have multiple m/z values at the same place. We can eliminate this by grouping them and summing them.
         # Summation is the correct choice here because we are combining values of a precision higher than we care about.
+        mz, starts = np.unique(mz, return_index=True)
+        intensities = np.add.reduceat(intensities, starts).astype(float)
+        return mz, intensities, int(scan['title']) if self.mrm else scan['rt']
+
+    def request_scan(self, ms1, start=None, end=None):
+        request_start = time.time()
+        self.request_count += 1
+        request_id = (os.getpid(), self.request_count)
+        reply_id, scan = self.queue_operation(self.send_request, (self.thread, ms1, start, end, request_id))
+        while reply_id != request_id:
+            # the reply to a request of the worker we replaced, which was stopped while waiting for it
+            reply_id, scan = self.queue_operation(self.reader_out.get)
+        self.reader_wait += time.time()-request_start
+        return scan
+
+    def send_request(self, request):
+        self.reader_in.put(request)
+        return self.reader_out.get()
+
+    def queue_operation(self, operation, *args):
+        """
+        Calls operation, deferring a stop until it returns.
+        """
+        self.in_queue = True
         try:
-            return res.groupby(level=0).sum() if not res.empty else None
-        except Exception as e:
-            print('Converting scan error {}\n{}\n{}\n'.format(traceback.format_exc(), res, scan))
+            return operation(*args)
+        finally:
+            self.in_queue = False
+            if self.stopping:
+                self.exit()
+
+    def stop(self, signum, frame):
+        """
+        Handles the SIGTERM sent to workers that run past the task timeout. A process that dies while putting to or
+        getting from a queue leaves the queue's lock held, which wedges every other process using the queue, so a
+        worker in a queue operation stops once the operation is done.
+        """
+        self.stopping = True
+        if not self.in_queue:
+            self.exit()
+
+    def exit(self):
+        for queue in (self.results, self.reader_in):
+            # a queue's feeder thread holds the queue's lock while it sends what we put, so let it finish
+            queue.close()
+            queue.join_thread()
+        os._exit(1)
+
+    def fetch_scan(self, ms1, start=None, end=None):
+        if self.task_scans is not None and six.text_type(ms1) in self.task_scans:
+            # the scans of a swept XIC are already sliced to its m/z range. Scans past either end of it are requested
+            # as usual, so a swept XIC is traced as far as any other.
+            scan = self.task_scans[six.text_type(ms1)]
+        elif not self.scan_cache_size:
+            return self.request_scan(ms1, start=start, end=end)
+        else:
+            if ms1 in self.scan_cache:
+                scan = self.scan_cache.pop(ms1)
+            else:
+                scan = self.request_scan(ms1)
+                if len(self.scan_cache) >= self.scan_cache_size:
+                    self.scan_cache.popitem(last=False)
+            self.scan_cache[ms1] = scan
+        if scan is None or (start is None and end is None):
+            return scan
+        scan = dict(scan)
+        start = 0 if start is None else start
+        end = scan['vals'][-1, 0] + 1 if end is None else end
+        scan['vals'] = scan['vals'][(scan['vals'][:, 0] >= start) & (scan['vals'][:, 0] <= end)]
+        return scan
 
     def getScan(self, ms1, start=None, end=None):
-        self.reader_in.put((self.thread, ms1, start, end))
-        scan = self.reader_out.get()
+        scan = self.fetch_scan(ms1, start=start, end=end)
         if scan is None:
             print('Unable to fetch scan {}.\n'.format(ms1))
         return (self.convertScan(scan), {'centroid': scan.get('centroid', False)}) if scan is not None else (None, {})
 
+    def find_envelope(self, key, xdata, ydata, **kwargs):
+        """
+        Returns peaks.findEnvelope(xdata, ydata, **kwargs), keeping the envelopes of the last envelope_cache_size keys.
+        The key must identify the spectrum and every argument that differs between searches, see envelope_key.
+
+        A new envelope is cached as it is returned, and hits return a copy of it. The only change quantify_peaks makes
+        to an envelope is to label each micro envelope with its own isotope, so what reaches the cache is the same
+        whichever search made it.
+        """
+        if not self.envelope_cache_size:
+            return peaks.findEnvelope(xdata, ydata, **kwargs)
+        if key in self.envelope_cache:
+            envelope = self.envelope_cache.pop(key)
+            self.envelope_cache[key] = envelope
+            return copy.deepcopy(envelope)
+        envelope = peaks.findEnvelope(xdata, ydata, **kwargs)
+        if len(self.envelope_cache) >= self.envelope_cache_size:
+            self.envelope_cache.popitem(last=False)
+        self.envelope_cache[key] = envelope
+        return envelope
+
     # @memory_profiler
     # @line_profiler(extra_view=[peaks.findEnvelope, peaks.findAllPeaks, peaks.findMicro])
     def quantify_peaks(self, params):
@@ -287,8 +498,6 @@ class Worker(Process):
             combine_xics = scan_info.get('combine_xics')
 
             precursor = target_scan['precursor']
-            calibrated_precursor = self.get_calibrated_mass(precursor)
-            theor_mass = target_scan.get('theor_mass', calibrated_precursor)
             # this will be the RT of the target_scan, which is not always equal to the RT of the quant_scan
             rt = target_scan['rt']
 
@@ -303,83 +512,33 @@ class Worker(Process):
               'charge': charge,
               'modifications': target_scan.get('modifications'),
               'rt': rt,
-              'accession': target_scan.get('accession')
+              'accession': target_scan.get('accession'),
+              'key': params.get('key'),
+              'task_id': params.get('task_id'),
+              'order': params.get('order'),
+              # other PSMs of the peptide that this result is reported for
+              'psms': params.get('psms', []),
             }
             if float(charge) == 0:
                 # We cannot proceed with a zero charge
-                self.results.put(result_dict)
+                self.put_result(result_dict)
                 return
 
-            precursors = defaultdict(dict)
             silac_dict = {'data': None, 'df': pd.DataFrame(), 'precursor': 'NA',
                                         'isotopes': {}, 'peaks': OrderedDict(), 'intensity': 'NA'}
             data = OrderedDict()
             # data['Light'] = copy.deepcopy(silac_dict)
-            combined_data = pd.DataFrame()
+            combined_data = XICMatrix()
             if self.mrm:
                 mrm_labels = [i for i in self.mrm_pair_info.columns if i.lower() not in ('retention time')]
                 mrm_info = None
                 for index, values in self.mrm_pair_info.iterrows():
                     if values['Light'] == mass:
                         mrm_info = values
-            for ion in target_scan.get('ion_set', []):
-                precursors[str(ion)]['uncalibrated_mz'] = ion
-                precursors[str(ion)]['calibrated_mz'] = self.get_calibrated_mass(ion)
-                precursors[str(ion)]['theoretical_mz'] = ion
-                data[str(ion)] = copy.deepcopy(silac_dict)
-            for silac_label, silac_masses in self.mass_labels.items():
-                silac_shift = 0
-                global_mass = None
-                added_residues = set([])
-                cterm_mass = 0
-                nterm_mass = 0
-                mass_keys = list(silac_masses.keys())
-                if self.reporter_mode:
-                    silac_shift = sum(mass_keys)
-                    label_mz = silac_shift
-                    theo_mz = silac_shift
-                else:
-                    if peptide:
-                        for label_mass, label_masses in silac_masses.items():
-                            if 'X' in label_masses:
-                                global_mass = label_mass
-                            if ']' in label_masses:
-                                cterm_mass = label_mass
-                            if '[' in label_masses:
-                                nterm_mass = label_mass
-                            added_residues = added_residues.union(label_masses)
-                            labels = [label_mass for mod_aa in peptide if mod_aa in label_masses]
-                            silac_shift += sum(labels)
-                    else:
-                        # no mass, just assume we have one of the labels
-                        silac_shift += mass_keys[0]
-                    if global_mass is not None:
-                        silac_shift += sum([global_mass for mod_aa in peptide if mod_aa not in added_residues])
-                    silac_shift += cterm_mass + nterm_mass
-
-                    label_mz = precursor + (silac_shift / float(charge))
-                    theo_mz = theor_mass + (silac_shift / float(charge))
-                precursors[silac_label]['uncalibrated_mz'] = label_mz
-                precursors[silac_label]['calibrated_mz'] = self.get_calibrated_mass(label_mz)
-                precursors[silac_label]['theoretical_mz'] = theo_mz
-                data[silac_label] = copy.deepcopy(silac_dict)
-            if not precursors:
-                precursors['']['uncalibrated_mz'] = precursor
-                precursors['']['calibrated_mz'] = self.get_calibrated_mass(precursor)
-                precursors['']['theoretical_mz'] = precursor
-                data[''] = copy.deepcopy(silac_dict)
-
-            precursors = OrderedDict(
-                sorted(precursors.items(), key=cmp_to_key(lambda x, y: int(x[1]['uncalibrated_mz'] - y[1]['uncalibrated_mz']))))
-            shift_maxes = {i: max([j['uncalibrated_mz'], j['calibrated_mz'], j['theoretical_mz']]) for i, j in
-                                         zip(precursors.keys(), list(precursors.values())[1:])}
-            lowest_precursor_mz = min(
-                [label_val for label, label_info in precursors.items() for label_info_key, label_val in label_info.items() if
-                 label_info_key.endswith('mz')])
-            highest_precursor_mz = max(shift_maxes.values()) if shift_maxes else lowest_precursor_mz
-            # do these here, remember when you tried to do this in one line with () and spent an hour debugging it?
-            lowest_precursor_mz -= 5
-            highest_precursor_mz += 5
+            precursors = get_precursors(target_scan, self.mass_labels, reporter_mode=self.reporter_mode, calibration=self.calibration)
+            for precursor_label in precursors:
+                data[precursor_label] = copy.deepcopy(silac_dict)
+            precursors, shift_maxes, lowest_precursor_mz, highest_precursor_mz = get_precursor_range(precursors)
 
             finished_isotopes = {i: set([]) for i in precursors.keys()}
             ms_index = 0
@@ -390,7 +549,7 @@ class Worker(Process):
             isotopes_chosen = {}
             last_precursors = {-1: {}, 1: {}}
             # our rt might sometimes be an approximation, such as from X!Tandem which requires some transformations
-            initial_scan = find_scan(self.quant_msn_map, ms1)
+            initial_scan = self.run_map.find_scan(ms1)
             current_scan = None
             not_found = 0
             if self.mrm:
@@ -400,14 +559,17 @@ class Worker(Process):
             low_int_isotopes = defaultdict(int)
             all_data_intensity = {-1: [], 1: []}
             while True:
-                map_to_search = self.quant_mrm_map[mass] if self.mrm else self.quant_msn_map
                 if current_scan is None:
                     current_scan = initial_scan
                 else:
                     if scans_to_quant:
                         current_scan = scans_to_quant.pop(0)
                     elif scans_to_quant is None:
-                        current_scan = find_prior_scan(map_to_search, current_scan) if delta == -1 else find_next_scan(map_to_search, current_scan)
+                        if self.mrm:
+                            map_to_search = self.quant_mrm_map[mass]
+                            current_scan = find_prior_scan(map_to_search, current_scan) if delta == -1 else find_next_scan(map_to_search, current_scan)
+                        else:
+                            current_scan = self.run_map.find_prior_scan(current_scan) if delta == -1 else self.run_map.find_next_scan(current_scan)
                     else:
                         # we've exhausted the scans we are supposed to quantify
                         break
@@ -423,22 +585,24 @@ class Worker(Process):
                             if full_scan is not None:
                                 scan_resolution = get_scan_resolution(full_scan)
                                 if scan_resolution < self.min_resolution:
-                                    self.scans_to_skip[current_scan] = True
+                                    self.scans_to_skip.add(current_scan)
                                     continue
-                            if self.mrm:
-                                df = full_scan
+                            if self.mrm or full_scan is None:
+                                spectrum = full_scan
                             else:
-                                df = full_scan.ix[(full_scan.index >= lowest_precursor_mz) & (full_scan.index <= highest_precursor_mz)]
+                                scan_mz, scan_intensities, scan_name = full_scan
+                                start = np.searchsorted(scan_mz, lowest_precursor_mz, side='left')
+                                end = np.searchsorted(scan_mz, highest_precursor_mz, side='right')
+                                spectrum = (scan_mz[start:end], scan_intensities[start:end], scan_name)
                         else:
-                            df, scan_params = self.getScan(
+                            spectrum, scan_params = self.getScan(
                               current_scan,
                               start=None if self.mrm else lowest_precursor_mz,
                               end=None if self.mrm else highest_precursor_mz
                             )
-                    if df is not None:
+                    if spectrum is not None:
                         labels_found = set([])
-                        xdata = df.index.values.astype(float)
-                        ydata = df.fillna(0).values.astype(float)
+                        xdata, ydata, scan_name = spectrum
                         iterator = precursors.items() if not self.mrm else [(mrm_label, 0)]
                         for precursor_label, precursor_info in iterator:
                             selected = {}
@@ -446,11 +610,11 @@ class Worker(Process):
                                 labels_found.add(precursor_label)
                                 for i, j in zip(xdata, ydata):
                                     selected[i] = j
-                                isotope_labels[df.name] = {
+                                isotope_labels[scan_name] = {
                                     'label': precursor_label,
                                     'isotope_index': target_scan.get('product_ion', 0),
                                 }
-                                key = (df.name, xdata[-1])
+                                key = (scan_name, xdata[-1])
                                 isotopes_chosen[key] = {
                                     'label': precursor_label,
                                     'isotope_index': target_scan.get('product_ion', 0),
@@ -464,7 +628,16 @@ class Worker(Process):
                                 data[precursor_label]['precursor'] = uncalibrated_precursor
                                 shift_max = shift_maxes.get(precursor_label) if self.overlapping_mz is False else None
                                 is_fragmented_scan = (current_scan == initial_scan) and (precursor == measured_precursor)
-                                envelope = peaks.findEnvelope(
+                                use_theo_dist = self.mono or precursor_label not in shift_maxes
+                                last_precursor = last_precursors[delta].get(precursor_label, measured_precursor)
+                                centroid = scan_params.get('centroid', False)
+                                envelope = self.find_envelope(
+                                    envelope_key(
+                                        current_scan, (lowest_precursor_mz, highest_precursor_mz), measured_precursor,
+                                        theoretical_precursor, shift_max, charge, peptide if use_theo_dist else None,
+                                        precursor_label, finished_isotopes[precursor_label], last_precursor,
+                                        is_fragmented_scan, centroid,
+                                    ),
                                     xdata,
                                     ydata,
                                     measured_mz=measured_precursor,
@@ -478,13 +651,13 @@ class Worker(Process):
                                     isotope_ppms=self.isotope_ppms if self.fitting_run else None,
                                     quant_method=self.quant_method,
                                     debug=self.debug,
-                                    theo_dist=theo_dist if (self.mono or precursor_label not in shift_maxes) else None,
+                                    theo_dist=theo_dist if use_theo_dist else None,
                                     label=precursor_label,
                                     skip_isotopes=finished_isotopes[precursor_label],
-                                    last_precursor=last_precursors[delta].get(precursor_label, measured_precursor),
+                                    last_precursor=last_precursor,
                                     isotopologue_limit=self.isotopologue_limit,
                                     fragment_scan=is_fragmented_scan,
-                                    centroid=scan_params.get('centroid', False)
+                                    centroid=centroid,
                                 )
                                 if not envelope['envelope']:
                                     if self.debug:
@@ -495,7 +668,7 @@ class Worker(Process):
                                           'label': precursor_label,
                                           'isotope_index': 0,
                                         }
-                                        isotopes_chosen[(df.name, measured_precursor)] = {
+                                        isotopes_chosen[(scan_name, measured_precursor)] = {
                                           'label': precursor_label,
                                           'isotope_index': 0,
                                           'amplitude': 0,
@@ -535,7 +708,7 @@ class Worker(Process):
                                       'label': precursor_label,
                                       'isotope_index': isotope,
                                     }
-                                    key = (df.name, measured_precursor + isotope * spacing)
+                                    key = (scan_name, measured_precursor + isotope * spacing)
                                     added_keys.append(key)
                                     isotopes_chosen[key] = {
                                         'label': precursor_label,
@@ -543,27 +716,22 @@ class Worker(Process):
                                         'amplitude': peak_intensity,
                                     }
                                 del envelope
-                            selected = pd.Series(selected, name=df.name).to_frame()
-                            if df.name in combined_data.columns:
-                                combined_data = combined_data.add(selected, axis='index', fill_value=0)
-                            else:
-                                combined_data = pd.concat([combined_data, selected], axis=1).fillna(0)
+                            combined_data.add(scan_name, selected)
                             del selected
                         if not self.mrm and ((len(labels_found) < self.labels_needed) or (
                                             self.parser_args.require_all_ions and len(labels_found) < len(precursors))):
                             if self.parser_args.msn_all_scans:
                                 if self.parser_args.require_all_ions:
                                     if self.debug:
-                                        print('Not all ions found, setting', df.name, 'to zero')
-                                    combined_data[df.name] = 0
+                                        print('Not all ions found, setting', scan_name, 'to zero')
+                                    combined_data.zero(scan_name)
                             else:
                                 found.discard(precursor_label)
-                                if df is not None and df.name in combined_data.columns:
-                                    del combined_data[df.name]
-                                    for i in isotopes_chosen.keys():
-                                        if i[0] == df.name:
-                                            del isotopes_chosen[i]
-                        del df
+                                if scan_name in combined_data:
+                                    combined_data.remove(scan_name)
+                                    for i in [i for i in isotopes_chosen if i[0] == scan_name]:
+                                        del isotopes_chosen[i]
+                        del spectrum
                 all_data_intensity[delta].append(current_scan_intensity)
                 if not found or ((np.abs(ms_index) > 7 and self.low_snr(all_data_intensity[delta], thresh=self.parser_args.xic_snr)) or (self.parser_args.xic_window_size != -1 and np.abs(ms_index) >= self.parser_args.xic_window_size)):
                     not_found += 1
@@ -598,23 +766,20 @@ class Worker(Process):
             rt_figure = {}
             isotope_figure = {}
 
-            if self.parser_args.merge_isotopes:
-                new_labels = {}
-                labels = set(v['label'] for i,v in six.iteritems(isotope_labels))
-                for label in labels:
-                    to_merge = [(i, v['isotope_index'], v) for i, v in six.iteritems(isotope_labels) if v['label'] == label]
-                    to_merge.sort(key=operator.itemgetter(1))
-                    new_labels[to_merge[0][0]] = to_merge[0][2]
-                    if len(to_merge) > 1:
-                        combined_data.loc[to_merge[0][0], :] = combined_data.loc[[i[0] for i in to_merge], :].sum(axis=0)
-                        combined_data.drop([i[0] for i in to_merge[1:]], inplace=True)
-                isotope_labels = new_labels
-
+            combined_data.compact()
+            if self.mrm:
+                # the ions of MRM runs are traced over the scans of each transition. This happens before labeling and
+                # merging, so rows are transitions and columns retention times when they are merged, and merged labels
+                # are named after the transitions they sum.
+                combined_data.transpose()
+            combined_data.label(isotope_labels)
 
+            if self.parser_args.merge_isotopes:
+                combined_data.merge_isotopes()
 
             if self.parser_args.merge_labels or combine_xics:
-                label_name = '_'.join(map(str, combined_data.index))
-                combined_data = combined_data.sum(axis=0).to_frame(name=label_name).T
+                label_name = '_'.join(map(str, combined_data.keys))
+                combined_data.merge_labels(label_name)
                 isotope_labels = {
                     label_name: {
                         'isotope_index': 0,
@@ -627,61 +792,37 @@ class Worker(Process):
                 data[label_name]['precursor'] = '_'.join(
                     map(str, (data[i].get('precursor') for i in sorted(data.keys()) if i != label_name)))
             if isotopes_chosen and isotope_labels and not combined_data.empty:
-                if self.mrm:
-                    combined_data = combined_data.T
-                # bookend with zeros if there aren't any, do the right end first because pandas will by default append there
-                combined_data = combined_data.sort_index().sort_index(axis='columns')
                 start_rt = rt
                 rt_guide = self.rt_guide and start_rt
-                if len(combined_data.columns) == 1:
-                    if combined_data.columns[-1] == self.msn_rt_map[-1]:
-                        new_col = combined_data.columns[-1] + (combined_data.columns[-1] - self.msn_rt_map[-2])
-                    else:
-                        try:
-                            new_col = self.msn_rt_map.iloc[self.msn_rt_map.searchsorted(combined_data.columns[-1]) + 1].values[0]
-                        except Exception as e:
-                            if self.debug:
-                                print(combined_data.columns)
-                                print(self.msn_rt_map)
-                else:
-                    new_col = combined_data.columns[-1] + (combined_data.columns[-1] - combined_data.columns[-2])
-                combined_data[new_col] = 0
-                new_col = combined_data.columns[0] - (combined_data.columns[1] - combined_data.columns[0])
-                combined_data[new_col] = 0
-                combined_data = combined_data[sorted(combined_data.columns)]
-
-                combined_data = combined_data.sort_index().sort_index(axis='columns')
+                # bookend with zeros if there aren't any
+                combined_data.bookend(self.run_map)
                 quant_vals = defaultdict(dict)
-                isotope_labels = pd.DataFrame(isotope_labels).T
-
-                isotopes_chosen = pd.DataFrame(isotopes_chosen).T
-                isotopes_chosen.index.names = ['RT', 'MZ']
+                isotopes_chosen = chosen_isotopes(isotopes_chosen)
 
                 if self.html:
                     # make the figure of our isotopes selected
-                    all_x = sorted(isotopes_chosen.index.get_level_values('MZ').drop_duplicates())
-                    isotopes_chosen['RT'] = isotopes_chosen.index.get_level_values('RT')
-                    isotope_group = isotopes_chosen.groupby('RT')
+                    all_x = sorted(set(isotopes_chosen['mz'].tolist()))
 
                     isotope_figure = {
                         'data': [],
                         'plot-multi': True,
                         'common-x': ['x'] + all_x,
-                        'max-y': isotopes_chosen['amplitude'].max(),
+                        'max-y': float(isotopes_chosen['amplitude'].max()),
                     }
                     isotope_figure_mapper = {}
                     rt_figure = {
                         'data': [],
                         'plot-multi': True,
-                        'common-x': ['x'] + ['{0:0.4f}'.format(i) for i in combined_data.columns],
+                        'common-x': ['x'] + ['{0:0.4f}'.format(i) for i in combined_data.rts],
                         'rows': len(precursors),
-                        'max-y': combined_data.max().max(),
+                        'max-y': float(combined_data.intensities.max()),
                     }
                     rt_figure_mapper = {}
 
-                    for counter, (index, row) in enumerate(isotope_group):
+                    for index in np.unique(isotopes_chosen['rt']).tolist():
+                        row = isotopes_chosen[isotopes_chosen['rt'] == index]
                         try:
-                            title = 'Scan {} RT {}'.format(self.msn_rt_map[self.msn_rt_map == index].index[0], index)
+                            title = 'Scan {} RT {}'.format(self.run_map.scan_at_rt(index), index)
                         except Exception as e:
                             title = '{}'.format(index)
                         if index in isotope_figure_mapper:
@@ -692,11 +833,10 @@ class Worker(Process):
                             isotope_figure_mapper[index] = isotope_base
                             isotope_figure['data'].append(isotope_base)
                         for group in precursors.keys():
-                            label_df = row[row['label'] == group]
-                            x = label_df['amplitude'].index.get_level_values('MZ').tolist()
-                            y = label_df['amplitude'].values.tolist()
+                            label_rows = row[row['label'] == group]
+                            amplitudes = dict(zip(label_rows['mz'].tolist(), label_rows['amplitude'].tolist()))
                             isotope_base['data']['columns'].append(
-                                ['{} {}'.format(title, group)] + [y[x.index(i)] if i in x else 0 for i in all_x])
+                                ['{} {}'.format(title, group)] + [amplitudes.get(i, 0) for i in all_x])
 
                 if not self.reporter_mode:
                     combined_peaks = defaultdict(dict)
@@ -707,9 +847,8 @@ class Worker(Process):
                     # combine the data to increase the SNR in case some XICs of a given ion are weak
 
                     if rt_guide and not self.parser_args.msn_all_scans:
-                        merged_data = combined_data.sum(axis=0)
-                        merged_x = merged_data.index.astype(float).values
-                        merged_y = merged_data.values.astype(float)
+                        merged_x = combined_data.rts.copy()
+                        merged_y = combined_data.intensities.sum(axis=0)
                         res, residual = peaks.targeted_search(
                             merged_x,
                             merged_y,
@@ -747,21 +886,21 @@ class Worker(Process):
                             merged_rb = len(merged_x) if merged_rb == -1 else merged_rb + 1
                         else:
                             merged_lb = 0
-                            merged_rb = combined_data.shape[1]
+                            merged_rb = len(combined_data.rts)
                             peak_location = start_rt
 
                     else:
                         merged_x = xdata
                         merged_y = ydata
                         merged_lb = 0
-                        merged_rb = combined_data.shape[1]
+                        merged_rb = len(combined_data.rts)
 
                     potential_peaks = defaultdict(list)
 
-                    for row_num, (index, values) in enumerate(combined_data.iterrows()):
-                        quant_label = isotope_labels.loc[index, 'label']
-                        xdata = values.index.values.astype(float)
-                        ydata = values.fillna(0).values.astype(float)
+                    for row_num, index in enumerate(combined_data.keys):
+                        quant_label = combined_data.rows['label'][row_num]
+                        xdata = combined_data.rts.copy()
+                        ydata = combined_data.intensities[row_num].copy()
 
                         # Setup the HTML first in case we do not fit any peaks, we still want to report the raw data
                         if self.html:
@@ -852,7 +991,7 @@ class Worker(Process):
                                     'amp': j,
                                     'std': l,
                                     'std2': k,
-                                    'total': values.sum(),
+                                    'total': ydata.sum(),
                                     'residual': residual,
                                 }
                                 mean_index = peaks.find_nearest_index(xdata[ydata > 0], i)
@@ -931,11 +1070,9 @@ class Worker(Process):
                 peak_info = {i: {} for i in self.mrm_pair_info.columns} if self.mrm else {i: {} for i in precursors.keys()}
                 if self.reporter_mode or combined_peaks:
                     if self.reporter_mode:
-                        for row_num, (index, values) in enumerate(combined_data.iterrows()):
-                            quant_label = isotope_labels.loc[index, 'label']
-                            isotope_index = isotope_labels.loc[index, 'isotope_index']
-                            int_val = sum(values)
-                            quant_vals[quant_label][isotope_index] = int_val
+                        for quant_label, isotope_index, values in zip(
+                                combined_data.rows['label'], combined_data.rows['isotope_index'], combined_data.intensities):
+                            quant_vals[quant_label][isotope_index] = values.sum()
                     else:
                         # common_peak = self.replaceOutliers(combined_peaks, combined_data, debug=self.debug)
                         common_peak = find_common_peak_mean(combined_peaks, tie_breaker_time=start_rt)
@@ -944,10 +1081,10 @@ class Worker(Process):
                             for index, values in quan_values.items():
                                 if not values:
                                     continue
-                                isotope_index = isotope_labels.loc[index, 'isotope_index']
-                                rt_values = combined_data.loc[index]
-                                xdata = rt_values.index.values.astype(float)
-                                ydata = rt_values.fillna(0).values.astype(float)
+                                row_num = combined_data.index(index)
+                                isotope_index = combined_data.rows['isotope_index'][row_num]
+                                xdata = combined_data.rts.copy()
+                                ydata = combined_data.intensities[row_num].copy()
                                 # pick the biggest within a rt cutoff of 0.2, otherwise pick closest
                                 # closest_rts = sorted([(i, i['amp']) for i in values if np.abs(i['peak']-common_peak) < 0.2], key=operator.itemgetter(1), reverse=True)
                                 closest_rts = sorted([(i, np.abs(i['mean'] - common_peak)) for i in values], key=operator.itemgetter(1))
@@ -1120,26 +1257,7 @@ class Worker(Process):
                             ratio = 'NA'
                             if qv1 is not None and qv2 is not None:
                                 if self.mono:
-                                    common_isotopes = set(qv1.keys()).intersection(qv2.keys())
-                                    x = []
-                                    y = []
-                                    l1, l2 = 0, 0
-                                    for i in common_isotopes:
-                                        q1 = qv1.get(i)
-                                        q2 = qv2.get(i)
-                                        if q1 > 100 and q2 > 100 and q1 > l1 * 0.15 and q2 > l2 * 0.15:
-                                            x.append(i)
-                                            y.append(q1 / q2)
-                                            l1, l2 = q1, q2
-                                    # fit it and take the intercept
-                                    if len(x) >= 3 and np.std(np.log2(y)) > 0.3:
-                                        classifier = EllipticEnvelope(contamination=0.25, random_state=0)
-                                        fit_data = np.log2(np.array(y).reshape(len(y), 1))
-                                        true_pred = (True, 1)
-                                        classifier.fit(fit_data)
-                                        ratio = nanmean([y[i] for i, v in enumerate(classifier.predict(fit_data)) if v in true_pred])
-                                    else:
-                                        ratio = nanmean(np.array(y))
+                                    ratio = mono_ratio(qv1, qv2)
                                 else:
                                     common_isotopes = set(qv1.keys()).union(qv2.keys())
                                     quant1 = sum([qv1.get(i, 0) for i in common_isotopes])
@@ -1157,7 +1275,7 @@ class Worker(Process):
                 for peak_label, peak_data in six.iteritems(peak_info):
                     result_dict.update({
                         '{}_peaks'.format(peak_label): peak_data,
-                        '{}_isotopes'.format(peak_label): sum((isotopes_chosen['label'] == peak_label) & (isotopes_chosen['amplitude'] > 0)),
+                        '{}_isotopes'.format(peak_label): int(np.sum((isotopes_chosen['label'] == peak_label) & (isotopes_chosen['amplitude'] > 0))),
                     })
             for silac_label, silac_data in six.iteritems(data):
                 precursor = silac_data['precursor']
@@ -1174,20 +1292,43 @@ class Worker(Process):
                     'isotope': isotope_figure,
                 }
             })
-            self.results.put(result_dict)
+            self.put_result(result_dict)
             del result_dict
             del combined_data
             del isotopes_chosen
         except Exception as e:
             print('ERROR encountered. Please report at https://github.com/Chris7/pyquant/issues:\n {}\nParameters: {}'.format(traceback.format_exc(), params))
             try:
-                self.results.put(result_dict)
+                self.put_result(result_dict)
             except Exception as e:
-                pass
+                # we failed before there was anything to report, but the task still has to be marked as finished
+                self.put_result({'key': params.get('key'), 'task_id': params.get('task_id'), 'order': params.get('order'), 'psms': params.get('psms', []), 'failed': True})
             return
 
+    def put_result(self, result_dict):
+        # the time taken is used by the scheduler to judge how much work to send at once, and with the time spent on the
+        # reader and when the result was sent, to judge whether more workers would help
+        result_dict['finished'] = time.time()
+        result_dict['elapsed'] = result_dict['finished']-self.task_start
+        result_dict['reader_wait'] = self.reader_wait
+        self.queue_operation(self.results.put, result_dict)
+
     def run(self):
-        for index, params in enumerate(iter(self.queue.get, None)):
-            self.params = params
-            self.quantify_peaks(params)
-        self.results.put(None)
+        signal.signal(signal.SIGTERM, self.stop)
+        if self.governor is not None:
+            self.governor.apply()
+        if self.mrm:
+            self.quant_mrm_map = {label: list(group) for label, group in
+                                  groupby(self.run_map.quant_map(), key=operator.itemgetter(0))}
+        # tasks are sent in lists, so cheap tasks can be sent together
+        for tasks in iter(self.queue.get, None):
+            for params in tasks:
+                self.params = params
+                self.task_scans = params.get('xic_scans')
+                self.peak_finding_kwargs = self.fast_peak_finding_kwargs if params.get('fast_fit') else self.default_peak_finding_kwargs
+                self.task_start = time.time()
+                self.reader_wait = 0
+                self.quantify_peaks(params)
+                if self.governor is not None and self.governor.over_memory_limit():
+                    # the main process hands the rest of our tasks to the worker that replaces us
+                    sys.exit(RECYCLE_EXIT_CODE)
@@ -0,0 +1,288 @@
+import os
+import threading
+import time
+
+import six
+from six.moves.queue import Queue, Empty
+
+from .logger import logger
+
+_SENTINEL = object()
+_FLUSH = object()
+
+FLOAT = 'float'
+STRING = 'string'
+
+PARQUET = 'parquet'
+ARROW = 'arrow'
+
+
+def truncate_lines(path, count):
+    """
+    Truncates a text file to its first count lines. Returns the number of lines dropped.
+    """
+    with open(path, 'r+b') as handle:
+        for _ in six.moves.range(count):
+            if not handle.readline():
+                return 0
+        position = handle.tell()
+        dropped = sum(1 for _ in handle)
+        handle.truncate(position)
+    return dropped
+
+
+class TextSink(object):
+    """
+    Writes records to a text handle. formatter converts a record into the string that is written.
+    """
+    def __init__(self, handle, formatter=None, close=False):
+        self.handle = handle
+        self.formatter = formatter if formatter is not None else str
+        self.owns_handle = close
+
+    def write(self, record):
+        self.handle.write(self.formatter(record))
+
+    def flush(self, durable=False):
+        self.handle.flush()
+        if durable:
+            try:
+                os.fsync(self.handle.fileno())
+            except (AttributeError, OSError, ValueError, IOError):
+                # stdout and friends cannot always be synced
+                pass
+
+    def close(self):
+        if self.owns_handle:
+            self.handle.close()
+
+
+class RecordSink(object):
+    """
+    Appends records to a RecordStore. formatter converts a record into what is stored.
+    """
+    def __init__(self, store, formatter=None, close=False):
+        self.store = store
+        self.formatter = formatter if formatter is not None else (lambda x: x)
+        self.owns_store = close
+
+    def write(self, record):
+        self.store.append(self.formatter(record))
+
+    def flush(self, durable=False):
+        self.store.flush(durable=durable)
+
+    def close(self):
+        if self.owns_store:
+            self.store.close()
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_string(value):
+    return None if value is None or value == 'NA' else six.text_type(value)
+
+
+class ColumnarSink(object):
+    """
+    Writes records as typed Arrow record batches to a parquet or Arrow IPC file.
+
+    columns is a list of (name, type) and formatter converts a record into a list of values in that order. If
+    peak_columns is provided, the formatter also returns the peak report (a list of rows), which is stored as a list of
+    structs per result instead of additional columns. Values that cannot be represented as their column's type
+    (such as 'NA') are stored as nulls. Buffered rows are written out once batch_size rows accumulate, the file
+    is only complete once the sink is closed.
+    """
+    def __init__(self, path, columns, formatter, peak_columns=None, file_format=PARQUET, batch_size=10000):
+        import pyarrow as pa
+
+        self.pa = pa
+        self.path = path
+        self.columns = columns
+        self.peak_columns = peak_columns
+        self.formatter = formatter
+        self.file_format = file_format
+        self.batch_size = batch_size
+        self.converters = [to_float if column_type == FLOAT else to_string for _, column_type in columns]
+        fields = [pa.field(name, self.get_arrow_type(column_type)) for name, column_type in columns]
+        if peak_columns is not None:
+            self.peak_converters = [to_float if column_type == FLOAT else to_string for _, column_type in peak_columns]
+            peak_type = pa.struct([pa.field(name, self.get_arrow_type(column_type)) for name, column_type in peak_columns])
+            fields.append(pa.field('Peaks', pa.list_(peak_type)))
+        self.schema = pa.schema(fields)
+        self.buffer = [[] for _ in fields]
+        self.rows = 0
+        if file_format == PARQUET:
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(path, self.schema)
+
+    def get_arrow_type(self, column_type):
+        return self.pa.float64() if column_type == FLOAT else self.pa.string()
+
+    def write(self, record):
+        if self.peak_columns is not None:
+            values, peaks = self.formatter(record)
+            self.buffer[-1].append([
+                {name: converter(value) for (name, _), converter, value in zip(self.peak_columns, self.peak_converters, peak)}
+                for peak in peaks
+            ])
+        else:
+            values = self.formatter(record)
+        for column, converter, value in zip(self.buffer, self.converters, values):
+            column.append(converter(value))
+        self.rows += 1
+
+    def write_buffer(self):
+        if not self.rows:
+            return
+        arrays = [self.pa.array(column, type=field.type) for column, field in zip(self.buffer, self.schema)]
+        batch = self.pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+        if self.file_format == PARQUET:
+            self.writer.write_table(self.pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+        self.buffer = [[] for _ in self.buffer]
+        self.rows = 0
+
+    def flush(self, durable=False):
+        # columnar files are only readable once closed, so we favor large batches over frequent writes
+        if self.rows >= self.batch_size:
+            self.write_buffer()
+
+    def close(self):
+        self.write_buffer()
+        self.writer.close()
+
+
+class ReorderBuffer(object):
+    """
+    Puts records to a writer in the order of the tasks they belong to, no matter the order tasks finish in.
+
+    Each task is put with its order and the records it produced (which may be none), and the records of a task are
+    held until those of every task before it have been put, and then put together with put_all. What is held is bounded by how far ahead of the earliest
+    unfinished task tasks are handed out, which is the window of the TaskScheduler.
+    """
+    def __init__(self, writer, start=0):
+        self.writer = writer
+        self.next_order = start
+        self.held = {}
+
+    def put(self, order, records):
+        self.held[order] = records
+        while self.next_order in self.held:
+            records = self.held.pop(self.next_order)
+            if records:
+                self.writer.put_all(records)
+            self.next_order += 1
+
+    def skip(self, order):
+        self.put(order, [])
+
+    def __len__(self):
+        return len(self.held)
+
+
+class ResultWriter(threading.Thread):
+    """
+    Writes results on a background thread so the collector never waits on the disk.
+
+    Records are queued (the queue is bounded, so a slow disk will apply backpressure) and handed to every sink in
+    batches of batch_size, or whatever has accumulated after flush_interval seconds. Sinks are written and flushed in
+    the order given, so if the resume file is the last sink, any entry in it is guaranteed to be in the output files
+    as well. The records given to put_all are always written in the same batch, so they are all in the output or none
+    are.
+
+    In durable mode, every record is written and synced before put returns, which is the behavior of writing
+    directly from the collector.
+    """
+    def __init__(self, sinks, queue_size=1000, batch_size=100, flush_interval=1.0, durable=False):
+        super(ResultWriter, self).__init__()
+        self.daemon = True
+        self.sinks = sinks
+        self.queue = Queue(maxsize=queue_size)
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.durable = durable
+        self.error = None
+
+    def put(self, record):
+        self.put_all([record])
+
+    def put_all(self, records):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(list(records))
+        if self.durable:
+            self.queue.join()
+
+    def flush(self):
+        """
+        Blocks until every record put so far has been written and flushed by all sinks.
+        """
+        if self.is_alive():
+            self.queue.put(_FLUSH)
+            self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self.is_alive():
+            self.queue.put(_SENTINEL)
+            self.join()
+        if self.error is not None:
+            raise self.error
+
+    def write_batch(self, batch):
+        for sink in self.sinks:
+            for record in batch:
+                sink.write(record)
+            sink.flush(durable=self.durable)
+
+    def run(self):
+        batch = []
+        last_flush = time.time()
+        finished = False
+        while not finished:
+            flush = False
+            timeout = None
+            if batch:
+                timeout = max(self.flush_interval - (time.time() - last_flush), 0)
+            try:
+                record = self.queue.get(timeout=timeout)
+            except Empty:
+                record = None
+            else:
+                if record is _SENTINEL:
+                    finished = True
+                elif record is _FLUSH:
+                    flush = True
+                else:
+                    if not batch:
+                        # the interval starts with the first record of a batch, so a batch that follows an idle
+                        # spell is not written as soon as it begins
+                        last_flush = time.time()
+                    batch.extend(record)
+            if batch and (finished or flush or self.durable or len(batch) >= self.batch_size or time.time() - last_flush >= self.flush_interval):
+                if self.error is None:
+                    try:
+                        self.write_batch(batch)
+                    except Exception as e:
+                        logger.error('Unable to write results: {}'.format(e))
+                        self.error = e
+                batch = []
+                last_flush = time.time()
+            if record is not None:
+                self.queue.task_done()
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
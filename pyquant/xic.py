@@ -0,0 +1,162 @@
+import numpy as np
+import six
+
+# the key, label and isotope index of each row of an XICMatrix
+ROW_DTYPE = [('key', object), ('label', object), ('isotope_index', int)]
+
+# the ions chosen from each scan of an XIC
+ISOTOPE_DTYPE = [('rt', float), ('mz', float), ('label', object), ('isotope_index', int), ('amplitude', float)]
+
+
+def chosen_isotopes(isotopes_chosen):
+    """
+    Converts a dictionary of (rt, mz) to the label, isotope index and amplitude of the ion chosen there into a
+    structured array.
+    """
+    return np.array(
+        [(rt, mz, i['label'], i['isotope_index'], i['amplitude']) for (rt, mz), i in six.iteritems(isotopes_chosen)],
+        dtype=ISOTOPE_DTYPE,
+    )
+
+
+class XICMatrix(object):
+    """
+    The XICs of the ions of a target, as a matrix of ions by scans.
+
+    While an XIC is traced, the intensities found in each scan are added to a column of a preallocated matrix, which
+    doubles in size when it fills, so building an XIC takes time linear in its length. Rows are keyed by the m/z of
+    each ion, and columns by the retention time of each scan.
+
+    Once tracing is done, compact sorts the rows and columns and leaves out the scans that were removed. The XIC is
+    then held in keys (the key of each row), rts (the retention time of each column) and intensities, and after
+    label, rows holds the key, label and isotope index of each row.
+    """
+    def __init__(self, rows=8, columns=64):
+        self.matrix = np.zeros((rows, columns))
+        self.row_index = {}
+        self.column_index = {}
+        self.column_count = 0
+        self.keys = None
+        self.column_keys = None
+        self.rts = None
+        self.intensities = None
+        self.rows = None
+
+    def get_row(self, key):
+        row = self.row_index.get(key)
+        if row is None:
+            row = len(self.row_index)
+            if row == self.matrix.shape[0]:
+                self.matrix = np.vstack([self.matrix, np.zeros_like(self.matrix)])
+            self.row_index[key] = row
+        return row
+
+    def get_column(self, key):
+        column = self.column_index.get(key)
+        if column is None:
+            # removed columns are not reused, they are left out by compact
+            column = self.column_count
+            if column == self.matrix.shape[1]:
+                self.matrix = np.hstack([self.matrix, np.zeros_like(self.matrix)])
+            self.column_index[key] = column
+            self.column_count += 1
+        return column
+
+    def __contains__(self, column_key):
+        return column_key in self.column_index
+
+    @property
+    def empty(self):
+        if self.intensities is not None:
+            return self.intensities.size == 0
+        return not self.row_index or not self.column_index
+
+    def add(self, column_key, values):
+        """
+        Adds a dictionary of row keys to intensities to the column of a scan.
+        """
+        column = self.get_column(column_key)
+        for key, value in six.iteritems(values):
+            # the row is found first, as it may grow the matrix
+            row = self.get_row(key)
+            self.matrix[row, column] += value
+
+    def zero(self, column_key):
+        column = self.get_column(column_key)
+        self.matrix[:, column] = 0
+
+    def remove(self, column_key):
+        self.column_index.pop(column_key, None)
+
+    def compact(self):
+        self.keys = sorted(self.row_index)
+        self.column_keys = sorted(self.column_index)
+        self.intensities = self.matrix[np.ix_(
+            [self.row_index[i] for i in self.keys],
+            [self.column_index[i] for i in self.column_keys],
+        )]
+        self.rts = np.array(self.column_keys, dtype=float)
+        self.matrix = None
+
+    def transpose(self):
+        """
+        Swaps the rows and columns of a compacted XIC, for MRM runs where the scans are the ions traced.
+        """
+        self.keys, self.column_keys = self.column_keys, self.keys
+        self.rts = np.array(self.column_keys, dtype=float)
+        self.intensities = self.intensities.T
+
+    def label(self, isotope_labels):
+        """
+        Sets the label and isotope index of each row from a dictionary of row keys to them.
+        """
+        self.rows = np.array(
+            [(i, isotope_labels[i]['label'], isotope_labels[i]['isotope_index']) for i in self.keys],
+            dtype=ROW_DTYPE,
+        )
+
+    def index(self, key):
+        return self.keys.index(key)
+
+    def merge_isotopes(self):
+        """
+        Sums the rows of each label into the row of its lowest isotope.
+        """
+        if not self.keys:
+            return
+        codes = {}
+        label_codes = np.array([codes.setdefault(i, len(codes)) for i in self.rows['label']])
+        order = np.lexsort((np.arange(len(self.keys)), self.rows['isotope_index'], label_codes))
+        starts = np.flatnonzero(np.r_[True, np.diff(label_codes[order]) != 0])
+        merged = np.add.reduceat(self.intensities[order], starts, axis=0)
+        # the merged rows keep the order of the rows they are kept in
+        kept = order[starts]
+        kept_order = np.argsort(kept)
+        kept = kept[kept_order]
+        self.intensities = merged[kept_order]
+        self.rows = self.rows[kept]
+        self.keys = [self.keys[i] for i in kept]
+
+    def merge_labels(self, label_name):
+        """
+        Sums every row into a single row keyed and labeled label_name.
+        """
+        self.intensities = self.intensities.sum(axis=0)[np.newaxis, :]
+        self.keys = [label_name]
+        self.rows = np.array([(label_name, label_name, 0)], dtype=ROW_DTYPE)
+
+    def bookend(self, run_map):
+        """
+        Adds a column of zeros before and after the XIC, a scan's distance away from either end.
+        """
+        rts = self.rts
+        if len(rts) == 1:
+            last = run_map.next_rt(rts[-1])
+            if last is None:
+                last = rts[-1] + (rts[-1] - run_map.rts[-2])
+            first = rts[0] - (last - rts[0])
+        else:
+            last = rts[-1] + (rts[-1] - rts[-2])
+            first = rts[0] - (rts[1] - rts[0])
+        self.rts = np.concatenate([[first], rts, [last]])
+        self.intensities = np.pad(self.intensities, ((0, 0), (1, 1)), mode='constant')
@@ -28,6 +28,7 @@ setup(
     scripts=['scripts/pyQuant'],
     entry_points={'console_scripts': ['pyQuant = pyquant.command_line:run_pyquant',]},
     install_requires=['cython', 'numpy', 'scipy >= 0.18.*', 'patsy', 'pythomics >= 0.3.41', 'pandas', 'lxml', 'scikit-learn', 'simplejson'],
+    extras_require={'columnar': ['pyarrow']},
     include_package_data=True,
     description='A framework for the analysis of quantitative mass spectrometry data',
     url='http://www.github.com/pandeylab/pyquant',